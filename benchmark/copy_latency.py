@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Small GET latency while a large COPY runs
+
+    Runs against a live server, e.g.
+
+        python benchmark/copy_latency.py http://localhost:8080/webdav/
+
+    A source tree is uploaded under the collection, then the latency of
+    small GET requests is measured alone and while the server copies
+    the tree. With the file system work on the thread pool the p99 of
+    the second run stays close to the first one.
+"""
+
+import os
+import time
+import httplib
+import argparse
+import threading
+from urlparse import urlsplit
+
+
+def request(host, method, path, body=None, headers={}):
+    connection = httplib.HTTPConnection(host)
+    try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p/100.0))]
+
+
+def measure_gets(host, path, stop, count=None):
+    latency = []
+    connection = httplib.HTTPConnection(host)
+    while not stop() and (count==None or len(latency)<count):
+        start = time.time()
+        connection.request('GET', path)
+        connection.getresponse().read()
+        latency.append(time.time() - start)
+    connection.close()
+    return latency
+
+
+def report(name, latency):
+    print "%-12s requests %6d  p50 %7.2fms  p99 %7.2fms  max %7.2fms" % (
+        name, len(latency),
+        percentile(latency, 50)*1000, 
+        percentile(latency, 99)*1000,
+        max(latency)*1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('url', help='collection url to run in')
+    parser.add_argument('--files', type=int, default=64, 
+        help='files in the copied tree')
+    parser.add_argument('--size', type=int, default=16, 
+        help='size of each copied file in MB')
+    parser.add_argument('--requests', type=int, default=500, 
+        help='GET requests for the baseline')
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    host = url.netloc
+    base = url.path if url.path.endswith('/') else url.path + '/'
+    src = base + 'bench-src/'
+    dst = base + 'bench-dst/'
+    small = base + 'bench-small.txt'
+
+    request(host, 'DELETE', src)
+    request(host, 'DELETE', dst)
+    request(host, 'MKCOL', src)
+    request(host, 'PUT', small, 'x'*512)
+    block = os.urandom(1024*1024)
+    for i in range(args.files):
+        request(host, 'PUT', src + 'file%d.bin' % i, block*args.size)
+
+    report('idle', measure_gets(host, small, lambda: False, args.requests))
+
+    done = []
+    def copy():
+        start = time.time()
+        request(host, 'COPY', src, 
+            headers={'Destination': dst, 'Overwrite': 'T'})
+        done.append(time.time() - start)
+    copier = threading.Thread(target=copy)
+    copier.start()
+    latency = measure_gets(host, small, lambda: done!=[])
+    copier.join()
+    report('during COPY', latency)
+    print "COPY of %d MB took %.2fs" % (args.files*args.size, done[0])
+
+    request(host, 'DELETE', src)
+    request(host, 'DELETE', dst)
+    request(host, 'DELETE', small)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Collection COPY of a tree of small files
+
+    Runs in process on a temporary directory, e.g.
+
+        python benchmark/copy_tree.py --files 50000 --workers 8
+
+    A tree of small files is copied with shutil.copytree, as COPY did
+    before the copy engine, with copy_tree() without an executor and
+    with --workers threads. Removing a copy slows the next one down,
+    so the copies take turns for --rounds and the best time of each
+    is reported. The temporary directory decides the file system, 
+    --dir puts it on another one to try reflinks.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from http.copyengine import copy_tree
+
+
+def fill(directory, files, per_directory, size):
+    data = os.urandom(size)
+    for i in xrange(files):
+        sub = os.path.join(directory, 'd%d' % (i / per_directory))
+        if i % per_directory == 0:
+            os.makedirs(sub)
+        with open(os.path.join(sub, 'f%d.txt' % i), 'wb') as f:
+            f.write(data)
+
+
+def timed(copy, destination):
+    start = time.time()
+    copy()
+    elapsed = time.time() - start
+    shutil.rmtree(destination)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=50000,
+                        help='files of the tree')
+    parser.add_argument('--per-directory', type=int, default=500,
+                        help='files of each directory')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='bytes of each file')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='copy threads')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='copies of each kind')
+    parser.add_argument('--dir', default=None,
+                        help='directory to make the tree in')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.dir)
+    try:
+        source = os.path.join(root, 'source')
+        destination = os.path.join(root, 'destination')
+        fill(source, args.files, args.per_directory, args.size)
+
+        executor = ThreadPoolExecutor(args.workers)
+
+        def engine(executor):
+            os.mkdir(destination)
+            failures = copy_tree(source, destination, executor)
+            assert failures == [], failures[:10]
+
+        copies = [
+            ('copytree', lambda: shutil.copytree(source, destination)),
+            ('engine', lambda: engine(None)),
+            ('engine x%d' % args.workers, lambda: engine(executor)),
+            ]
+        times = dict( (name, []) for name, copy in copies )
+        try:
+            for i in xrange(args.rounds):
+                for name, copy in copies[i % 3:] + copies[:i % 3]:
+                    times[name].append(timed(copy, destination))
+        finally:
+            executor.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+    for name, copy in copies:
+        elapsed = min(times[name])
+        print '%-12s %7.2fs %9.0f files/s' % (name, elapsed, 
+                                               args.files / elapsed)
+
+
+if __name__ == '__main__':
+    main()
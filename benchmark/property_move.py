@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Property table MOVE of a large collection
+
+    Runs on an sqlite database file, e.g.
+
+        python benchmark/property_move.py --descendants 100000
+
+    The properties of a collection with many descendants are moved
+    among other unrelated rows, first on the old unindexed table with
+    the LIKE and REPLACE statements, then on the indexed table of the
+    storage with range queries. The times of a small collection move
+    and of a single resource select (a PROPFIND) are reported for both.
+"""
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from http.storage import SqliteStorage
+
+
+OLD_TABLE = """\
+    create table property (
+        id integer primary key autoincrement,
+        uri text not null,
+        property_name text not null,
+        property_value text)"""
+
+OLD_DELETE = "DELETE FROM property WHERE uri LIKE ?"
+OLD_MOVE = "UPDATE property SET uri = REPLACE(uri, ?, ?) WHERE uri LIKE ?"
+OLD_SELECT = """\
+    select id, uri, property_name, property_value from property
+    where uri = ?"""
+
+VALUE = '<R:author xmlns:R="http://www.foo.bar/boxschema/">me</R:author>'
+
+
+def rows(descendants, others):
+    for i in xrange(descendants):
+        yield ('/webdav/big/d%d/f%d.txt' % (i % 100, i),
+               '{http://www.foo.bar/boxschema/}author', VALUE)
+    for i in xrange(others):
+        yield ('/webdav/other%d/f%d.txt' % (i % 1000, i),
+               '{http://www.foo.bar/boxschema/}author', VALUE)
+
+
+def fill(connection, descendants, others):
+    connection.execute("BEGIN")
+    connection.executemany("""\
+        insert into property (uri, property_name, property_value)
+        values (?, ?, ?)""", rows(descendants, others))
+    connection.execute("COMMIT")
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def run_old(filename, args):
+    connection = sqlite3.connect(filename, isolation_level=None)
+    connection.execute(OLD_TABLE)
+    fill(connection, args.descendants, args.others)
+
+    def move(from_uri, to_uri):
+        connection.execute("BEGIN")
+        connection.execute(OLD_DELETE, (to_uri + '%',))
+        connection.execute(OLD_MOVE, (from_uri, to_uri, from_uri + '%'))
+        connection.execute("COMMIT")
+
+    def select():
+        connection.execute(OLD_SELECT, ('/webdav/other7/f7.txt',)).fetchall()
+
+    results = (timed(move, '/webdav/big/', '/webdav/moved/'), 
+               timed(move, '/webdav/other7/', '/webdav/small/'),
+               timed(select))
+    connection.close()
+    return results
+
+
+def run_new(filename, args):
+    db = SqliteStorage(filename)
+    fill(db._db, args.descendants, args.others)
+    results = (timed(db.move_properties, '/webdav/big/', '/webdav/moved/', True),
+               timed(db.move_properties, '/webdav/other7/', '/webdav/small/', True),
+               timed(db.select_properties, ['/webdav/other7/f7.txt']))
+    db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--descendants', type=int, default=100000,
+                        help='property rows below the moved collection')
+    parser.add_argument('--others', type=int, default=400000,
+                        help='unrelated property rows')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        old = run_old(os.path.join(directory, 'old.db'), args)
+        new = run_new(os.path.join(directory, 'new.db'), args)
+    finally:
+        shutil.rmtree(directory)
+
+    print '%d descendants, %d other rows' % (args.descendants, args.others)
+    print '%-10s %12s %16s %12s' % ('', 'move (s)', 'small move (ms)', 
+                                    'select (ms)')
+    for name, result in (('unindexed', old), ('indexed', new)):
+        print '%-10s %12.3f %16.3f %12.3f' % (name, result[0], 
+                                    result[1]*1000, result[2]*1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Depth 1 PROPFIND of a large collection
+
+    Runs in process on a temporary directory, e.g.
+
+        python benchmark/propfind_depth1.py --entries 10000
+
+    The collection is listed and its allprop PROPFIND response is 
+    written to memory, as the request handler does. The file system 
+    calls made through the os module are reported, with the wall time
+    of the listing and of the whole request.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tornado.concurrent import Future
+from http import file_object
+from http.file_object import FileObject
+from http.dav.properties import PropFindParser
+from http.dav.lock import Lockdb
+from http.multistatus import MultistatusWriter
+from http.storage import SqliteStorage
+
+
+ALLPROP = '<D:propfind xmlns:D="DAV:"><D:allprop/></D:propfind>'
+CALLS = ('stat', 'lstat', 'listdir')
+
+
+class Application(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.db = SqliteStorage(':memory:')
+        self.lockdb = Lockdb()
+        self.executor = None
+
+
+class Handler(object):
+    """ keeps the size of the body """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+class Counter(object):
+    """ counts the calls of the os file system functions """
+    def __init__(self):
+        self.calls = dict( (name, 0) for name in CALLS + ('scandir',) )
+        self._saved = {}
+
+    def _wrap(self, module, name, key):
+        function = getattr(module, name)
+        self._saved[(module, name)] = function
+        def counted(*args, **kwargs):
+            self.calls[key] += 1
+            return function(*args, **kwargs)
+        setattr(module, name, counted)
+
+    def __enter__(self):
+        for name in CALLS:
+            self._wrap(os, name, name)
+        self._wrap(file_object, 'scandir', 'scandir')
+        return self
+
+    def __exit__(self, *args):
+        for (module, name), function in self._saved.items():
+            setattr(module, name, function)
+
+
+def fill(directory, entries):
+    os.mkdir(directory)
+    for i in xrange(entries):
+        if i % 100 == 0:
+            os.mkdir(os.path.join(directory, 'd%d' % i))
+        else:
+            open(os.path.join(directory, 'f%d.txt' % i), 'w').close()
+
+
+def propfind(application, parser):
+    """ return (childs, response size, listing time, total time) """
+    start = time.time()
+    collection = FileObject(application, 'col', '')
+    childs = collection.childs()
+    listed = time.time()
+    status, responses = collection.propfind(parser, 1, childs).result()
+    handler = Handler()
+    MultistatusWriter(handler).write(responses).result()
+    return len(childs), handler.size, listed - start, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=10000,
+                        help='entries of the collection')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='timed runs')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        fill(os.path.join(root, 'col'), args.entries)
+        application = Application(root)
+        propfind_parser = PropFindParser(ALLPROP)
+        
+        with Counter() as counter:
+            childs, size, listing, total = propfind(application, 
+                                                    propfind_parser)
+        runs = [propfind(application, propfind_parser)[2:] 
+                for i in xrange(args.runs)]
+    finally:
+        shutil.rmtree(root)
+
+    print '%d childs, %d bytes of response' % (childs, size)
+    print 'calls: %s' % ', '.join('%s %d' % (name, counter.calls[name]) 
+                                  for name in sorted(counter.calls))
+    for name, times in zip(('listing', 'request'), zip(*runs)):
+        print '%-8s best %.3f s, mean %.3f s' % (name, min(times), 
+                                            sum(times)/len(times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Depth 1 PROPFIND throughput by requested properties
+
+    Runs in process on a temporary directory, e.g.
+
+        python benchmark/propfind_narrow.py --entries 10000
+
+    The collection is listed once, then Depth 1 PROPFIND responses of
+    a single live property, of a single dead property and of allprop
+    are written to memory for a few seconds each. The resources per 
+    second are reported. Every tenth child has a dead property of
+    about --value-size bytes of xml.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from http.file_object import FileObject
+from http.dav.properties import PropFindParser
+from http.multistatus import MultistatusWriter
+from propfind_depth1 import Application, Handler, fill
+
+
+REQUESTS = [
+    ('getetag', """\
+        <D:propfind xmlns:D="DAV:"><D:prop><D:getetag/></D:prop></D:propfind>"""),
+    ('dead', """\
+        <D:propfind xmlns:D="DAV:" xmlns:Z="x:"><D:prop><Z:p/></D:prop></D:propfind>"""),
+    ('allprop', """\
+        <D:propfind xmlns:D="DAV:"><D:allprop/></D:propfind>"""),
+    ]
+
+
+def throughput(collection, childs, parser, seconds):
+    """ resources per second of the responses """
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        status, responses = collection.propfind(parser, 1, childs).result()
+        MultistatusWriter(Handler()).write(responses).result()
+        count += len(childs) + 1
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=10000,
+                        help='entries of the collection')
+    parser.add_argument('--seconds', type=float, default=3,
+                        help='time of each request type')
+    parser.add_argument('--value-size', type=int, default=0,
+                        help='bytes of each dead property')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        fill(os.path.join(root, 'col'), args.entries)
+        application = Application(root)
+        item = '<Z:e n="0">item</Z:e>'
+        items = item * (args.value_size / len(item))
+        for i in xrange(0, args.entries, 10):
+            application.db.insert_property('/col/f%d.txt' % i, '{x:}p', 
+                            '<Z:p xmlns:Z="x:">%d%s</Z:p>' % (i, items))
+        collection = FileObject(application, 'col', '')
+        childs = collection.childs()
+        results = [(name, throughput(collection, childs, 
+                                     PropFindParser(body), args.seconds))
+                   for name, body in REQUESTS]
+    finally:
+        shutil.rmtree(root)
+
+    print '%d childs' % len(childs)
+    for name, rate in results:
+        print '%-8s %10.0f resources/s' % (name, rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,19 +20,12 @@ import os
 
 
 class DbSqlAuth(object):
-    """ Database users mysql
+    """ Database users of the server storage
     """
     def __init__(self, realm, database):
         self.realm = realm
         self._db = database
-        
-        user_list = []
-        for row in self._db.iter("""\
-            SELECT id, realm, user_name, user_hash
-            FROM users"""):
-            if row['realm'] == self.realm:
-                user_list.append( (row['user_name'], row['user_hash']) )
-        self._usersdb = dict( user_list )
+        self._usersdb = dict( self._db.select_users(self.realm) )
 
 
 class DbFileAuth(object):
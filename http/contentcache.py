@@ -0,0 +1,150 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import threading
+from collections import OrderedDict
+
+
+""" Small file content cache
+
+    A LRU of the content of the small files served by GET, bounded by
+    the bytes it holds and keyed by absolute path. An entry keeps the
+    size, modification time and inode of the file it was read from,
+    stated on the open file, and is only used while the stat of the
+    file is the same, so the files changed by others are read again
+    even within the second of the etag. The server invalidates the
+    paths it changes itself like it does for the metadata cache.
+"""
+
+CONTENT_BUDGET = 32*1024*1024
+# largest file kept
+CONTENT_MAX_FILE = 64*1024
+
+
+def validator(stat):
+    """ what an entry is checked with, of an os.stat result or of an
+        object with the same members
+    """
+    return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+
+class ContentCache(object):
+    """ LRU of file contents, budget is the number of bytes kept and
+        max_file the size of the largest file kept, 0 disables it.
+
+        Files are read outside of the cache lock, a content read
+        before an invalidation is not kept.
+    """
+
+    def __init__(self, budget=CONTENT_BUDGET, max_file=CONTENT_MAX_FILE):
+        self.budget = budget
+        self.max_file = min(max_file, budget)
+        self.hits = 0
+        self.misses = 0
+        # path: (validator, content)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return self.budget > 0 and self.max_file > 0
+
+    def fits(self, size):
+        """ a file of size bytes can be kept """
+        return self.enabled() and size <= self.max_file
+
+    def get(self, path, valid):
+        """ (content or None, generation to load the content with),
+            valid is the validator of the current stat of path
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry!=None and entry[0]==valid:
+                self.hits += 1
+                # most recently used last
+                self._entries[path] = self._entries.pop(path)
+                return entry[1], self._generation
+            if entry!=None:
+                self._drop(path)
+            self.misses += 1
+            return None, self._generation
+
+    def load(self, path, generation):
+        """ read the content of path and keep it, None when it is
+            too large or changed while it was read. Raises IOError
+            when it cannot be read
+        """
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if not self.fits(stat.st_size):
+                # grown since it was stated
+                return None
+            content = f.read(self.max_file + 1)
+        if len(content)!=stat.st_size:
+            return None
+        with self._lock:
+            if generation==self._generation:
+                self._drop(path)
+                self._entries[path] = (validator(stat), content)
+                self._bytes += len(content)
+                while self._bytes > self.budget and self._entries:
+                    key, old = self._entries.popitem(last=False)
+                    self._bytes -= len(old[1])
+        return content
+
+    def read(self, path, valid):
+        """ content of path from the cache or read now, None when it
+            cannot be kept
+        """
+        content, generation = self.get(path, valid)
+        if content==None:
+            content = self.load(path, generation)
+        return content
+
+    def invalidate(self, path, tree=False):
+        """ forget path, and everything below it when tree """
+        with self._lock:
+            self._generation += 1
+            self._drop(path)
+            if tree:
+                prefix = path.rstrip('/') + '/'
+                for key in [key for key in self._entries
+                            if key.startswith(prefix)]:
+                    self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'enabled': self.enabled(),
+                    'budget': self.budget,
+                    'max_file': self.max_file,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def _drop(self, path):
+        entry = self._entries.pop(path, None)
+        if entry!=None:
+            self._bytes -= len(entry[1])
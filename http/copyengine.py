@@ -0,0 +1,247 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import errno
+import shutil
+import ctypes
+import ctypes.util
+from concurrent.futures import Future
+
+from fswalk import scandir
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+""" File and tree copy
+
+    copy_file() copies the content of a file the cheapest way the file
+    system allows: a FICLONE reflink shares the blocks of the source,
+    otherwise the data ranges of the source are copied with
+    copy_file_range(2) in the kernel, or read and written when it is
+    not available. Holes found with SEEK_DATA and SEEK_HOLE are not
+    copied so sparse files stay sparse. copy_tree() walks a tree with
+    scandir and copies its files on an executor, the failures are
+    returned instead of ending the copy.
+"""
+
+CHUNK_SIZE = 1024*1024
+# files copied by a task of the executor
+BATCH_SIZE = 64
+
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# errors of a copy method the file system does not support
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _libc_copy_file_range():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = libc.copy_file_range
+    except (OSError, AttributeError):
+        return None
+    offset = ctypes.POINTER(ctypes.c_int64)
+    function.argtypes = [ctypes.c_int, offset, ctypes.c_int, offset,
+                         ctypes.c_size_t, ctypes.c_uint]
+    function.restype = ctypes.c_ssize_t
+    return function
+
+_copy_file_range = _libc_copy_file_range()
+
+
+def _clone(fd_in, fd_out):
+    """ reflink the whole file, False when not supported """
+    if fcntl==None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(fd_out, FICLONE, fd_in)
+    except (IOError, OSError), why:
+        if why.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def _segments(fd, size):
+    """ (start, end) of the data ranges of the file """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError, why:
+            if why.errno==errno.ENXIO:
+                # a hole up to the end
+                return
+            # holes are not reported, all data
+            yield offset, size
+            return
+        yield start, min(end, size)
+        offset = end
+
+
+def _copy_range(fd_in, fd_out, start, end):
+    """ copy the bytes from start to end at the same offsets """
+    if _copy_file_range!=None:
+        off_in = ctypes.c_int64(start)
+        off_out = ctypes.c_int64(start)
+        while off_in.value < end:
+            count = _copy_file_range(fd_in, ctypes.byref(off_in),
+                                     fd_out, ctypes.byref(off_out),
+                                     min(end - off_in.value, 1<<30), 0)
+            if count==0:
+                # the file got shorter
+                return
+            if count < 0:
+                err = ctypes.get_errno()
+                if err not in _UNSUPPORTED:
+                    raise OSError(err, os.strerror(err))
+                break
+        else:
+            return
+        start = off_in.value
+
+    os.lseek(fd_in, start, os.SEEK_SET)
+    os.lseek(fd_out, start, os.SEEK_SET)
+    while start < end:
+        data = os.read(fd_in, min(CHUNK_SIZE, end - start))
+        if not data:
+            return
+        start += len(data)
+        while data:
+            data = data[os.write(fd_out, data):]
+
+
+def copy_file(source, destination):
+    """ copy the content, mode and times of the file source to
+        destination, returns the size of the copy
+    """
+    fd_in = os.open(source, os.O_RDONLY)
+    try:
+        size = os.fstat(fd_in).st_size
+        fd_out = os.open(destination,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            if size==0 or not _clone(fd_in, fd_out):
+                for start, end in _segments(fd_in, size):
+                    _copy_range(fd_in, fd_out, start, end)
+                # a trailing hole
+                os.ftruncate(fd_out, size)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+    shutil.copystat(source, destination)
+    return size
+
+
+def copy_link(source, destination):
+    """ create a symbolic link as source at destination """
+    os.symlink(os.readlink(source), destination)
+    return 0
+
+
+def _copy_batch(batch, progress):
+    """ copy (method, source, destination) of a batch, returns the
+        failures
+    """
+    failures = []
+    files = size = 0
+    for method, from_path, to_path in batch:
+        try:
+            size += method(from_path, to_path)
+            files += 1
+        except (IOError, os.error), why:
+            failures.append( (to_path, False, why) )
+    if progress!=None:
+        progress.add(files, size)
+    return failures
+
+
+def _submit(executor, batch, progress):
+    if executor!=None:
+        return executor.submit(_copy_batch, batch, progress)
+    future = Future()
+    future.set_result(_copy_batch(batch, progress))
+    return future
+
+
+def copy_tree(source, destination, executor=None, hidden=None,
+              progress=None):
+    """ copy what the directory source holds into the existing
+        directory destination. Files are copied in batches on the
+        executor, or one after another without one. Symbolic links
+        are copied as links, other special files and the names
+        starting with hidden are left out. progress.add(files, bytes)
+        is called with what each batch copied.
+
+        Returns the members that could not be copied as a list of
+        (destination path, is a directory, error), the content of a
+        directory that could not be created is not copied.
+    """
+    failures = []
+    directories = []
+    batches = []
+    batch = []
+    stack = [(source, destination)]
+    while stack:
+        from_dir, to_dir = stack.pop()
+        try:
+            entries = list(scandir(from_dir))
+        except os.error, why:
+            failures.append( (to_dir, True, why) )
+            continue
+        directories.append( (from_dir, to_dir) )
+        for entry in entries:
+            if hidden and entry.name.startswith(hidden):
+                continue
+            from_path = os.path.join(from_dir, entry.name)
+            to_path = os.path.join(to_dir, entry.name)
+            try:
+                if entry.is_symlink():
+                    batch.append( (copy_link, from_path, to_path) )
+                elif entry.is_dir():
+                    os.mkdir(to_path)
+                    stack.append( (from_path, to_path) )
+                elif entry.is_file():
+                    batch.append( (copy_file, from_path, to_path) )
+            except os.error, why:
+                failures.append( (to_path, True, why) )
+            if len(batch) >= BATCH_SIZE:
+                batches.append(_submit(executor, batch, progress))
+                batch = []
+    if batch:
+        batches.append(_submit(executor, batch, progress))
+
+    for future in batches:
+        failures.extend(future.result())
+    # after their content changed them
+    for from_dir, to_dir in reversed(directories):
+        try:
+            shutil.copystat(from_dir, to_dir)
+        except os.error:
+            pass
+    return failures
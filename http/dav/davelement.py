@@ -14,9 +14,20 @@
 # under the License.
 
 
+from lxml import etree
 from lxml.builder import ElementMaker
 from httplib import responses as http_responses
 
+# WebDAV status codes missing from httplib, tornado only sets
+# status codes it finds there
+http_responses.update({
+    207: 'Multi-Status',
+    422: 'Unprocessable Entity',
+    423: 'Locked',
+    424: 'Failed Dependency',
+    507: 'Insufficient Storage',
+})
+
 DAV_NS="DAV:"     
 DAVElement = ElementMaker(namespace=DAV_NS, nsmap={'d' : DAV_NS})                  
 
@@ -30,6 +41,16 @@ HrefElement = DAVElement.href
 CollectionElement = DAVElement.collection
 ErrorElement = DAVElement.error
 
+# placeholder of a serialized property, its text is written as is
+RAW_TAG = '{urn:shadav}raw'
+
+def RawElement(fragment):
+    """ element holding a serialized xml fragment
+    """
+    element = etree.Element(RAW_TAG)
+    element.text = fragment
+    return element
+
 """Factory class for elements
 """
 class DavElementFactory(object):
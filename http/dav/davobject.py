@@ -15,18 +15,25 @@
 
 import calendar
 import time
+import itertools
 from email.utils import formatdate
 from datetime import datetime
+from tornado import gen
+from tornado.concurrent import Future
 
 from davelement import *
 from properties import Properties, DbAdapter
 from lock import LockDiscovery, EXCLUSIVE, SHARED
 
+# objects of a depth infinity walk listed and selected together
+WALK_BATCH = 256
+
 class DavObject(object):
     """ 
         Dav basic object
         represents a file tree like hierarchy of object and its properties
     """
+    etag = ""
     
     def __init__(self, appliction=None, parent='', name=''):
         self.application = appliction
@@ -42,7 +49,6 @@ class DavObject(object):
         self.st_mtime = 0
         self.st_ctime = 0
         self.st_size = 0
-        self.etag = ""
 
         self._properties = [
             ('{DAV:}creationdate'    , 'creationdate' ),
@@ -53,11 +59,19 @@ class DavObject(object):
             ('{DAV:}getcontenttype'  , 'getcontenttype' ),
             ]            
 
-    def get_properties(self):
-        adapter = DbAdapter(self.application.db)        
-        adapter.select(self.uri)
+    def get_properties(self, adapter):
+        """ object properties, adapter is an already selected
+            database adapter of this object
+        """
         locks   = self.application.lockdb.all_locks(self.uri)
         return Properties(self, adapter, locks)
+
+    @gen.coroutine
+    def select_properties(self):
+        """ object properties selected from the database """
+        adapter = DbAdapter(self.application.db)        
+        yield adapter.select(self.uri)
+        raise gen.Return(self.get_properties(adapter))
         
     def is_collection(self):
         return self.collection
@@ -70,6 +84,17 @@ class DavObject(object):
         """
         return []
 
+    def walk(self):
+        """ generate the objects below this collection, depth first
+        """
+        stack = [self]
+        while stack:
+            childs = stack.pop().childs()
+            for child in childs:
+                yield child
+            stack.extend(child for child in reversed(childs) 
+                            if child.collection)
+
     def contenttype(self):
         return "application/unknown"
 
@@ -129,33 +154,99 @@ class DavObject(object):
     def properties(self):
         return dict (self._properties)
 
-    def propfind(self, parser, depth=0):
+    @gen.coroutine
+    def propfind(self, parser, depth=0, childs=None, max_entries=None):
         """ Propfind Dav method
+            childs can be given when already listed,
+            the responses are generated while they are written.
+            With depth None the whole tree is walked, up to max_entries
+            responses when given.
         """
-        response = []
-        props    = self.get_properties()
-        prop_e   = props.propfind(parser.prop_list, parser.propname)           
-        href_e   = HrefElement(self.uri)
-        response.append ( ResponseElement(href_e, *prop_e) )       
+        if self.collection and depth==None:
+            raise gen.Return( ( 207, 
+                    self._walk_responses(parser, max_entries) ) )
+
         if self.collection and depth==1:
-            childs = self.childs()
-            for child in childs:
-                props    = child.get_properties()
-                prop_e   = props.propfind(parser.prop_list, parser.propname)
-                href_e   = HrefElement(child.uri)
-                response.append ( ResponseElement(href_e, *prop_e) )
-                
-        return ( 207, response )
+            if childs==None:
+                childs = self.childs()
+        else:
+            childs = []
+
+        # dead properties of the object and its childs in one query
+        adapters = yield DbAdapter.prefetch(self.application.db, 
+                        [self.uri] + [child.uri for child in childs])
+        raise gen.Return( ( 207, self._responses(parser, 
+                                        [self] + childs, adapters) ) )
+
+    def _responses(self, parser, objects, adapters):
+        for dav_object in objects:
+            props    = dav_object.get_properties(adapters[dav_object.uri])
+            prop_e   = props.propfind(parser.prop_list, parser.propname)
+            href_e   = HrefElement(dav_object.uri)
+            yield ResponseElement(href_e, *prop_e)
+
+    def _walk_responses(self, parser, max_entries):
+        """ responses of a depth infinity propfind, generates
+            futures of lists of responses a batch at a time.
+            The writer waits for each future before asking for the next
+        """
+        walk = {'objects': itertools.chain([self], self.walk()),
+                'count': 0, 
+                'done': False}
+        while not walk['done']:
+            yield self._walk_batch(parser, walk, max_entries)
+
+    @gen.coroutine
+    def _walk_batch(self, parser, walk, max_entries):
+        """ list the next objects of the walk on the application 
+            executor and select their dead properties in one query.
+            A walk cut at max_entries ends with a 507 response
+        """
+        size = WALK_BATCH
+        if max_entries!=None:
+            # one more than allowed tells whether the walk is cut
+            size = min(size, max_entries - walk['count'] + 1)
+        objects = yield self._submit(list, 
+                        itertools.islice(walk['objects'], size))
+        walk['done'] = len(objects) < size
+
+        truncated = max_entries!=None and \
+            walk['count'] + len(objects) > max_entries
+        if truncated:
+            objects = objects[:max_entries - walk['count']]
+            walk['done'] = True
+        walk['count'] += len(objects)
+
+        adapters = yield DbAdapter.prefetch(self.application.db, 
+                        [dav_object.uri for dav_object in objects])
+        responses = list(self._responses(parser, objects, adapters))
+        if truncated:
+            responses.append(get_response(self.uri, 507))
+        raise gen.Return(responses)
+
+    def _submit(self, method, *args):
+        """ run blocking file system work on the application executor,
+            inline when there is none
+        """
+        executor = self.application.executor
+        if executor!=None:
+            return executor.submit(method, *args)
+        future = Future()
+        future.set_result(method(*args))
+        return future
 
+    @gen.coroutine
     def proppatch(self, parser):       
         """ Proppatch Dav method
         """
-        props    = self.get_properties()
-        prop_e   = props.proppatch( parser.property_set, parser.property_remove)
+        props    = yield self.select_properties()
+        prop_e   = yield props.proppatch( parser.property_set, 
+                                          parser.property_remove)
         href_e   = HrefElement(self.uri)
         response = ResponseElement(href_e, *prop_e)
-        return ( 207, response  )
+        raise gen.Return( ( 207, response  ) )
               
+    @gen.coroutine
     def lock(self, parser, timeout=None, depth=None):
         """ Lock of a resource 
             If resource is a collection then the lock apply
@@ -164,13 +255,13 @@ class DavObject(object):
         """             
         exclusive = self.application.lockdb.exclusive_lock(self.uri)
         if exclusive!=[]:
-            return 423
+            raise gen.Return(423)
 
         # do not allow exlusive locks on resource with shared lock
         shared = self.application.lockdb.shared_lock(self.uri)
         if shared!=[]:
             if parser.lockscope == EXCLUSIVE:
-                return 423
+                raise gen.Return(423)
 
         if self.collection and depth==None:
             # do we have a lock on child object of infinite lock on parent?
@@ -183,9 +274,9 @@ class DavObject(object):
                 response = []
                 response.append (get_response(conflict[0].resource, 403))
                 response.append (get_response(self.uri, 424))
-                return (207, response)
+                raise gen.Return( (207, response) )
 
-        lockid = self.application.lockdb.add_lock(self.uri, 
+        lockid = yield self.application.lockdb.add_lock(self.uri, 
                             parser.lockscope, 
                             depth, 
                             timeout, 
@@ -194,17 +285,18 @@ class DavObject(object):
         lock = self.application.lockdb.getbyid(lockid)
         if lock==None: 
             # something very bad should not continue
-            return 500
+            raise gen.Return(500)
             
         discovery = LockDiscovery( lock.Activelock() )
-        return (200, (lock.token, discovery))
+        raise gen.Return( (200, (lock.token, discovery)) )
         
+    @gen.coroutine
     def unlock(self, lock_token):  
         """ Try to release the lock on a resource
         """
         lock = self.application.lockdb.getbytoken(lock_token)
         if lock != None:
-            self.application.lockdb.remove_lock( lock.id ) 
-        return 204            
+            yield self.application.lockdb.remove_lock( lock.id ) 
+        raise gen.Return(204)            
 
 
@@ -15,8 +15,10 @@
 
 import re
 import time
-import hashlib
+import heapq
+import uuid
 from lxml import etree
+from tornado import gen
 from davelement import *
 
 
@@ -87,44 +89,165 @@ class Lock(object):
         return DAVElement.activelock( *activelock )
 
 
+class LockNode(object):
+    """ Path segment node of the lock tree
+    """
+    def __init__(self, parent=None, name=None):
+        self.parent = parent
+        self.name = name
+        self.childs = {}
+        self.locks = []
+
+    def subtree_locks(self):
+        """ all locks below this node """
+        stack = self.childs.values()
+        while stack:
+            node = stack.pop()
+            for lock in node.locks:
+                yield lock
+            stack.extend(node.childs.values())
+
+
+def split_path(resource):
+    """ path segments of a resource, a collection with or 
+        without a trailing slash is the same node
+    """
+    return [name for name in resource.split('/') if name!='']
+
+
 class Lockdb(object):
+    """ Active locks indexed by resource path, lock token and id
+
+        Locks are kept in a tree of path segments so a lookup of the
+        locks on a resource, its parents or its childs only visits the
+        nodes along the path.
+
+        Locks with a timeout are kept in a heap by expiry time, lookups
+        drop the expired ones from memory and purge() deletes them
+        from the database in one statement.
+
+        Database changes run on the storage executor, the memory index 
+        is changed before waiting for them so lock conflicts are always
+        checked against the latest locks.
+    """
     
     def __init__(self, database=None):
         self._db = database
-        self._locks = []
+        self._reset()
         if self._db:
-            self.clean()
-            self.select_locks()
+            # startup, the io loop is not running yet
+            self._locks = [Lock(**row) for row in self._load()]
+
+    def _reset(self):
+        self._tree = LockNode()
+        self._byid = {}
+        self._bytoken = {}
+        # (expiry time, lock id), refreshed locks leave stale entries
+        self._expiry = []
+        # ids of expired locks still in the database
+        self._expired = []
+
+    def _get_locks(self):
+        return self._byid.values()
+
+    def _set_locks(self, locks):
+        self._reset()
+        for lock in locks:
+            self._index(lock)
+
+    _locks = property(_get_locks, _set_locks)
+
+    def _index(self, lock):
+        node = self._tree
+        for name in split_path(lock.resource):
+            child = node.childs.get(name)
+            if child==None:
+                child = node.childs[name] = LockNode(node, name)
+            node = child
+        node.locks.append(lock)
+        self._bytoken[lock.token] = lock
+        if lock.id!=None:
+            self._index_id(lock)
+
+    def _index_id(self, lock):
+        self._byid[lock.id] = lock
+        if lock.timeout!=None:
+            heapq.heappush(self._expiry, (lock.created + lock.timeout, lock.id))
+
+    def _unindex(self, lock):
+        self._byid.pop(lock.id, None)
+        if self._bytoken.get(lock.token) is lock:
+            del self._bytoken[lock.token]
+        node = self._node(lock.resource)
+        node.locks.remove(lock)
+        # prune the empty branch
+        while node.parent!=None and not node.locks and not node.childs:
+            del node.parent.childs[node.name]
+            node = node.parent
+
+    def _node(self, resource):
+        """ the tree node of resource or None """
+        node = self._tree
+        for name in split_path(resource):
+            node = node.childs.get(name)
+            if node==None:
+                return None
+        return node
+
+    def _expire(self):
+        """ drop locks expired by now from memory """
+        now = get_current_time()
+        while self._expiry and self._expiry[0][0] < now:
+            expires, lockid = heapq.heappop(self._expiry)
+            lock = self._byid.get(lockid)
+            if lock==None or lock.timeout==None or \
+                lock.created + lock.timeout != expires:
+                # removed or refreshed
+                continue
+            self._unindex(lock)
+            self._expired.append(lockid)
+
+    @gen.coroutine
+    def purge(self):
+        """ drop expired locks and delete them from the database 
+            in one statement, called periodically
+        """
+        self._expire()
+        if self._expired and self._db:
+            expired, self._expired = self._expired, []
+            yield self._db.submit(self._db.delete_locks, expired)
 
     def getbyid(self, lockid):
         """finds a lock by id"""
-        for lock in self._locks:
-            if lock.id==lockid:
-                return lock
-        return None
+        self._expire()
+        return self._byid.get(lockid)
        
     def getbytoken(self, token):
         """finds a lock by token"""
-        for lock in self._locks:
-            if lock.token==token:
-                return lock
-        return None
-
-    def clean(self):
-        self._db.execute("""\
-            DELETE FROM locks WHERE 
-            timeout IS NULL AND created + %s < UNIX_TIMESTAMP() OR 
-            timeout IS NOT NULL AND created + timeout < UNIX_TIMESTAMP();
-        """, MAX_TIMEOUT)  
+        self._expire()
+        return self._bytoken.get(token)
+
+    def _load(self):
+        """ delete expired locks and read the locks table """
+        now = get_current_time()
+        self._db.clean_locks(MAX_TIMEOUT, now)
+        return self._db.select_locks(now)
         
-    def select_locks(self):
-        self._locks = []
-        for row in self._db.iter("""\
-            SELECT id, resource, token, scope, depth, owner, created, timeout
-            FROM locks WHERE 
-            timeout IS NULL OR created + timeout > %s""", get_current_time() ):
-            self._locks.append(Lock(**row))
-
+    @gen.coroutine
+    def resync(self):
+        """ Drop expired locks and reload all locks from the database,
+            done when the locks table was changed by someone else.
+            The locks add_lock is inserting are kept as they are,
+            their rows may or may not be loaded yet
+        """
+        rows = yield self._db.submit(self._load)
+        locks = dict( (row['token'], Lock(**row)) for row in rows )
+        for lock in self._bytoken.values():
+            if lock.id==None:
+                locks[lock.token] = lock
+        self._locks = locks.values()
+
+    @gen.coroutine
     def add_lock(self, resource, scope=1, depth=0, timeout=None, owner=None):
         """ resource: The resource to be locked
             scope   : 1 = exclusive 0 = shared
@@ -132,82 +255,91 @@ class Lockdb(object):
             timeout : None = infinite
         """
         created = get_current_time()  
-        lock_token = hashlib.sha1(resource + str(created)).hexdigest()
-        rowid = self._db.execute("""\
-            insert into locks (resource, token, scope, depth, created, timeout, owner)  
-            values (%s, %s, %s, %s, %s, %s, %s)
-            """, resource, lock_token, scope, depth, created, timeout, owner)
+        # unique even for locks taken in the same second
+        lock_token = uuid.uuid4().hex
+        lock = Lock(id=None, 
+                resource=resource, 
+                token=lock_token, 
+                scope=scope, 
+                depth=depth, 
+                created=created, 
+                timeout=timeout, 
+                owner=owner)
+        # the lock holds the resource while the row is inserted
+        self._index(lock)
+        try:
+            rowid = yield self._db.submit(self._db.insert_lock, resource, 
+                        lock_token, scope, depth, created, timeout, owner)
+        except:
+            self._unindex(lock)
+            raise
 
         if rowid>0:
-            self.select_locks()
-        return rowid
+            lock.id = rowid
+            self._index_id(lock)
+        else:
+            self._unindex(lock)
+        raise gen.Return(rowid)
 
+    @gen.coroutine
     def refresh_lock(self, lockid, timeout):
         created = get_current_time()  
-        self._db.execute("update locks set created = %s, timeout = %s where id = %s",
-                         created, timeout, lockid)       
-        self.select_locks()
-
+        lock = self._byid.get(lockid)
+        if lock!=None:
+            lock.created = created
+            lock.timeout = timeout
+            if timeout!=None:
+                heapq.heappush(self._expiry, (created + timeout, lockid))
+        yield self._db.submit(self._db.update_lock, lockid, created, timeout)
+
+    @gen.coroutine
     def remove_lock(self, lockid):
-        self._db.execute("delete from locks where id = %s",
-                         lockid)       
-        self.select_locks()
+        lock = self._byid.get(lockid)
+        if lock!=None:
+            self._unindex(lock)
+        yield self._db.submit(self._db.delete_locks, [lockid])
 
     def all_locks(self, resource):     
-        """ retrun a list of all locks associated with resource"""
-        any_lock = [lock for lock in self._locks if \
-                not self.isexpired(lock) and \
-                self.islocked(resource, lock.resource, lock.depth)]
+        """ retrun a list of all locks associated with resource,
+            locks on the resource and infinite locks on its parents
+        """
+        self._expire()
+        any_lock = []
+        node = self._tree
+        names = split_path(resource)
+        for name in names:
+            any_lock.extend( lock for lock in node.locks if lock.depth==None )
+            node = node.childs.get(name)
+            if node==None:
+                break
+        else:
+            any_lock.extend( node.locks )
         return any_lock
 
     def exclusive_lock(self, resource):
         """ retrun a list of exclusive locks associated with resource"""   
-        exclusive_lock = [lock for lock in self._locks if \
-                not self.isexpired(lock) and lock.scope == EXCLUSIVE and \
-                self.islocked(resource, lock.resource, lock.depth)]
-        return exclusive_lock
+        return [lock for lock in self.all_locks(resource) 
+                if lock.scope == EXCLUSIVE]
 
     def shared_lock(self, resource):
         """ retrun a list of shared locks associated with resource"""   
-        shared_lock = [lock for lock in self._locks if \
-                not self.isexpired(lock) and lock.scope == SHARED and \
-                self.islocked(resource, lock.resource, lock.depth)]
-        return shared_lock
+        return [lock for lock in self.all_locks(resource) 
+                if lock.scope == SHARED]
 
     def conflict_lock(self, resource):
         """ retrun a list of exclusive locks on childs of resource
         """   
-        conflict_lock = [lock for lock in self._locks if \
-            lock.resource!=resource and \
-            not self.isexpired(lock) and \
-            lock.scope == EXCLUSIVE and \
-            self.islocked(lock.resource, resource, None)]
-        return conflict_lock
+        return [lock for lock in self.dependent_lock(resource) 
+                if lock.scope == EXCLUSIVE]
 
     def dependent_lock(self, resource):
         """ retrun a list of all locks on childs of resource
         """   
-        dependent_lock = [lock for lock in self._locks if \
-            lock.resource!=resource and \
-            not self.isexpired(lock) and \
-            self.islocked(lock.resource, resource, None)]
-        return dependent_lock
-
-    def isexpired(self, lock):
-        """ return True if lock is expired,
-            none is never expire
-        """ 
-        if lock.timeout == None:
-            return False
-        return lock.created + lock.timeout < get_current_time()
-
-    def islocked(self, resource, path, depth):
-        """return True if:
-            path is equal to resource if depth is 0
-            path is parent of resource and depth is infinity 
-        """
-        return ( (depth == 0 and path == resource) or \
-                 (depth == None and re.match(path, resource)!=None) )
+        self._expire()
+        node = self._node(resource)
+        if node==None:
+            return []
+        return list(node.subtree_locks())
 
       
 class LockParser:
@@ -19,10 +19,14 @@ import mimetypes
 import time
 import re
 import hashlib
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
 from httplib import responses as http_responses
 from lxml import etree
 from lxml.etree import _Element
 from functools import partial
+from tornado import gen
 
 from davelement import *
 from lock import Supportedlock, LockDiscovery, Lockdb
@@ -33,7 +37,7 @@ HTTP_OK = 200
     Handling of object Live and Dead properties, implementing
     propfind and proppatch, dead properties are handled by database
     class adapter allowing for other database to be easily pluged in.
-    The current implementation has a mysql adapter only.
+    The adapter works on the server storage, MySQL or sqlite.
 """
 
 qnamere = re.compile(r'^\{(.+)\}(.+)')
@@ -96,11 +100,40 @@ class PropPatchParser():
             else:
                 raise
                 
+
+# checks stored values, entities are not expanded
+_CHECK_PARSER = etree.XMLParser(resolve_entities=False)
+
+def well_formed(value):
+    """ the stored value is an element that can be written into a
+        response as it is. Values set by PROPPATCH are, the rows of
+        older versions or other writers are checked when the storage
+        is migrated or upgraded
+    """
+    if not value or value.lstrip().startswith('<?'):
+        return False
+    try:
+        root = etree.fromstring(value, _CHECK_PARSER)
+    except (etree.XMLSyntaxError, ValueError):
+        return False
+    return not root.getroottree().docinfo.doctype
+
+
+class _Live(object):
+    """ a live property value computed when first looked up """
+    __slots__ = ('compute',)
+
+    def __init__(self, compute):
+        self.compute = compute
+
      
 class Properties(dict):
     """ Properties request handler
         A dictionary like object that holds all object 
-        proerties.
+        proerties. Live and lock properties are evaluated when
+        a request asks for them, most ask for a few. Dead 
+        properties are kept serialized as they were stored and
+        go in responses as raw elements.
     """
     
     # dav default properties cannot be cahnged by client
@@ -133,11 +166,12 @@ class Properties(dict):
         self.adapter = adapter
         self.locks   = locks
         if self.adapter!=None:
-            self.update( self.adapter._values )       
+            for key, val in self.adapter._values.iteritems():
+                dict.__setitem__(self, key, _Live(partial(RawElement, val)))
 
-        self["{DAV:}supportedlock"]=Supportedlock()
+        self["{DAV:}supportedlock"]=_Live(Supportedlock)
         if self.locks!=None:
-            self["{DAV:}lockdiscovery"]=self.lockdiscovery()
+            self["{DAV:}lockdiscovery"]=_Live(self.lockdiscovery)
             
         self.update(self._object.properties())
             
@@ -148,28 +182,37 @@ class Properties(dict):
         return LockDiscovery(*(active_list))
 
     def __getitem__(self, key):
-        return dict.__getitem__(self, key)
+        val = dict.__getitem__(self, key)
+        if isinstance(val, _Live):
+            val = val.compute()
+            dict.__setitem__(self, key, val)
+        return val
 
     def __setitem__(self, key, val):
-        if val == None or isinstance (val, _Element):
+        if val == None or isinstance (val, (_Element, _Live)):
             # if this is an element just append to dict
             dict.__setitem__(self, key, val)       
         elif hasattr(self._object, val):
-            # if this is an object do method
-            method = getattr(self._object, val)
-            dict.__setitem__(self, key, method())       
-        elif self.adapter and isinstance(val, str): 
-            # if it is a string update value in database 
-            if self.adapter.update_property (key, val):
-                value = etree.fromstring(val)
-                dict.__setitem__(self, key, value)         
-            
-    def __delitem__(self, key):
-        if self.adapter != None:
-            if self.adapter.delete_property(key):
+            # if this is an object do method when asked for
+            dict.__setitem__(self, key, _Live(getattr(self._object, val)))
+
+    @gen.coroutine
+    def patch(self, set_list, remove_list):
+        """ set and remove dead properties in database 
+            in one transaction
+        """
+        # the request parsed the values, serialized they are valid
+        # fragments declaring the namespaces they use
+        values = [(p.tag, etree.tostring(p, with_tail=False)) 
+                  for p in set_list]
+        names = [p.tag for p in remove_list]
+        if self.adapter!=None:
+            yield self.adapter.patch(values, names)
+        for key, val in values:
+            dict.__setitem__(self, key, _Live(partial(RawElement, val)))
+        for key in names:
+            if key in self:
                 dict.__delitem__(self, key) 
-        else:
-            dict.__delitem__(self, key) 
         
     def _allprop(self):
         props = []
@@ -192,9 +235,9 @@ class Properties(dict):
             return [(HTTP_OK , self._allprop())]
 
         propnotfound = [DavElementFactory(name) 
-                        for name in prop_list if not name in self.keys()]         
+                        for name in prop_list if not name in self]         
         propfound = []      
-        found = [name for name in prop_list if name in self.keys()]
+        found = [name for name in prop_list if name in self]
         for name in found:
             value = self.get(name, None)
             if value!=None:
@@ -204,6 +247,7 @@ class Properties(dict):
             
         return [(HTTP_OK,  propfound), (404, propnotfound)]
                 
+    @gen.coroutine
     def _prop_patch(self, prop_set=None, prop_remove=None):
         set_status = HTTP_OK
         set_list = []                  
@@ -237,18 +281,18 @@ class Properties(dict):
                 remove_status = 424
         else:
             #Ok, update properties
-            for pset in set_list:
-                self[pset.tag]=etree.tostring(pset)
-            for prem in remove_list:
-                del self[prem.tag]
+            yield self.patch(set_list, remove_list)
 
-        return [(set_status, set_list), (remove_status,  remove_list)]
+        raise gen.Return(
+            [(set_status, set_list), (remove_status,  remove_list)])
 
     def __repr__(self):
         return dict.__repr__(self)
 
     def get(self, name, default=None):
-        return dict.get(self, name, default)
+        if name in self:
+            return self[name]
+        return default
 
     def update(self, *args, **kwargs):
         for k, v in dict(*args, **kwargs).iteritems():
@@ -261,9 +305,10 @@ class Properties(dict):
             response = self._prop_find(proplist)
         return self.propstat( response )       
 
+    @gen.coroutine
     def proppatch(self, prop_set=None, prop_remove=None):
-        response = self._prop_patch( prop_set, prop_remove )
-        return self.propstat( response )
+        response = yield self._prop_patch( prop_set, prop_remove )
+        raise gen.Return(self.propstat( response ))
 
     def propstat(self, response):
         prop_stat = []
@@ -282,146 +327,338 @@ class Property():
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
+class PropertyCache(object):
+    """ LRU of the stored dead properties of uris within a budget of
+        bytes of stored names and values, uris without properties
+        are kept too.
+        
+        The adapters drop the uris they change. A value selected 
+        before a change is not kept, so the cache holds what the 
+        database has as long as this process is its only writer.
+    """
+
+    # bytes counted for each uri besides its properties
+    ENTRY_SIZE = 128
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        """ to be taken before selecting the properties to keep """
+        return self._generation
+
+    def get(self, uri):
+        """ (properties, values) of uri or None """
+        with self._lock:
+            entry = self._entries.pop(uri, None)
+            if entry==None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries[uri] = entry
+            return entry[1:]
+
+    def put(self, uri, properties, values, generation):
+        size = self.ENTRY_SIZE + len(uri) + sum(len(name) + 
+                        len(p.property_value or '') 
+                        for name, p in properties.iteritems())
+        with self._lock:
+            if generation!=self._generation or size > self.budget:
+                return
+            self._drop(uri)
+            self._entries[uri] = (size, properties, values)
+            self._size += size
+            while self._size > self.budget:
+                key, entry = self._entries.popitem(last=False)
+                self._size -= entry[0]
+
+    def invalidate(self, uri, subtree=False):
+        """ forget uri, and the uris below it when subtree """
+        with self._lock:
+            self._generation += 1
+            self._drop(uri)
+            if subtree:
+                prefix = uri.rstrip('/') + '/'
+                for key in [key for key in self._entries 
+                            if key.startswith(prefix)]:
+                    self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            return {'budget': self.budget,
+                    'size': self._size,
+                    'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def _drop(self, uri):
+        entry = self._entries.pop(uri, None)
+        if entry!=None:
+            self._size -= entry[0]
+
+
+class UriSet(object):
+    """ The uris that have dead properties as a sorted list, 
+        a subtree of uris is a range of the list.
+
+        The adapters add the uris they may give properties to before
+        writing and remove the uris left without properties after, 
+        so a uri missing from the set has no properties as long as
+        this process is the only writer of the database. 
+        Used on the io loop.
+
+        Membership is a set lookup. Adding a new uri shifts the end of
+        the list, a memmove of 8 bytes per uri, about a millisecond for
+        a million uris with properties.
+    """
+
+    def __init__(self, uris=()):
+        self._set = set(uris)
+        self._uris = sorted(self._set)
+
+    def __len__(self):
+        return len(self._uris)
+
+    def __contains__(self, uri):
+        return uri in self._set
+
+    def add(self, uri):
+        if uri not in self._set:
+            self._set.add(uri)
+            insort(self._uris, uri)
+
+    def discard(self, uri, subtree=False):
+        """ remove uri, and all uris below it when subtree """
+        if subtree:
+            lo, hi = self._range(uri)
+            self._set.difference_update(self._uris[lo:hi])
+            del self._uris[lo:hi]
+        if uri in self._set:
+            self._set.discard(uri)
+            del self._uris[bisect_left(self._uris, uri)]
+
+    def select(self, uri, subtree=False):
+        """ uri if in the set, and the uris below it when subtree """
+        found = []
+        if uri in self:
+            found.append(uri)
+        if subtree:
+            lo, hi = self._range(uri)
+            found.extend(u for u in self._uris[lo:hi] if u!=uri)
+        return found
+
+    def copy(self, from_uri, to_uri, subtree=False):
+        """ add the uris a copy of from_uri to to_uri gives 
+            properties to, as the storage names them
+        """
+        if subtree:
+            from_base, to_base = from_uri.rstrip('/'), to_uri.rstrip('/')
+        else:
+            from_base, to_base = from_uri, to_uri
+        for uri in self.select(from_uri, subtree):
+            self.add(to_base + uri[len(from_base):])
+
+    def _range(self, uri):
+        """ slice of the uris below uri, see SqlStorage._subtree """
+        prefix = uri.rstrip('/') + '/'
+        return (bisect_left(self._uris, prefix), 
+                bisect_left(self._uris, prefix[:-1] + '0'))
+
+
 class DbAdapter():
     """ Database object user properties storage
         Manage all external object properties, and 
         MOVE COPY DELETE of object properties 
+
+        Database access runs on the storage executor, the methods
+        are coroutines. Selected properties are kept in the property
+        cache of the database when it has one, the uris missing from 
+        its property uri set are not selected. Values are the stored
+        xml fragments, checked when they were set.
     """
     
     def __init__(self, database):
         self._db = database
+        self._cache = database.property_cache
+        self._uris = database.property_uris
         self._uri = None
         self._properties = None
         self._values = None
 
+    @classmethod
+    @gen.coroutine
+    def prefetch(cls, database, uris):
+        """ retrieves the properties of all uris in one query,
+            returns a dictionary of uri to a selected adapter
+        """
+        adapters = {}
+        rows = {}
+        for uri in uris:
+            adapter = cls(database)
+            adapters[uri] = adapter
+            if adapter._absent(uri):
+                adapter._load(uri, [])
+            elif not adapter._cached(uri):
+                rows[uri] = []
+
+        if rows:
+            generation = None
+            if database.property_cache!=None:
+                generation = database.property_cache.generation()
+            selected = yield database.submit(database.select_properties, 
+                                             rows.keys())
+            for row in selected:
+                if row['uri'] in rows:
+                    rows[row['uri']].append(row)
+            for uri, uri_rows in rows.iteritems():
+                adapters[uri]._load(uri, uri_rows)
+                adapters[uri]._keep(generation)
+        raise gen.Return(adapters)
+
+    @gen.coroutine
     def select(self, uri):
         """retrieves object properties for uri"""
+        if self._absent(uri):
+            self._load(uri, [])
+            return
+        if self._cached(uri):
+            return
+        generation = None
+        if self._cache!=None:
+            generation = self._cache.generation()
+        rows = yield self._db.submit(self._db.select_properties, [uri])
+        self._load(uri, rows)
+        self._keep(generation)
+
+    def _absent(self, uri):
+        """ uri is known to have no properties """
+        return self._uris!=None and uri not in self._uris
+
+    def _cached(self, uri):
+        """ use the cached properties of uri when there are """
+        if self._cache==None:
+            return False
+        cached = self._cache.get(uri)
+        if cached==None:
+            return False
+        self._uri = uri
+        self._properties, self._values = cached
+        return True
+
+    def _keep(self, generation):
+        """ put the loaded properties in the cache """
+        if self._cache!=None:
+            self._cache.put(self._uri, self._properties, self._values,
+                            generation)
+
+    def _invalidate(self, uri, subtree=False):
+        if self._cache!=None:
+            self._cache.invalidate(uri, subtree)
+
+    def _load(self, uri, rows):
         self._uri = uri
 
         values = []
         rowlist = []
-        for row in self._db.iter(
-            """\
-            select id, uri, property_name, property_value from property 
-            where uri = %s
-            """, self._uri):
+        for row in rows:
             p = Property(**row)
-            try:
-                value = etree.fromstring( p.property_value )
-                values.append( (p.property_name, value) ) 
+            if p.property_value:
+                values.append( (p.property_name, p.property_value) ) 
                 rowlist.append( (p.property_name, p) )                
-            except:
-                pass
                 
         self._properties = dict( rowlist ) 
         self._values = dict( values )
                 
-    def update_property(self, key, val):
-        if self._properties and key in self._properties:
-            return self.update_row(key, val)
-        else:
-            return self.insert_row(key, val)
-
-    def delete_property(self, key):
-        if self._properties and key in self._properties:
-            return self.delete_row(key)
-        return 0
-        
-    def delete_row (self, key):
-        p = self._properties[key]
-        success = self._dbupdate("""\
-            delete from property 
-            where id = %s
-            """, 
-            p.id)
-        if success:
-            del self._properties[key]    
-        return success                  
-                    
-    def update_row (self, key, val):
-        p = self._properties[key]
-        success = self._dbupdate("""\
-            update property 
-            set property_value = %s 
-            where id = %s
-            """, 
-            val, p.id)
-        if success>0:
-            p.property_value = val
-        return success
-            
-    def insert_row (self, key, val):
-        rowid = self._db.execute("""\
-            insert into property (uri, property_name, property_value)  
-            values (%s, %s, %s)
-            """, 
-            self._uri, key, val)
-        if rowid>0:
-            self.select_row( rowid )
-        return rowid
-            
-    def select_row(self, rowid):
-        row = self._db.get ("""\
-            select id, uri, property_name, property_value
-            from property
-            where id = %s
-            """, rowid)
-        p = Property(**row)
-        self._properties[p.property_name] = p
-        
-    def _dbupdate(self, query, *parameters):
-        """Update query, returning the rows effected. 
-           Should be a library function
+    @gen.coroutine
+    def patch(self, values, names):
+        """ set (name, value) properties and delete the named 
+            properties in one transaction
         """
-        cursor = self._db._cursor()
+        if self._uris!=None and values:
+            self._uris.add(self._uri)
         try:
-            self._db._execute(cursor, query, parameters)
-            return cursor.rowcount
+            rows = yield self._db.submit(self._db.patch_properties, 
+                                         self._uri, values, names)
         finally:
-            cursor.close()
-
+            self._invalidate(self._uri)
+        if self._uris!=None and not rows:
+            self._uris.discard(self._uri)
+        self._load(self._uri, rows)
+            
+    @gen.coroutine
     def copy_properties (self, from_uri, to_uri, like=''):
         """ delete old properties from destination 
             then copy all properties from source
         """
-        select_insert = """INSERT INTO property 
-            (uri, property_name, property_value) 
-            SELECT REPLACE (property.uri, %s, %s), 
-                property.property_name, 
-                property.property_value 
-            FROM property WHERE property.uri LIKE %s
-            """ 
-        self.delete_properties(to_uri, like)
-        success = self._dbupdate(select_insert, from_uri, to_uri, from_uri+like)
-        return success        
+        subtree = like=='%'
+        if self._uris!=None:
+            self._uris.copy(from_uri, to_uri, subtree)
+        try:
+            yield self._db.submit(self._db.copy_properties, 
+                                  from_uri, to_uri, subtree)
+        finally:
+            self._invalidate(to_uri, subtree)
+        if self._uris!=None:
+            self._uris.discard(to_uri, subtree)
+            self._uris.copy(from_uri, to_uri, subtree)
 
+    @gen.coroutine
     def move_properties (self, from_uri, to_uri, like=''):
-        """ move properties to new uri """
-        select = """UPDATE property 
-            SET uri = REPLACE(uri, %s, %s) 
-            WHERE uri LIKE %s
-            """ 
-        success = self._dbupdate(select, from_uri, to_uri, from_uri+like)
-        return success        
-
+        """ move properties to new uri, replacing the 
+            properties of the destination
+        """
+        subtree = like=='%'
+        if self._uris!=None:
+            self._uris.copy(from_uri, to_uri, subtree)
+        try:
+            yield self._db.submit(self._db.move_properties, 
+                                  from_uri, to_uri, subtree)
+        finally:
+            self._invalidate(from_uri, subtree)
+            self._invalidate(to_uri, subtree)
+        if self._uris!=None:
+            moved = self._uris.select(from_uri, subtree)
+            self._uris.discard(to_uri, subtree)
+            self._uris.copy(from_uri, to_uri, subtree)
+            for uri in moved:
+                self._uris.discard(uri)
+
+    @gen.coroutine
     def delete_properties (self, uri, like=''):
         """ delete properties of uri"""
-        select = """DELETE FROM property 
-            WHERE uri LIKE %s
-            """ 
-        success = self._dbupdate(select, uri+like)
-        return success        
+        subtree = like=='%'
+        try:
+            yield self._db.submit(self._db.delete_properties, 
+                                  uri, subtree)
+        finally:
+            self._invalidate(uri, subtree)
+        if self._uris!=None:
+            self._uris.discard(uri, subtree)
+
+    @gen.coroutine
+    def trash_collection (self, uri, trash_uri):
+        """ move the properties of a deleted collection below 
+            trash_uri, where the trash reaper deletes them
+        """
+        try:
+            yield self._db.submit(self._db.move_properties, 
+                                  uri, trash_uri, True)
+        finally:
+            self._invalidate(uri, True)
+        if self._uris!=None:
+            self._uris.discard(uri, True)
 
     def copy_collection (self, from_uri, to_uri, like=''):
-        self.copy_properties( from_uri, to_uri, like='%' )
+        return self.copy_properties( from_uri, to_uri, like='%' )
     
     def move_collection (self, from_uri, to_uri, like=''):
-        self.move_properties( from_uri, to_uri, like='%' )
+        return self.move_properties( from_uri, to_uri, like='%' )
     
     def delete_collection (self, from_uri, like=''):
-        self.delete_properties( from_uri, like='%' )
-
-
-                                   
-
-
+        return self.delete_properties( from_uri, like='%' )
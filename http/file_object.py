@@ -14,40 +14,159 @@
 # under the License.
 
 import os
+import errno
 import hashlib
 import shutil
 import urllib
 import calendar
 import time
 import mimetypes
+import tempfile
+import functools
+from stat import S_ISDIR
 from datetime import datetime
 from email.utils import formatdate
 
 from dav.davobject import DavObject
+from dav.davelement import get_response
+from fswalk import scandir, entry_stat, listdir
+from copyengine import copy_file, copy_tree
+
+# server files inside the data directory, not listed as childs
+# and not reachable by url
+HIDDEN_PREFIX = '.dav-'
+UPLOAD_PREFIX = HIDDEN_PREFIX + 'upload-'
+MOVED_PREFIX = HIDDEN_PREFIX + 'moved-'
+
+# new files get the default mode of open() 
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def is_hidden(path):
+    """ a name of the url path is one of the server files """
+    return any(name.startswith(HIDDEN_PREFIX)
+               for name in urllib.unquote(path).split('/'))
+
+
+def invalidates(destination=False):
+    """ the decorated method changes the object file, and the
+        destination given as first argument when destination is True.
+        Their cached metadata and content are dropped when it returns
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                for cache in (self._cache, self._content):
+                    if cache!=None:
+                        cache.invalidate(self.filename, self.collection)
+                        if destination:
+                            cache.invalidate(args[0], True)
+        return wrapper
+    return decorator
+
+
+def error_status(why):
+    """ http status of a failed file system call """
+    if why.errno in (errno.ENOSPC, errno.EDQUOT):
+        return 507
+    if why.errno in (errno.EACCES, errno.EPERM):
+        return 403
+    return 500
+
+
+class FileUpload(object):
+    """ New content of a file written into a temporary file in the
+        same directory, commit() renames it into place atomically
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        fd, self.tempname = tempfile.mkstemp(prefix=UPLOAD_PREFIX, 
+                dir=os.path.dirname(filename))
+        self._file = os.fdopen(fd, "wb")
+        self.size = 0
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        self._file.close()
+        try:
+            mode = os.stat(self.filename).st_mode & 07777
+        except os.error:
+            mode = 0666 & ~_umask
+        os.chmod(self.tempname, mode)
+        os.rename(self.tempname, self.filename)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.unlink(self.tempname)
+        except os.error:
+            pass
+
 
 class FileObject(DavObject):
     """ Dav file object method implementation
     """
 
-    def __init__(self, appliction, parent='', name=''):
+    # trash name of a deleted collection
+    trashed = None
+    # trash name of the destination a move replaced
+    replaced = None
+
+    def __init__(self, appliction, parent='', name='', stat=None):
+        """ stat is the os.stat result of the file when already known,
+            otherwise the file is stated once here or found in the 
+            metadata cache of the application
+        """
         DavObject.__init__(self, appliction, parent, name)
         self.filename = os.path.abspath(
             os.path.join(self.root, self.parent, self.name))
         self.uri = urllib.pathname2url ('/' + os.path.join(self.parent, self.name))
-        self.exists = os.path.exists(self.filename) 
+        self._cache = getattr(appliction, 'metadata', None)
+        self._content = getattr(appliction, 'content_cache', None)
+        if stat==None:
+            if self._cache!=None:
+                stat = self._cache.stat(self.filename)
+            else:
+                try:
+                    stat = os.stat(self.filename)
+                except os.error:
+                    pass
+        self._etag = None
 
+        self.exists = stat!=None
         if self.exists:
-            stat = os.stat(self.filename) 
-            self.collection = os.path.isdir(self.filename)
+            self.collection = S_ISDIR(stat.st_mode)
             self.st_mtime = stat.st_mtime
             self.st_ctime = stat.st_ctime
             self.st_size  = stat.st_size
-            self.etag = '"%s"' % hashlib.sha1(
-                    self.filename + self.lastmodified()).hexdigest() 
+            self.st_ino   = stat.st_ino
+
+    @property
+    def etag(self):
+        """ entity tag, computed when first used """
+        if self._etag==None:
+            if self.exists and self._cache!=None:
+                self._etag = self._cache.etag(self.filename, self.st_mtime, 
+                                              self._make_etag)
+            else:
+                self._etag = self._make_etag()
+        return self._etag
+
+    def _make_etag(self):
+        if self.exists:
+            l = self.lastmodified()
         else:
             t = calendar.timegm(time.gmtime())
             l = formatdate(t, localtime=True, usegmt=True)
-            self.etag = '"%s"' % hashlib.sha1(self.filename + l).hexdigest() 
+        return '"%s"' % hashlib.sha1(self.filename + l).hexdigest() 
 
     @staticmethod
     def fromuri_factory(application, uri):
@@ -63,6 +182,11 @@ class FileObject(DavObject):
           
     def contenttype(self):
         """ guess content type """
+        if self._cache!=None:
+            return self._cache.contenttype(self.filename, self._guess_type)
+        return self._guess_type()
+
+    def _guess_type(self):
         mtype =  "application/unknown"
         guess = mimetypes.guess_type(self.filename)
         if guess[0]!=None:
@@ -81,19 +205,56 @@ class FileObject(DavObject):
         """
         childs = []
         if self.collection:               
-            for name in os.listdir(self.filename):
-                filename = os.path.join(self.root, self.parent , name)
-                path = os.path.abspath(filename)
-                if os.path.isdir(path):
-                    obj = FileObject(self.application, 
-                        parent = os.path.join(self.parent, name))
-                else:
-                    obj = FileObject(self.application, 
-                        parent = self.parent, 
-                        name = name)
-                childs.append( obj )
+            if self._cache!=None:
+                entries = self._cache.listdir(self.filename)
+            else:
+                entries = listdir(self.filename)
+            for name, stat in entries:
+                if name.startswith(HIDDEN_PREFIX):
+                    continue
+                childs.append( self._child(self.parent, name, stat) )
         return childs
 
+    def _child(self, parent, name, stat):
+        """ object of an entry of the collection parent,
+            built with the stat of its directory listing
+        """
+        if stat==None:
+            return FileObject(self.application, 
+                parent = parent, 
+                name = name)
+        if S_ISDIR(stat.st_mode):
+            return FileObject(self.application, 
+                parent = os.path.join(parent, name), 
+                stat = stat)
+        return FileObject(self.application, 
+            parent = parent, 
+            name = name, 
+            stat = stat)
+
+    def walk(self):
+        """ generate the objects below this collection, depth first.
+            Directories are read with scandir as they are reached and
+            symbolic links to directories are not followed
+        """
+        stack = [self.parent]
+        while stack:
+            parent = stack.pop()
+            try:
+                entries = scandir(os.path.join(self.root, parent))
+            except os.error:
+                continue
+            collections = []
+            for entry in entries:
+                if entry.name.startswith(HIDDEN_PREFIX):
+                    continue
+                child = self._child(parent, entry.name, entry_stat(entry))
+                if child.collection and not entry.is_symlink():
+                    collections.append(child.parent)
+                yield child
+            stack.extend(reversed(collections))
+
+    @invalidates()
     def mkcol(self):
         """ Dav mkcol method
         """
@@ -108,8 +269,13 @@ class FileObject(DavObject):
             return 500  
         return 201
 
-    def copy(self, destination, overwrite=None):
+    @invalidates(destination=True)
+    def copy(self, destination, overwrite=None, progress=None):
         """ Dav file copy method
+            The files of a collection are copied on the copy executor 
+            of the application, members that fail are reported in a 
+            207 response. progress.add(files, bytes) is called as 
+            files are copied
         """
         rc = 201           
         if self.collection:        
@@ -126,19 +292,13 @@ class FileObject(DavObject):
             except (IOError, os.error), why:
                 return 500
 
-            names = os.listdir(self.filename)
-            for name in names:
-                srcname = os.path.join(self.filename, name)
-                dstname = os.path.join(destination, name)
-                try:
-                    if os.path.islink(srcname):
-                        pass
-                    elif os.path.isdir(srcname):
-                        shutil.copytree(srcname, dstname)
-                    else:
-                        shutil.copy2(srcname, dstname)
-                except (IOError, os.error), why:
-                    return 500        
+            failures = copy_tree(self.filename, destination, 
+                    getattr(self.application, 'copy_executor', None), 
+                    HIDDEN_PREFIX, progress)
+            if failures:
+                return (207, [get_response(self._uri_of(path, collection), 
+                                           error_status(why)) 
+                              for path, collection, why in failures])
         else:
             if os.path.exists( destination ):
                 if os.path.isfile( destination ):
@@ -151,20 +311,98 @@ class FileObject(DavObject):
                 return 409
 
             try:
-                shutil.copy2(self.filename, destination)
+                size = copy_file(self.filename, destination)
             except (IOError, os.error), why:
-                return 500
+                return error_status(why)
+            if progress!=None:
+                progress.add(1, size)
 
         return rc
+
+    def _uri_of(self, path, collection=False):
+        """ uri of a file below the root """
+        uri = urllib.pathname2url('/' + os.path.relpath(path, self.root))
+        if collection:
+            uri += '/'
+        return uri
         
+    @invalidates(destination=True)
     def move(self, destination, overwrite=None):
         """ Dav file move method
+            On the same device the file or tree is renamed in one 
+            step, otherwise it is copied and removed
         """
         rc = 201           
         if self.collection:        
             if os.path.exists(destination):
                 if overwrite!='T':
                     return 412
+        else:
+            if os.path.lexists( destination ):
+                # whatever it is, a directory is replaced too
+                if overwrite!='T':
+                    return 412
+                rc = 204
+
+            p, n = os.path.split(destination)
+            if not os.path.isdir(p):
+                return 409
+
+        if self._same_device(destination):
+            try:
+                self._rename(destination)
+                return rc
+            except (IOError, os.error), why:
+                # a bind mount of the same file system
+                if why.errno!=errno.EXDEV:
+                    return 500
+        return self._move_across(destination, rc)
+
+    def _same_device(self, destination):
+        """ destination directory is on the device of the file """
+        try:
+            return os.stat(os.path.dirname(destination)).st_dev == \
+                os.lstat(self.filename).st_dev
+        except os.error:
+            return False
+
+    def _rename(self, destination):
+        """ rename the file to destination. An existing destination 
+            a file cannot replace is renamed aside first and put in the
+            trash after, it is put back when the rename fails
+        """
+        aside = None
+        if os.path.isdir(destination) or \
+            self.collection and os.path.lexists(destination):
+            aside = tempfile.mkdtemp(prefix=MOVED_PREFIX, 
+                                     dir=os.path.dirname(destination))
+            try:
+                os.rename(destination, os.path.join(aside, 'old'))
+            except os.error:
+                os.rmdir(aside)
+                raise
+        try:
+            os.rename(self.filename, destination)
+        except os.error:
+            if aside!=None:
+                os.rename(os.path.join(aside, 'old'), destination)
+                os.rmdir(aside)
+            raise
+        if aside!=None:
+            trash = getattr(self.application, 'trash', None)
+            if trash!=None:
+                try:
+                    self.replaced = trash.put(aside)
+                    return
+                except (IOError, os.error), why:
+                    # on another device, removed in place
+                    pass
+            shutil.rmtree(aside, ignore_errors=True)
+
+    def _move_across(self, destination, rc):
+        """ move by copying, for a destination on another device """
+        if self.collection:        
+            if os.path.exists(destination):
                 if os.path.isdir( destination ):
                     try:
                         shutil.rmtree( destination )
@@ -196,16 +434,6 @@ class FileObject(DavObject):
                 return 500
 
         else:
-            if os.path.exists( destination ):
-                if os.path.isfile(destination):
-                    if overwrite!='T':
-                        return 412
-                rc = 204
-
-            p, n = os.path.split(destination)
-            if not os.path.isdir(p):
-                return 409
-
             try:
                 shutil.move(self.filename, destination)
             except (IOError, os.error), why:
@@ -213,10 +441,21 @@ class FileObject(DavObject):
 
         return rc
 
+    @invalidates()
     def delete(self):
         """ Dav file delete method
+            A collection is renamed into the trash of the application
+            when it has one, the trash reaper removes it later
         """
         if self.collection: 
+            trash = getattr(self.application, 'trash', None)
+            if trash!=None:
+                try:
+                    self.trashed = trash.put(self.filename)
+                    return 204
+                except (IOError, os.error), why:
+                    # on another device, removed in place
+                    pass
             try:    
                 shutil.rmtree(self.filename)
             except (IOError, os.error), why:
@@ -228,6 +467,27 @@ class FileObject(DavObject):
                 return 500
         return 204
 
+    def upload(self):
+        """ Start writing new content to the file, return a
+            FileUpload or None if the parent directory is missing
+        """
+        try:
+            return FileUpload(self.filename)
+        except (IOError, os.error), why:
+            return None
+
+    @invalidates()
+    def commit(self, upload):
+        """ Replace the file content with a completed upload
+        """
+        try:
+            upload.commit()
+        except (IOError, os.error), why:
+            upload.discard()
+            return 500
+        return 201
+
+    @invalidates()
     def write(self, body=''):        
         """ Dav write to file method
         """
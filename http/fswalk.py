@@ -0,0 +1,89 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import stat
+
+
+""" Directory listing
+
+    scandir() returns the entries of a directory with their type as
+    read by the directory listing, so telling files from directories
+    does not cost a stat per entry. It is os.scandir, the scandir
+    package on older pythons, or a listdir based fallback with the
+    same interface. listdir() returns the names of a directory with
+    their stat results.
+"""
+
+
+class _DirEntry(object):
+    """ os.DirEntry of the listdir fallback, stats on demand """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self._lstat==None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+        if self._stat==None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def _mode(self, follow_symlinks):
+        try:
+            return self.stat(follow_symlinks).st_mode
+        except os.error:
+            return 0
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self._mode(follow_symlinks))
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self._mode(follow_symlinks))
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._mode(False))
+
+
+def _scandir(directory):
+    for name in os.listdir(directory):
+        yield _DirEntry(directory, name)
+
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = _scandir
+
+
+def entry_stat(entry):
+    """ stat of a directory entry, None when it cannot be stated """
+    try:
+        return entry.stat()
+    except os.error:
+        return None
+
+
+def listdir(directory):
+    """ (name, stat or None) of each entry of directory """
+    return [(entry.name, entry_stat(entry)) for entry in scandir(directory)]
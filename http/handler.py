@@ -13,23 +13,33 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from tornado import web
+from tornado import web, gen
+from tornado.iostream import StreamClosedError
 import os
 import re
+import sys
+import errno
 import functools
 import hashlib
 import shutil
 import mimetypes
+import json
 from datetime import datetime
 from urlparse import urlsplit
 from lxml import etree
 import urllib
 
 from ifheader import if_header_evaluate
+from rangeheader import parse_range_header, if_range_match
 from index import collection_index
 from dav.davelement import *
 from dav.properties import DbAdapter, PropFindParser, PropPatchParser
 from dav.lock import Lockdb, LockDiscovery, LockParser, parse_timeout
+from stream import FileSender, multipart
+from multistatus import MultistatusWriter
+from jobs import Job, JOB_URI
+from file_object import is_hidden
+from contentcache import validator
 
 
 """RFC4918 implemeantation  
@@ -39,6 +49,8 @@ from dav.lock import Lockdb, LockDiscovery, LockParser, parse_timeout
 
 DAV_VERSION = "1,2"
 INTERNAL_SERVER_ERROR = 500
+# default of the largest upload, a max_upload of 0 accepts any size
+MAX_UPLOAD = 1024*1024*1024
 
 Unauthorized = """\
 <html><head><title>401: Unauthorized</title></head><body>
@@ -61,32 +73,122 @@ Server Error %s
 </body></html>"""
 
 
+def authorize(handler):
+    """ True when the user of the request is logged in, otherwise the
+        401 or 403 response is sent and False returned
+    """
+    if  handler.application.auth!=None and not handler.current_user:
+        authorization = handler.request.headers.get("authorization")
+        if not authorization:
+            """send 401 error with WWW-Authenticate header"""
+            handler.set_header('WWW-Authenticate', handler.application.auth.get_header())
+            handler.set_status(401)
+            handler.write(Unauthorized)
+            handler.finish()
+            return False
+        else:
+            auth_type, auth_param =  authorization.split (' ', 1)                      
+            if not handler.application.auth.authenticate( handler.request, auth_param ):
+                """send 403 error"""
+                handler.set_status(403)
+                handler.write(Forbidden)
+                handler.finish()
+                return False
+        handler._current_user =  handler.application.auth.username    
+    return True
+
+
 def authenticated(method):
     """Decorate methods with this to require that the user be logged in."""
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        if  self.application.auth!=None and not self.current_user:
-            authorization = self.request.headers.get("authorization")
-            if not authorization:
-                    """send 401 error with WWW-Authenticate header"""
-                    self.set_header('WWW-Authenticate', self.application.auth.get_header())
-                    self.set_status(401)
-                    self.write(Unauthorized)
-                    self.finish()
-                    return
-            else:
-                auth_type, auth_param =  authorization.split (' ', 1)                      
-                if not self.application.auth.authenticate( self.request, auth_param ):
-                    """send 403 error"""
-                    self.set_status(403)
-                    self.write(Forbidden)
-                    self.finish()
-                    return
-            self._current_user =  self.application.auth.username    
+        if not authorize(self):
+            return
         return method(self, *args, **kwargs)
     return wrapper
 
 
+def if_header_match(ifh_result, locks):
+    """ the first of locks with a token in the If header result """
+    if ifh_result=={} or ifh_result==None:
+        return None  
+    for lock in locks:
+        for uri in ifh_result.keys():
+            # result can be parent of resource 
+            # of unmmaped If list 
+            if uri.startswith(lock.resource) and \
+                lock.token in ifh_result[ uri ]:
+                return lock   
+    return None
+
+
+def is_locked(lockdb, uri, ifh_result):
+    """ uri or one of its members has a lock the If header result has
+        no token of
+    """
+    for locks in (lockdb.all_locks(uri), lockdb.dependent_lock(uri)):
+        if locks and not if_header_match(ifh_result, locks):
+            return True
+    return False
+
+
+@gen.coroutine
+def transfer(application, dav_object, destination, overwrite, from_uri,
+             to_uri, move, job=None):
+    """ copy or move dav_object to the file destination and its
+        properties from from_uri to to_uri. Returns the status or
+        (207, responses). The file system work of a job runs on the
+        job executor
+    """
+    if job!=None:
+        run = functools.partial(application.jobs.executor.submit, job.call)
+    else:
+        run = application.executor.submit
+
+    if move:
+        rc = yield run(dav_object.move, destination, overwrite)
+        if getattr(dav_object, 'replaced', None)!=None:
+            application.trash.reap()
+    else:
+        rc = yield run(dav_object.copy, destination, overwrite, job)
+
+    status = rc[0] if isinstance(rc, tuple) else rc
+    if status/100==2:
+        adapter = DbAdapter(application.db)
+        if move:
+            if dav_object.is_collection():
+                yield adapter.move_collection( from_uri, to_uri )
+            else:
+                yield adapter.move_properties( from_uri, to_uri )
+        else:
+            if dav_object.is_collection():
+                yield adapter.copy_collection( from_uri, to_uri )
+            else:
+                yield adapter.copy_properties( from_uri, to_uri )
+    raise gen.Return(rc)
+
+
+@gen.coroutine
+def transfer_job(application, dav_object, destination, overwrite, from_uri,
+                 to_uri, move, ifh_result, locked, job):
+    """ transfer of a job, members that failed as (href, status).
+        The job holds what it needs of the request and not its
+        handler. The uris in locked were checked when the request
+        came, they are checked again with the If header result of
+        the request as the job starts and a lock taken meanwhile
+        fails it with 423
+    """
+    for uri in locked:
+        if is_locked(application.lockdb, uri, ifh_result):
+            raise gen.Return(423)
+    rc = yield transfer(application, dav_object, destination, overwrite,
+                        from_uri, to_uri, move, job)
+    if isinstance(rc, tuple):
+        rc = (rc[0], [(r.findtext('{DAV:}href'), r.findtext('{DAV:}status'))
+                      for r in rc[1]])
+    raise gen.Return(rc)
+
+
 class BasicHandler(web.RequestHandler):
     """Basic method handler for http request
     """
@@ -130,6 +232,36 @@ class BasicHandler(web.RequestHandler):
         self.finish()
 
 
+class StatusHandler(BasicHandler):
+    """ Counters of the server caches as json
+    """
+
+    @authenticated
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(self.application.status(), 
+                               sort_keys=True, indent=2))
+
+    def post(self):
+        raise web.HTTPError(405)
+
+
+class JobHandler(BasicHandler):
+    """ State and progress of a background COPY or MOVE as json
+    """
+
+    @authenticated
+    def get(self, job_id):
+        job = self.application.jobs.get(job_id)
+        if job==None:
+            raise web.HTTPError(404)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(job.info(), sort_keys=True, indent=2))
+
+    def post(self, job_id):
+        raise web.HTTPError(405)
+
+
 class RootHandler(BasicHandler):
     """ Handle basic root object requests, i.e just redirect 
         for exisiting directory or serve get request for files
@@ -139,6 +271,11 @@ class RootHandler(BasicHandler):
             "PUT", "DELETE", "MKCOL", 
             "PROPFIND", "PROPPATCH", 
             "MOVE", "COPY", "LOCK", "UNLOCK")
+
+    def prepare(self):
+        # the trash, uploads and other server files are not served
+        if is_hidden(self.request.path):
+            raise web.HTTPError(404)
     
     def options(self, name):
         self.set_header('Allow',  
@@ -161,6 +298,18 @@ class RootHandler(BasicHandler):
             self.moved_permanatly()
             return                                            
         elif with_body:
+            cache = getattr(self.application, 'content_cache', None)
+            if cache!=None:
+                dav_object = self.application._object(self.application,
+                                                       name = name)
+                if dav_object.is_exists() and cache.fits(dav_object.st_size):
+                    try:
+                        content = cache.read(filename, validator(dav_object))
+                    except (IOError, os.error), why:
+                        raise web.HTTPError(500)
+                    if content!=None:
+                        self.finish( content )
+                        return
             try:
                 object_file = open(filename, "r")
                 try:
@@ -215,32 +364,101 @@ class RootHandler(BasicHandler):
         raise web.HTTPError(405)  
 
 
+@web.stream_request_body
 class ObjectHandler(RootHandler):
     """ Handle object requests
         methods are delegate to the coresponding object method
+
+        The request body is streamed, a PUT body is written to a
+        temporary file next to the object while other method bodies
+        are buffered in memory.
+
+        Blocking file system work is done on the application thread
+        pool, the object factory methods return futures.
     """
+
+    @gen.coroutine
+    def prepare(self):
+        self._chunks = []
+        self._upload = None
+        self._upload_error = None
+        # before any of the body is read
+        if not authorize(self):
+            return
+        RootHandler.prepare(self)
+        if self.request.method != 'PUT':
+            return
+
+        max_upload = self.application.max_upload
+        if max_upload <= 0:
+            # no limit
+            max_upload = sys.maxsize
+        content_length = self.request.headers.get('content-length') 
+        if content_length:
+            try:
+                length = int (content_length)
+            except:
+                raise web.HTTPError(400)
+            if length > max_upload:
+                raise web.HTTPError(400)
+        # the connection refuses to read more than max_upload
+        self.request.connection.set_max_body_size(max_upload)
+
+        dav_object = yield self._object(parent = self.path_args[0], 
+                        name = self.path_args[1] if len(self.path_args)>1 else '')
+        self._upload = yield self._blocking(dav_object.upload)
+
+    @gen.coroutine
+    def data_received(self, chunk):
+        if self._finished:
+            # refused in prepare
+            return
+        if self._upload==None:
+            if self.request.method != 'PUT':
+                self._chunks.append(chunk)
+            return
+        try:
+            # the connection waits for the write before reading more
+            yield self._blocking(self._upload.write, chunk)
+        except (IOError, os.error), why:
+            self._upload_error = why.errno
+            self._discard_upload()
+
+    def _discard_upload(self):
+        if self._upload!=None:
+            self._upload.discard()
+            self._upload = None
+
+    def on_connection_close(self):
+        RootHandler.on_connection_close(self)
+        self._discard_upload()
+
+    def on_finish(self):
+        self._discard_upload()
+
+    @property
+    def body(self):
+        """ buffered request body """
+        return ''.join(self._chunks)
+
+    def _blocking(self, method, *args, **kwargs):
+        """ run a blocking method on the application thread pool """
+        return self.application.executor.submit(method, *args, **kwargs)
+
     def _object(self, **kw):
         """ object factory method """
-        return self.application._object(self.application, **kw)
+        return self._blocking(self.application._object, self.application, **kw)
 
     def _object_fromuri(self, uri):
         """ object from uri factory method """
-        return self.application._object.fromuri_factory( self.application, uri )         
+        return self._blocking(self.application._object.fromuri_factory, 
+                    self.application, uri)
     
     def _if_header_evaluate(self):
         return if_header_evaluate(self.application, self.request) 
         
     def _if_header_match(self, ifh_result, locks):
-        if ifh_result=={} or ifh_result==None:
-            return None  
-        for lock in locks:
-            for uri in ifh_result.keys():
-                # result can be parent of resource 
-                # of unmmaped If list 
-                if uri.startswith(lock.resource) and \
-                    lock.token in ifh_result[ uri ]:
-                    return lock   
-        return None
+        return if_header_match(ifh_result, locks)
          
     def _is_locked(self, obj, ifh_result):
         """ verify that the object is not locked
@@ -262,8 +480,9 @@ class ObjectHandler(RootHandler):
             return    
         raise web.HTTPError(423)
   
+    @gen.coroutine
     def options(self, collection, filename=''):
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         if not dav_object.is_exists() or \
             not dav_object.is_collection() and filename == '':
             raise web.HTTPError(404) 
@@ -276,6 +495,7 @@ class ObjectHandler(RootHandler):
         self.finish()
                                     
     @authenticated      
+    @gen.coroutine
     def mkcol(self, collection, filename=''):
         """Handle collection create request
         """
@@ -283,19 +503,19 @@ class ObjectHandler(RootHandler):
         if ife!=None and ife=={}:
             raise web.HTTPError(412) 
 
-        if self.request.body!='':
+        if self.body!='':
             raise web.HTTPError(415) 
 
         if filename!='' or self.request.uri[-1]!='/':
             self.moved_permanatly()
             return    
 
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         if dav_object.is_exists():
             raise web.HTTPError(405)           
 
         self._is_locked( dav_object, ife )  
-        rc = dav_object.mkcol()
+        rc = yield self._blocking(dav_object.mkcol)
         if rc/100!=2:
             raise web.HTTPError(rc)                                       
 
@@ -303,42 +523,38 @@ class ObjectHandler(RootHandler):
         self.finish()
 
     @authenticated      
+    @gen.coroutine
     def put(self, collection, filename=''):
         """ Put a new object """
         ife = self._if_header_evaluate()
         if ife!=None and ife=={}:
             raise web.HTTPError(412) 
         
-        parent_object = self._object(parent = collection)
+        parent_object = yield self._object(parent = collection)
         if not parent_object.is_exists():
             raise web.HTTPError(409)   
         
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         self._is_locked( dav_object, ife ) 
-        content_length = self.request.headers.get('content-length') 
-        if content_length:
-            try:
-                length = int (content_length)
-            except:
-                raise web.HTTPError(400)
-            if self.application.max_upload > 0 and \
-                int(content_length) > self.application.max_upload:
-                raise web.HTTPError(400)
-        else:
-            if self.application.max_upload > 0 and \
-                len( self.request.body ) > self.application.max_upload:
-                raise web.HTTPError(400)
-            
-        dav_object.write(self.request.body)                     
-        self.set_status(201)           
+
+        if self._upload_error == errno.ENOSPC:
+            raise web.HTTPError(507)
+        if self._upload==None:
+            raise web.HTTPError(500)
+
+        rc = yield self._blocking(dav_object.commit, self._upload)
+        self._upload = None
+        if rc/100!=2:
+            raise web.HTTPError(rc)                                       
+        self.set_status(rc)           
         self.finish()
 
     @authenticated      
+    @gen.coroutine
     def get(self, collection, filename='', with_body=True):
         """ Return an index of the object if a collection
         """   
-        SIZE = 4*1024
-        dav_object = self._object(parent = collection, name=filename)
+        dav_object = yield self._object(parent = collection, name=filename)
         if not dav_object.is_exists() or \
             not dav_object.is_collection() and filename == '':
             raise web.HTTPError(404) 
@@ -356,36 +572,114 @@ class ObjectHandler(RootHandler):
         elif with_body:
             if dav_object.is_collection():
                 self.set_header("Content-Type", 'text/html')
-                self.write( collection_index( self.request, dav_object ) )
+                index = yield self._blocking(collection_index, 
+                                self.request, dav_object)
+                self.write( index )
             else:
-                self.set_header("Content-Type", dav_object.contenttype())
-                try:
-                    object_file = open(dav_object.filename, "rb")
+                content = yield self._cached_content(dav_object)
+                if content!=None:
+                    self.set_header("Accept-Ranges", "bytes")
+                    self.set_header("Content-Type", dav_object.contenttype())
+                    self.write(content)
+                else:
+                    try:
+                        object_file = yield self._blocking(open,
+                                    dav_object.filename, "rb")
+                    except (IOError, os.error), why:
+                        raise web.HTTPError(404)
                     try:
-                        buf = object_file.read(SIZE)
-                        while buf!='':
-                            self.write( buf )
-                            self.flush()
-                            buf = object_file.read(SIZE)
+                        yield self._send_file(dav_object, object_file)
+                    except StreamClosedError:
+                        # client went away
+                        return
                     finally:
                         object_file.close()
-                except (IOError, os.error), why:
-                    pass
 
         self.finish()
 
+    @gen.coroutine
+    def _cached_content(self, dav_object):
+        """ content of the file from the content cache, None when the
+            whole content is not wanted or cannot be kept. Small files
+            are served from memory, ranges from the file
+        """
+        cache = getattr(self.application, 'content_cache', None)
+        if cache==None or not cache.fits(dav_object.st_size) or \
+            self.request.headers.get("Range")!=None:
+            raise gen.Return(None)
+        content, generation = cache.get(dav_object.filename,
+                                        validator(dav_object))
+        if content==None:
+            try:
+                content = yield self._blocking(cache.load,
+                                    dav_object.filename, generation)
+            except (IOError, os.error), why:
+                raise web.HTTPError(404)
+        raise gen.Return(content)
+
+    def _get_ranges(self, dav_object, size):
+        """ requested ranges of the object or None for the
+            whole object
+        """
+        range_header = self.request.headers.get("Range")
+        if range_header==None:
+            return None
+        if_range = self.request.headers.get("If-Range")
+        if if_range!=None and \
+            not if_range_match(if_range, dav_object.etag, dav_object.st_mtime):
+            return None
+        return parse_range_header(range_header, size)
+
+    @gen.coroutine
+    def _send_file(self, dav_object, object_file):
+        """ Send the object file or the requested ranges of it
+        """
+        content_type = dav_object.contenttype()
+        size = os.fstat(object_file.fileno()).st_size
+        sender = FileSender(self, 
+            use_sendfile = self.application.use_sendfile,
+            chunk_size = self.application.chunk_size,
+            executor = self.application.executor)
+        self.set_header("Accept-Ranges", "bytes")
+        ranges = self._get_ranges(dav_object, size)
+        if ranges==None:
+            self.set_header("Content-Type", content_type)
+            self.set_header("Content-Length", size)
+            yield sender.send(object_file, 0, size)
+        elif ranges==[]:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+        elif len(ranges)==1:
+            first, last = ranges[0]
+            self.set_status(206)
+            self.set_header("Content-Type", content_type)
+            self.set_header("Content-Range", 
+                "bytes %d-%d/%d" % (first, last, size))
+            self.set_header("Content-Length", last - first + 1)
+            yield sender.send(object_file, first, last - first + 1)
+        else:
+            boundary = os.urandom(12).encode('hex')
+            parts, trailer, length = multipart(ranges, size, 
+                                        content_type, boundary)
+            self.set_status(206)
+            self.set_header("Content-Type", 
+                "multipart/byteranges; boundary=%s" % boundary)
+            self.set_header("Content-Length", length)
+            yield sender.send_parts(object_file, parts, trailer)
+
     @authenticated
     def post(self, collection, filename=''):
-        self.get( collection, filename )
+        return self.get( collection, filename )
 
     @authenticated
     def head(self, collection, filename=''):
         self.set_header('Allow',  
             ",".join (method for method in self.SUPPORTED_METHODS) )
         self.set_header('Dav', DAV_VERSION)
-        self.get( collection, filename, with_body=False )
+        return self.get( collection, filename, with_body=False )
 
     @authenticated
+    @gen.coroutine
     def copy(self, collection, filename='', move=False):
         """ Copy / Move method
         """
@@ -393,7 +687,7 @@ class ObjectHandler(RootHandler):
         if ife!=None and ife=={}:
             raise web.HTTPError(412) 
 
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         if not dav_object.is_exists() or \
             not dav_object.is_collection() and filename == '':
             raise web.HTTPError(404) 
@@ -410,6 +704,8 @@ class ObjectHandler(RootHandler):
         urld = urlsplit (destination)
         if urld.path=='':
             raise web.HTTPError(400) 
+        if is_hidden(urld.path):
+            raise web.HTTPError(403)
 
         # cannot copy on itself
         if re.match(urld.path, self.request.uri)!=None:
@@ -420,40 +716,55 @@ class ObjectHandler(RootHandler):
             self._is_locked( dav_object, ife )                          
             self._has_dependent_lock ( dav_object, ife )
 
-        d = self._object_fromuri(urld.path)
+        d = yield self._object_fromuri(urld.path)
         self._is_locked( d, ife )                          
         self._has_dependent_lock ( d, ife )
 
-        if move:
-            rc = dav_object.move( d.filename,  overwrite_header )
-        else:
-            rc = dav_object.copy( d.filename,  overwrite_header )
-
-        if rc/100!=2:
-            raise web.HTTPError(rc)                                       
-
-        adapter = DbAdapter(self.application.db)
-        if move:
-            if dav_object.is_collection():
-                adapter.move_collection( self.request.uri, urld.path )
-            else:
-                adapter.move_properties( self.request.uri, urld.path )
-        else:
-            if dav_object.is_collection():
-                adapter.copy_collection( self.request.uri, urld.path )
-            else:
-                adapter.copy_properties( self.request.uri, urld.path )
-
-        self.set_status(rc)           
+        if self._respond_async():
+            job = Job('MOVE' if move else 'COPY', self.request.uri, urld.path)
+            locked = [dav_object.uri, d.uri] if move else [d.uri]
+            work = functools.partial(transfer_job, self.application,
+                        dav_object, d.filename, overwrite_header,
+                        self.request.uri, urld.path, move, ife, locked)
+            if not self.application.jobs.submit(job, work):
+                raise web.HTTPError(503)
+            self.set_status(202)
+            self.set_header('Preference-Applied', 'respond-async')
+            self.set_header('Location', JOB_URI + job.id)
+            self.set_header("Content-Type", "application/json")
+            self.finish(json.dumps(job.info(), sort_keys=True, indent=2))
+            return
+
+        rc = yield transfer(self.application, dav_object, d.filename,
+                            overwrite_header, self.request.uri, urld.path, move)
+
+        # members that failed are reported in a multistatus
+        status = rc[0] if isinstance(rc, tuple) else rc
+        if status/100!=2:
+            raise web.HTTPError(status)
+
+        self.set_status(status)
+        if isinstance(rc, tuple):
+            self.set_header("Content-Type", "text/xml; charset=UTF-8")
+            yield MultistatusWriter(self).write(rc[1])
         self.finish()
 
+    def _respond_async(self):
+        """ the client prefers a 202 and a job to waiting """
+        if getattr(self.application, 'jobs', None)==None:
+            return False
+        prefer = ','.join(self.request.headers.get_list('Prefer'))
+        return 'respond-async' in [p.split(';')[0].strip().lower()
+                                   for p in prefer.split(',')]
+
     @authenticated
     def move(self, collection, filename=''):
         """ Move 
         """
-        self.copy( collection, filename, move = True )        
+        return self.copy( collection, filename, move = True )        
         
     @authenticated
+    @gen.coroutine
     def delete(self, collection, filename=''):
         """ Delete 
         """
@@ -461,7 +772,7 @@ class ObjectHandler(RootHandler):
         if ife!=None and ife=={}:
             raise web.HTTPError(412) 
 
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         if not dav_object.is_exists() or \
             not dav_object.is_collection() and filename == '':
             raise web.HTTPError(404) 
@@ -473,20 +784,27 @@ class ObjectHandler(RootHandler):
         self._is_locked( dav_object, ife )                          
         self._has_dependent_lock ( dav_object, ife )
 
-        rc = dav_object.delete()
+        rc = yield self._blocking(dav_object.delete)
         if rc/100!=2:
             raise web.HTTPError(rc)                                       
         
         adapter = DbAdapter(self.application.db)
-        if dav_object.is_collection():
-            adapter.delete_collection(self.request.uri)
+        trashed = getattr(dav_object, 'trashed', None)
+        if trashed!=None:
+            trash = self.application.trash
+            yield adapter.trash_collection(self.request.uri, 
+                                           trash.uri(trashed))
+            trash.reap()
+        elif dav_object.is_collection():
+            yield adapter.delete_collection(self.request.uri)
         else:
-            adapter.delete_properties(self.request.uri)
+            yield adapter.delete_properties(self.request.uri)
 
         self.set_status(rc)           
         self.finish()
 
     @authenticated      
+    @gen.coroutine
     def propfind(self, collection, filename=''):
         """ Propfind 
         """
@@ -494,7 +812,7 @@ class ObjectHandler(RootHandler):
         if ife!=None and ife=={}:
             raise web.HTTPError(412) 
 
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         if not dav_object.is_exists() or \
             not dav_object.is_collection() and filename == '':
             raise web.HTTPError(404) 
@@ -514,26 +832,33 @@ class ObjectHandler(RootHandler):
                     depth = None
             
         if dav_object.is_collection() and depth!=0 and depth!=1:
-            raise web.HTTPError(400) 
+            if depth!=None or not self.application.propfind_infinity:
+                raise web.HTTPError(400) 
         
         try:
-            parser = PropFindParser(self.request.body)    
+            parser = PropFindParser(self.body)    
         except:
             raise web.HTTPError(400) 
 
-        response = dav_object.propfind( parser, depth )
+        childs = None
+        if dav_object.is_collection() and depth==1:
+            childs = yield self._blocking(dav_object.childs)
+        response = yield dav_object.propfind( parser, depth, childs,
+                            self.application.propfind_max_entries )
         if isinstance (response, int):
             raise web.HTTPError(response)
 
         self.set_header("Content-Type", "text/xml; charset=UTF-8")
         self.set_status(response[0])
-        self.write ( etree.tostring(MultistatusElement(*response[1]), 
-                        pretty_print=True, 
-                        encoding='UTF-8', 
-                        xml_declaration=True))                       
+        try:
+            yield MultistatusWriter(self).write(response[1])
+        except StreamClosedError:
+            # client went away
+            return
         self.finish()       
 
     @authenticated      
+    @gen.coroutine
     def proppatch(self, collection, filename=''):
         """ Proppatch 
         """
@@ -541,7 +866,7 @@ class ObjectHandler(RootHandler):
         if ife!=None and ife=={}:
             raise web.HTTPError(412) 
 
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         if not dav_object.is_exists() or \
             not dav_object.is_collection() and filename == '':
             raise web.HTTPError(404) 
@@ -553,23 +878,21 @@ class ObjectHandler(RootHandler):
         self._is_locked( dav_object, ife )
 
         try:
-            parser = PropPatchParser(self.request.body)    
+            parser = PropPatchParser(self.body)    
         except:
             raise web.HTTPError(400) 
        
-        response = dav_object.proppatch( parser ) 
+        response = yield dav_object.proppatch( parser ) 
         if isinstance (response, int):
             raise web.HTTPError(response)
 
         self.set_header("Content-Type", "text/xml; charset=UTF-8")
         self.set_status(response[0])
-        self.write ( etree.tostring(MultistatusElement(*response[1]), 
-                        pretty_print=True, 
-                        encoding='UTF-8', 
-                        xml_declaration=True))                       
+        yield MultistatusWriter(self).write([response[1]])
         self.finish()       
            
     @authenticated      
+    @gen.coroutine
     def lock(self, collection, filename=''):
         """ Lock object
         """
@@ -577,7 +900,7 @@ class ObjectHandler(RootHandler):
         if ife!=None and ife=={}:
             raise web.HTTPError(412) 
 
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         if dav_object.is_collection() and filename != '':
             self.moved_permanatly()
             return                                 
@@ -585,15 +908,15 @@ class ObjectHandler(RootHandler):
         if not dav_object.is_exists():
             # you can lock non-existing object
             # how wonderfull is that?
-            if self.request.body=='':
+            if self.body=='':
                 raise web.HTTPError(400)  
 
-            parent_object = self._object(parent = collection)                
+            parent_object = yield self._object(parent = collection)
             if not parent_object.is_exists():
                 raise web.HTTPError(409)                 
 
             # create an empty resource
-            dav_object.write()
+            yield self._blocking(dav_object.write)
 
         depth = self.request.headers.get('depth')  
         if depth == "infinity":
@@ -613,7 +936,7 @@ class ObjectHandler(RootHandler):
         else:
             timeout = None
 
-        if self.request.body == '':
+        if self.body == '':
             # Try to refresh locked object
             locks = self.application.lockdb.all_locks( dav_object.uri )
             if locks==[]:
@@ -622,7 +945,7 @@ class ObjectHandler(RootHandler):
             lock = self._if_header_match( ife, locks )
             if lock:      
                 # resresh the lock
-                self.application.lockdb.refresh_lock(lock.id, timeout) 
+                yield self.application.lockdb.refresh_lock(lock.id, timeout) 
                 discovery = LockDiscovery( lock.Activelock() )
                 lockdiscovery = etree.tostring(PropElement (discovery) , 
                       encoding='UTF-8', 
@@ -637,11 +960,11 @@ class ObjectHandler(RootHandler):
         else:
             # Try to lock object
             try:
-                parser = LockParser(self.request.body)
+                parser = LockParser(self.body)
             except:
                 raise web.HTTPError(400) 
 
-            rc = dav_object.lock(parser, timeout, depth)
+            rc = yield dav_object.lock(parser, timeout, depth)
             if isinstance (rc, int):
                 raise web.HTTPError(rc)
         
@@ -670,6 +993,7 @@ class ObjectHandler(RootHandler):
         self.finish()
            
     @authenticated      
+    @gen.coroutine
     def unlock(self, collection, filename=''):
         """ Unlock object
         """
@@ -677,7 +1001,7 @@ class ObjectHandler(RootHandler):
         if ife!=None and ife=={}:
             raise web.HTTPError(412) 
 
-        dav_object = self._object(parent = collection, name = filename)
+        dav_object = yield self._object(parent = collection, name = filename)
         if not dav_object.is_exists() or \
             not dav_object.is_collection() and filename == '':
             raise web.HTTPError(404) 
@@ -696,6 +1020,7 @@ class ObjectHandler(RootHandler):
         else:
             raise web.HTTPError(400) 
 
-        self.set_status( dav_object.unlock(lock_token) )    
+        rc = yield dav_object.unlock(lock_token)
+        self.set_status(rc)
         self.finish()
 
@@ -0,0 +1,164 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.locks import Semaphore
+
+
+""" Background jobs
+
+    A COPY or MOVE sent with Prefer: respond-async is answered with
+    202 Accepted and the url of a job, the job does the work after
+    the response. The file system work of the jobs runs on the job
+    executor, a job waits for one of its threads to be free before it
+    starts, and no more than queue_size jobs are queued or running.
+    Finished jobs are kept for their status to be read, up to keep of
+    them.
+"""
+
+JOB_URI = '/.dav/jobs/'
+
+JOB_WORKERS = 2
+JOB_QUEUE = 64
+JOB_KEEP = 256
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class Job(object):
+    """ a background COPY or MOVE and its progress, files and bytes
+        are counted by the copy threads
+    """
+
+    def __init__(self, method, source, destination):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.source = source
+        self.destination = destination
+        self.state = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.files = 0
+        self.bytes = 0
+        # http status of the request and (href, status) of the
+        # members that failed
+        self.status = None
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add(self, files, size):
+        """ progress of the copy """
+        with self._lock:
+            self.files += files
+            self.bytes += size
+
+    def call(self, method, *args):
+        """ run method of the job on the job executor """
+        self.state = RUNNING
+        self.started = time.time()
+        return method(*args)
+
+    def info(self):
+        with self._lock:
+            return {'id': self.id,
+                    'method': self.method,
+                    'source': self.source,
+                    'destination': self.destination,
+                    'state': self.state,
+                    'created': self.created,
+                    'started': self.started,
+                    'finished': self.finished,
+                    'files': self.files,
+                    'bytes': self.bytes,
+                    'status': self.status,
+                    'errors': [{'href': href, 'status': status}
+                               for href, status in self.errors]}
+
+
+class JobQueue(object):
+    """ Jobs of the server, used on the io loop
+    """
+
+    def __init__(self, workers=JOB_WORKERS, queue_size=JOB_QUEUE,
+                 keep=JOB_KEEP):
+        self.executor = ThreadPoolExecutor(workers)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.keep = keep
+        self._jobs = OrderedDict()
+        self._active = 0
+        # a worker for each running job
+        self._workers = Semaphore(workers)
+
+    def submit(self, job, work):
+        """ start work(job), a coroutine returning the status of the
+            job or (status, errors). False when the queue is full
+        """
+        if self._active >= self.queue_size:
+            return False
+        self._active += 1
+        self._jobs[job.id] = job
+        self._run(job, work)
+        return True
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def stats(self):
+        states = dict( (state, 0) for state in
+                       (QUEUED, RUNNING, DONE, FAILED) )
+        for job in self._jobs.itervalues():
+            states[job.state] += 1
+        states['workers'] = self.workers
+        states['queue_size'] = self.queue_size
+        return states
+
+    @gen.coroutine
+    def _run(self, job, work):
+        try:
+            # work sees the server as it is when the job starts
+            with (yield self._workers.acquire()):
+                result = yield work(job)
+            if isinstance(result, tuple):
+                job.status, job.errors = result
+            else:
+                job.status = result
+            # a 207 reports the members that failed
+            if job.status/100==2 and not job.errors:
+                job.state = DONE
+            else:
+                job.state = FAILED
+        except Exception:
+            logging.exception('job %s failed', job.id)
+            job.status = 500
+            job.state = FAILED
+        finally:
+            job.finished = time.time()
+            self._active -= 1
+            self._trim()
+
+    def _trim(self):
+        """ forget the oldest finished jobs beyond keep """
+        finished = [job_id for job_id, job in self._jobs.iteritems()
+                    if job.finished!=None]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job_id]
@@ -0,0 +1,391 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+from collections import OrderedDict
+
+from tornado.ioloop import IOLoop
+
+from fswalk import listdir
+
+
+""" File system metadata cache
+
+    A bounded LRU of stat results, directory listings, etags and content
+    types keyed by absolute path, shared by all the file objects of the
+    process. The server invalidates the paths it changes itself, changes
+    made by others are reported by inotify(7). A value is only kept when
+    the directory holding it is watched, so without inotify nothing is
+    cached. The least recently used watches are removed beyond a limit,
+    and the cache is disabled when the kernel refuses more watches.
+"""
+
+CACHE_SIZE = 10000
+# directories watched at most
+MAX_WATCHES = 4096
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0x00080000
+IN_NONBLOCK    = 0x00000800
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_EVENT = struct.Struct('iIII')
+
+# cached value of a path that does not exist
+MISSING = ()
+
+
+def _oserror():
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
+
+
+class Inotify(object):
+    """ inotify(7) through libc, reports the changes in watched directories
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._add_watch.restype = ctypes.c_int
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._rm_watch.restype = ctypes.c_int
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise _oserror()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, directory):
+        """ watch descriptor of directory """
+        wd = self._add_watch(self.fd, directory, WATCH_MASK)
+        if wd < 0:
+            raise _oserror()
+        return wd
+
+    def rm_watch(self, wd):
+        """ stop watching, the directory may be gone already """
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        """ the pending events as a list of (wd, mask, name) """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64*1024)
+            except OSError, why:
+                if why.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset+length].rstrip('\0')
+                offset += length
+                events.append( (wd, mask, name) )
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Entry(object):
+    __slots__ = ('stat', 'listing', 'etag', 'contenttype')
+
+    def __init__(self):
+        self.stat = None
+        self.listing = None
+        self.etag = None
+        self.contenttype = None
+
+    def weight(self):
+        """ a listing counts as an entry per child """
+        return 1 + len(self.listing or ())
+
+
+class MetadataCache(object):
+    """ LRU of file system metadata, size is the number of entries kept,
+        a directory listing counts for each of its childs. At most
+        max_watches directories are watched, the entries of a directory
+        are dropped with its watch.
+
+        Values are read outside of the cache lock. A value read before
+        an invalidation is not kept, and the watch of its directory is
+        added before it is read, so a change is either seen by the read
+        or reported by the watcher.
+    """
+
+    def __init__(self, size=CACHE_SIZE, watcher=None,
+                 max_watches=MAX_WATCHES):
+        self.size = size
+        self.watcher = watcher
+        self.max_watches = max_watches
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._weight = 0
+        self._generation = 0
+        # directory: watch descriptor, least recently used first
+        self._watches = OrderedDict()
+        self._directories = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, size=CACHE_SIZE, max_watches=MAX_WATCHES):
+        """ a cache watched with inotify when available """
+        watcher = None
+        if size > 0 and max_watches > 0:
+            try:
+                watcher = Inotify()
+            except OSError:
+                pass
+        return cls(size, watcher, max_watches)
+
+    def enabled(self):
+        return self.size > 0 and self.watcher!=None
+
+    def start(self, io_loop=None):
+        """ read the watcher events on the io loop """
+        if self.enabled():
+            io_loop = io_loop or IOLoop.current()
+            io_loop.add_handler(self.watcher.fileno(),
+                                self._on_events, IOLoop.READ)
+
+    def stat(self, path):
+        """ os.stat of path or None when it does not exist """
+        value, generation = self._get(path, 'stat')
+        if value==None:
+            watched = self._watch(os.path.dirname(path))
+            try:
+                value = os.stat(path)
+            except os.error:
+                value = MISSING
+            if watched:
+                self._put(path, 'stat', value, generation)
+        if value is MISSING:
+            return None
+        return value
+
+    def listdir(self, path):
+        """ (name, stat or None) of each entry of the directory path,
+            raises os.error when it cannot be listed
+        """
+        value, generation = self._get(path, 'listing')
+        if value==None:
+            watched = self._watch(path)
+            value = listdir(path)
+            if watched:
+                self._put(path, 'listing', value, generation)
+        return value
+
+    def etag(self, path, mtime, compute):
+        """ etag of path last modified at mtime, compute() makes it """
+        value, generation = self._get(path, 'etag',
+                                lambda value: value[0]==mtime)
+        if value==None:
+            value = (mtime, compute())
+            if self._watch(os.path.dirname(path)):
+                self._put(path, 'etag', value, generation)
+        return value[1]
+
+    def contenttype(self, path, compute):
+        """ content type of path, compute() guesses it """
+        value, generation = self._get(path, 'contenttype')
+        if value==None:
+            value = compute()
+            if self._watch(os.path.dirname(path)):
+                self._put(path, 'contenttype', value, generation)
+        return value
+
+    def invalidate(self, path, tree=False):
+        """ forget path, its directory and the listing holding the stat
+            of the directory, and everything below path when tree
+        """
+        directory = os.path.dirname(path)
+        with self._lock:
+            self._generation += 1
+            self._drop(path)
+            self._drop(directory)
+            self._drop(os.path.dirname(directory))
+            if tree:
+                prefix = path.rstrip('/') + '/'
+                for key in [key for key in self._entries
+                            if key.startswith(prefix)]:
+                    self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._weight = 0
+
+    def stats(self):
+        with self._lock:
+            return {'enabled': self.enabled(),
+                    'size': self.size,
+                    'entries': len(self._entries),
+                    'weight': self._weight,
+                    'watches': len(self._watches),
+                    'max_watches': self.max_watches,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def _get(self, path, field, valid=None):
+        """ (value or None, generation to put a value read now) """
+        if not self.enabled():
+            return None, None
+        with self._lock:
+            entry = self._entries.get(path)
+            value = getattr(entry, field) if entry!=None else None
+            if value!=None and (valid==None or valid(value)):
+                self.hits += 1
+                # most recently used last
+                self._entries[path] = self._entries.pop(path)
+                return value, self._generation
+            self.misses += 1
+            return None, self._generation
+
+    def _put(self, path, field, value, generation):
+        # a listing is watched with its directory, the others with the
+        # directory holding them
+        directory = path if field=='listing' else os.path.dirname(path)
+        with self._lock:
+            if generation!=self._generation or \
+                directory not in self._watches:
+                return
+            entry = self._entries.pop(path, None)
+            if entry==None:
+                entry = _Entry()
+            else:
+                self._weight -= entry.weight()
+            setattr(entry, field, value)
+            self._entries[path] = entry
+            self._weight += entry.weight()
+            while self._weight > self.size and self._entries:
+                key, old = self._entries.popitem(last=False)
+                self._weight -= old.weight()
+
+    def _drop(self, path):
+        entry = self._entries.pop(path, None)
+        if entry!=None:
+            self._weight -= entry.weight()
+
+    def _watch(self, directory):
+        """ watch directory, False when it cannot be watched """
+        if not self.enabled():
+            return False
+        with self._lock:
+            if directory in self._watches:
+                # most recently used last
+                self._watches[directory] = self._watches.pop(directory)
+                return True
+        try:
+            wd = self.watcher.add_watch(directory)
+        except OSError, why:
+            if why.errno==errno.ENOSPC:
+                # out of watches, changes would go unnoticed
+                logging.warning('metadata cache disabled: %s, raise '
+                    'fs.inotify.max_user_watches or lower max_watches', why)
+                self.size = 0
+                self.clear()
+            return False
+        evicted = []
+        with self._lock:
+            self._watches[directory] = wd
+            # the same directory can be reached by several paths
+            self._directories.setdefault(wd, set()).add(directory)
+            while len(self._watches) > self.max_watches:
+                evicted.append(self._watches.popitem(last=False))
+        for old, old_wd in evicted:
+            self._unwatch(old, old_wd)
+        return True
+
+    def _unwatch(self, directory, wd):
+        """ stop watching directory and forget what depends on it """
+        with self._lock:
+            directories = self._directories.get(wd, set())
+            directories.discard(directory)
+            remove = not directories
+            if remove:
+                self._directories.pop(wd, None)
+            # the values read through the watch, a value read before is
+            # not kept by _put as the directory is no longer watched
+            self._drop(directory)
+            prefix = directory.rstrip('/') + '/'
+            for key in [key for key in self._entries
+                        if key.startswith(prefix) and
+                        os.path.dirname(key)==directory]:
+                self._drop(key)
+        if remove:
+            self.watcher.rm_watch(wd)
+
+    def _on_events(self, fd, events):
+        try:
+            events = self.watcher.read()
+        except OSError:
+            self.clear()
+            return
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.clear()
+                continue
+            if mask & IN_IGNORED:
+                # the directory is gone, so is its watch
+                with self._lock:
+                    directories = self._directories.pop(wd, ())
+                    for directory in directories:
+                        self._watches.pop(directory, None)
+                for directory in directories:
+                    self.invalidate(directory, True)
+                continue
+            with self._lock:
+                directories = list(self._directories.get(wd, ()))
+            for directory in directories:
+                if name:
+                    self.invalidate(os.path.join(directory, name),
+                                    bool(mask & IN_ISDIR))
+                else:
+                    self.invalidate(directory, True)
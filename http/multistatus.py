@@ -0,0 +1,97 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from lxml import etree
+from tornado import gen
+from tornado.concurrent import is_future
+
+from dav.davelement import DAV_NS, RAW_TAG
+
+
+""" Multistatus response writer
+
+    Serializes the response elements of a multistatus body one at a
+    time as they are produced instead of building the whole document.
+    The output is flushed to the connection every flush_size bytes,
+    the writer waits for the socket to take it before producing more,
+    so a slow client holds about one buffer of the response. Without a
+    Content-Length the body goes out with chunked transfer encoding.
+    Stored properties come as raw elements holding their serialized
+    xml, which is copied to the output without parsing it.
+"""
+
+FLUSH_SIZE = 64*1024
+
+
+class _Output(object):
+    """ file like target of the xml writer, writes to the handler """
+    def __init__(self, handler):
+        self.handler = handler
+        self.pending = 0
+
+    def write(self, data):
+        if data:
+            self.handler.write(data)
+            self.pending += len(data)
+
+
+class MultistatusWriter(object):
+    """ Write a multistatus body on a request handler
+
+        The handler must have set the response status and headers.
+    """
+
+    def __init__(self, handler, flush_size=FLUSH_SIZE, pretty_print=True):
+        self.handler = handler
+        self.flush_size = flush_size
+        self.pretty_print = pretty_print
+
+    @gen.coroutine
+    def write(self, responses):
+        """ responses is an iterable of response elements or of
+            futures of lists of response elements
+        """
+        output = _Output(self.handler)
+        with etree.xmlfile(output, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            with xf.element('{%s}multistatus' % DAV_NS, nsmap={'d': DAV_NS}):
+                for response in responses:
+                    if is_future(response):
+                        elements = yield response
+                    else:
+                        elements = [response]
+                    for element in elements:
+                        self._write(xf, output, element)
+                        xf.flush()
+                        if output.pending >= self.flush_size:
+                            output.pending = 0
+                            yield self.handler.flush()
+
+    def _write(self, xf, output, element):
+        """ write element, splicing the text of the raw elements in it
+        """
+        if element.tag == RAW_TAG:
+            xf.flush()
+            output.write(element.text)
+        elif next(element.iter(RAW_TAG), None) is None:
+            xf.write(element, pretty_print=self.pretty_print)
+        else:
+            with xf.element(element.tag, dict(element.attrib)):
+                if element.text:
+                    xf.write(element.text)
+                for child in element:
+                    self._write(xf, output, child)
+                    if child.tail:
+                        xf.write(child.tail)
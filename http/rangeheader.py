@@ -0,0 +1,101 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+from email.utils import parsedate_tz, mktime_tz
+
+
+"""
+Range and If-Range header parser
+
+Range = byte-ranges-specifier
+    byte-ranges-specifier = bytes-unit "=" byte-range-set
+    byte-range-set  = 1#( byte-range-spec / suffix-byte-range-spec )
+    byte-range-spec = first-byte-pos "-" [ last-byte-pos ]
+    suffix-byte-range-spec = "-" suffix-length
+
+If-Range = entity-tag / HTTP-date
+
+http://tools.ietf.org/html/rfc7233
+"""
+
+# more ranges than this are served as a full response
+MAX_RANGES = 64
+
+rangem = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+def parse_range_header(header, size):
+    """ Parse a Range header against a resource of size bytes.
+
+        - None if the header should be ignored (not bytes or bogus)
+        - empty list if no range is satisfiable
+        - otherwise a sorted list of (first, last) inclusive positions,
+          overlapping and adjacent ranges are coalesced
+    """
+    unit, sep, byte_range_set = header.partition('=')
+    if sep=='' or unit.strip().lower()!='bytes':
+        return None
+
+    ranges = []
+    for spec in byte_range_set.split(','):
+        if spec.strip()=='':
+            continue
+        m = rangem.match(spec)
+        if not m or m.group(1)=='' and m.group(2)=='':
+            return None
+        first, last = m.groups()
+        if first=='':
+            # suffix range, the last bytes of the resource
+            suffix = int(last)
+            if suffix==0:
+                continue
+            first = max(size - suffix, 0)
+            last = size - 1
+        else:
+            first = int(first)
+            if last=='':
+                last = size - 1
+            else:
+                last = int(last)
+                if last<first:
+                    return None
+                last = min(last, size - 1)
+        if first<size:
+            ranges.append( (first, last) )
+
+    if len(ranges)>MAX_RANGES:
+        return None
+
+    ranges.sort()
+    coalesced = []
+    for first, last in ranges:
+        if coalesced and first<=coalesced[-1][1]+1:
+            coalesced[-1] = (coalesced[-1][0], max(last, coalesced[-1][1]))
+        else:
+            coalesced.append( (first, last) )
+    return coalesced
+
+
+def if_range_match(header, etag, mtime):
+    """ True if the If-Range validator matches the current entity,
+        a weak entity tag never matches
+    """
+    header = header.strip()
+    if header.startswith('"') or header.startswith('W/'):
+        return header==etag
+    date = parsedate_tz(header)
+    if date==None:
+        return False
+    return mktime_tz(date)==int(mtime)
@@ -17,40 +17,70 @@
 
 import os
 import ssl
+import signal
+from concurrent.futures import ThreadPoolExecutor
 
 import tornado.web
 import tornado.httpserver
 import tornado.ioloop
 import tornado.options
 from tornado.options import define, options
-from torndb import Connection
 
-from handler import BasicHandler, RootHandler, ObjectHandler
+from handler import BasicHandler, RootHandler, ObjectHandler, StatusHandler, \
+                    JobHandler, MAX_UPLOAD
 from auth import DigestAuth, BasicAuth, DbSqlAuth, DbFileAuth
 from dav.lock import Lockdb
+from dav.properties import PropertyCache, UriSet
 from file_object import FileObject
+from metacache import MetadataCache
+from contentcache import ContentCache
+from trash import Trash
+from jobs import JobQueue
+from storage import MySqlStorage, SqliteStorage, migrate
 
 CONFIG_FILE = 'dav-server.conf'
 
 define("port", default=8888, help="run on the given port", type=int)
 define("root", default='/tmp', help="Data root directory")
+define("storage", default='mysql', help="Locks, properties and users storage, mysql or sqlite")
+define("sqlite_file", default='dav.db', help="sqlite storage database file")
 define("mysql_host", default='localhost', help="Main application DB host")
 define("mysql_name", default='db1', help="Main application DB name")
 define("mysql_user", default='admin', help="Main application DB user")
 define("mysql_passwd", default='admin', help="Main application DB password")
 define("realm", default='davserver', help="Sever authorization realm")
 define("auth_type", default='', help="digest or basic")
-define("auth_file", default='MYSQL', help="MYSQL or authentication file name")
+define("auth_file", default='MYSQL', help="MYSQL for the storage users table or authentication file name")
 define("use_ssl", default=False, help="Use SSL encryption", type=bool)
 define("ssl_cretfile", default='', help="SSL certificate file")
 define("ssl_keyfile", default='', help="SSL key file")
-define("max_upload", default=0, help="Max file size to upload", type=int)
+define("max_upload", default=MAX_UPLOAD, help="Max file size to upload, 0 for no limit", type=int)
+define("pool_size", default=8, help="Threads for blocking file system work", type=int)
+define("copy_workers", default=8, help="Threads copying the files of a collection COPY", type=int)
+define("trash_batch", default=1000, help="Files or properties the trash reaper removes at a time", type=int)
+define("trash_pause", default=0.1, help="Seconds the trash reaper waits between batches", type=float)
+define("job_workers", default=2, help="Threads running the COPY and MOVE jobs of Prefer: respond-async", type=int)
+define("job_queue", default=64, help="Jobs queued or running at most, more are answered 503", type=int)
+define("db_pool_size", default=4, help="Database connections and threads", type=int)
+define("lock_purge_interval", default=60, help="Seconds between expired locks purges", type=int)
+define("use_sendfile", default=True, help="Send files with sendfile when possible", type=bool)
+define("chunk_size", default=64*1024, help="Download chunk size when not using sendfile", type=int)
+define("propfind_infinity", default=False, help="Allow depth infinity PROPFIND on collections", type=bool)
+define("propfind_max_entries", default=10000, help="Responses of a depth infinity PROPFIND, 0 for no limit", type=int)
+define("metadata_cache", default=10000, help="Entries of the file system metadata cache, 0 disables it", type=int)
+define("metadata_watches", default=4096, help="Directories the metadata cache watches with inotify at most", type=int)
+define("content_cache", default=32*1024*1024, help="Bytes of small file contents kept for GET, 0 disables it", type=int)
+define("content_cache_max_file", default=64*1024, help="Size of the largest file kept in the content cache", type=int)
+define("property_cache", default=16*1024*1024, help="Bytes of the dead property cache, 0 disables it", type=int)
+define("property_uris", default=True, help="Keep the uris with dead properties in memory to skip queries for the others", type=bool)
 
 
 class DavApplication(tornado.web.Application):
     def __init__(self, root_directory, userauth, db, settings):    
         tornado.web.Application.__init__(self, [
             (r'/', BasicHandler),
+            (r'/\.dav/status', StatusHandler),
+            (r'/\.dav/jobs/(\w+)', JobHandler),
             (r'/([^/]+)$', RootHandler),
             (r'/(.+)/', ObjectHandler),
             (r'/(.+)/(.+)', ObjectHandler),
@@ -62,21 +92,72 @@ class DavApplication(tornado.web.Application):
         self.lockdb = Lockdb(db)
         self._object = FileObject        
         self.max_upload = options.max_upload
+        # sendfile cannot be used on ssl connections
+        self.use_sendfile = options.use_sendfile and not options.use_ssl
+        self.chunk_size = options.chunk_size
+        self.executor = ThreadPoolExecutor(options.pool_size)
+        # not the executor, collection copies running there wait on it
+        self.copy_executor = ThreadPoolExecutor(options.copy_workers)
+        self.propfind_infinity = options.propfind_infinity
+        self.propfind_max_entries = options.propfind_max_entries or None
+        self.metadata = MetadataCache.create(options.metadata_cache,
+                                             options.metadata_watches)
+        self.content_cache = ContentCache(options.content_cache,
+                                          options.content_cache_max_file)
+        self.trash = Trash(self.directory, db, self.executor, 
+                           options.trash_batch, options.trash_pause)
+        self.jobs = JobQueue(options.job_workers, options.job_queue)
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
 
+    def status(self):
+        """ counters of the server caches """
+        status = {'metadata': self.metadata.stats(),
+                  'content': self.content_cache.stats(),
+                  'trash': self.trash.stats(),
+                  'jobs': self.jobs.stats()}
+        if self.db.property_cache!=None:
+            status['properties'] = self.db.property_cache.stats()
+        if self.db.property_uris!=None:
+            status['property_uris'] = len(self.db.property_uris)
+        return status
 
-def run_server(conf_root=''):       
+
+def parse_options(conf_root=''):
     conf_file = os.path.abspath(
                 os.path.join (conf_root, CONFIG_FILE))
     if os.path.exists(conf_file):            
         tornado.options.parse_config_file( conf_file )
     tornado.options.parse_command_line()
 
-    db = Connection(options.mysql_host, 
+
+def mysql_storage(executor=None):
+    return MySqlStorage(options.mysql_host, 
         options.mysql_name, 
         options.mysql_user, 
-        options.mysql_passwd)
+        options.mysql_passwd,
+        options.db_pool_size,
+        executor)
+
+
+def sqlite_storage(conf_root='', executor=None):
+    return SqliteStorage( os.path.abspath(
+                os.path.join (conf_root, options.sqlite_file)), executor )
+
+
+def run_server(conf_root=''):       
+    parse_options(conf_root)
+
+    # database work is done off the io loop
+    executor = ThreadPoolExecutor(options.db_pool_size)
+    if options.storage == 'sqlite':
+        db = sqlite_storage(conf_root, executor)
+    else:
+        db = mysql_storage(executor)
+    if options.property_cache > 0:
+        db.property_cache = PropertyCache(options.property_cache)
+    if options.property_uris:
+        db.property_uris = UriSet(db.select_property_uris())
 
     usersdb = {}        
     if options.auth_file == 'MYSQL':
@@ -113,7 +194,36 @@ def run_server(conf_root=''):
         http_server = tornado.httpserver.HTTPServer(application)
     
     http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    io_loop = tornado.ioloop.IOLoop.instance()
+    application.metadata.start(io_loop)
+    # what the trash held when the server stopped
+    io_loop.add_callback(application.trash.reap)
+
+    tornado.ioloop.PeriodicCallback(application.lockdb.purge, 
+        options.lock_purge_interval*1000, io_loop).start()
+
+    # reload the locks table on SIGHUP
+    signal.signal(signal.SIGHUP, lambda signum, frame: 
+        io_loop.add_callback_from_signal(application.lockdb.resync))
+    io_loop.start()
+
+
+def run_upgrade(conf_root=''):
+    """ move the MySQL property table to the indexed schema """
+    parse_options(conf_root)
+    copied = mysql_storage().upgrade_property_table()
+    if copied==None:
+        print 'property table is up to date'
+    else:
+        print 'property: %d rows copied, old table kept as property_old' % copied
+
+
+def run_migrate(conf_root=''):
+    """ copy the MySQL tables into the sqlite storage """
+    parse_options(conf_root)
+    copied = migrate(mysql_storage(), sqlite_storage(conf_root))
+    for table, count in sorted(copied.items()):
+        print '%s: %d rows' % (table, count)
 
 
 if __name__=='__main__':
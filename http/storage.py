@@ -0,0 +1,621 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sys
+import time
+import Queue
+import sqlite3
+import threading
+import contextlib
+from collections import OrderedDict
+
+from tornado.concurrent import Future
+
+from dav.properties import well_formed
+
+try:
+    import torndb
+except ImportError:
+    # MySQLdb is not needed with the sqlite storage
+    torndb = None
+
+
+""" Server storage
+
+    Locks, dead properties and users are kept in a database behind
+    the Storage interface. The sql storage implements it with plain
+    sql common to MySQL and sqlite, the subclasses only supply the
+    connection.
+
+    Storage methods block, the server runs them on the storage
+    executor with submit() and waits for the returned future.
+"""
+
+# MySQL server has gone away, the statement was not sent
+CR_SERVER_GONE_ERROR = 2006
+
+# rows of one multi row insert, keeps the statement parameters
+# under the sqlite limit
+INSERT_ROWS = 300
+
+TABLES = ('locks', 'property', 'users')
+
+SQLITE_SCHEMA = """
+create table if not exists locks (
+    id integer primary key autoincrement,
+    resource text not null,
+    token text not null,
+    scope integer not null,
+    depth integer default null,
+    created integer,
+    timeout integer default null,
+    owner text);
+create unique index if not exists locks_token on locks (token);
+
+create table if not exists property (
+    id integer primary key autoincrement,
+    uri text not null,
+    property_name text not null,
+    property_value text);
+create unique index if not exists property_uri on property (uri, property_name);
+
+create table if not exists users (
+    id integer primary key autoincrement,
+    realm text not null,
+    user_name text not null,
+    user_hash text not null);
+create index if not exists users_realm on users (realm, user_name);
+"""
+
+
+class Storage(object):
+    """ Storage interface of locks, properties and users
+        rows are returned as dictionaries
+    """
+
+    # runs the storage methods off the io loop
+    executor = None
+    # stored dead properties of the database adapters
+    property_cache = None
+    # uris that have dead properties, for the database adapters
+    property_uris = None
+
+    def submit(self, method, *args):
+        """ run a storage method on the executor and return its
+            future, without an executor the method runs in place
+        """
+        if self.executor!=None:
+            return self.executor.submit(method, *args)
+        future = Future()
+        try:
+            future.set_result(method(*args))
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        return future
+
+    # locks
+    def clean_locks(self, max_timeout, now):
+        """ delete expired locks, infinite locks expire after max_timeout """
+        raise NotImplementedError()
+
+    def select_locks(self, now):
+        """ all locks not expired by now """
+        raise NotImplementedError()
+
+    def insert_lock(self, resource, token, scope, depth, created, timeout, owner):
+        """ return the new lock id """
+        raise NotImplementedError()
+
+    def update_lock(self, lockid, created, timeout):
+        raise NotImplementedError()
+
+    def delete_locks(self, lockids):
+        raise NotImplementedError()
+
+    # properties
+    def select_properties(self, uris):
+        """ property rows of all uris """
+        raise NotImplementedError()
+
+    def select_property_uris(self):
+        """ the uris that have properties """
+        raise NotImplementedError()
+
+    def insert_property(self, uri, name, value):
+        """ return the new property row id """
+        raise NotImplementedError()
+
+    def patch_properties(self, uri, values, names):
+        """ set the (name, value) properties and remove the named
+            properties of uri in one transaction, return the 
+            properties of uri after the change
+        """
+        raise NotImplementedError()
+
+    def copy_properties(self, from_uri, to_uri, subtree=False):
+        """ replace properties of to_uri with a copy of from_uri
+            properties, with all uris below them if subtree
+        """
+        raise NotImplementedError()
+
+    def move_properties(self, from_uri, to_uri, subtree=False):
+        raise NotImplementedError()
+
+    def delete_properties(self, uri, subtree=False):
+        raise NotImplementedError()
+
+    def purge_properties(self, uri, limit):
+        """ delete up to limit properties of uri and the uris below
+            it, return the number deleted
+        """
+        raise NotImplementedError()
+
+    # users
+    def select_users(self, realm):
+        """ list of (user name, user hash) of realm """
+        raise NotImplementedError()
+
+
+class SqlStorage(Storage):
+    """ Storage on a sql database
+        subclasses implement the _query, _insert and _update primitives
+        with %s parameters
+    """
+
+    def __init__(self):
+        # number of statements executed
+        self.queries = 0
+
+    def _query(self, query, *parameters):
+        """ list of row dictionaries """
+        raise NotImplementedError()
+
+    def _insert(self, query, *parameters):
+        """ last row id """
+        raise NotImplementedError()
+
+    def _update(self, query, *parameters):
+        """ row count """
+        raise NotImplementedError()
+
+    def _transaction(self):
+        """ context manager, statements of the block run in one
+            transaction committed at its end
+        """
+        raise NotImplementedError()
+
+    def _delete_malformed(self, table, batch_size):
+        """ delete the properties of table that cannot be written into
+            a response as they are, return the number deleted
+        """
+        deleted = 0
+        last = 0
+        while True:
+            rows = self._query("""\
+                select id, property_value from %s
+                where id > %%s order by id limit %%s
+                """ % table, last, batch_size)
+            if not rows:
+                return deleted
+            last = rows[-1]['id']
+            malformed = [row['id'] for row in rows
+                         if not well_formed(row['property_value'])]
+            if malformed:
+                deleted += self._update("delete from %s where id in (%s)" %
+                            (table, ', '.join(['%s'] * len(malformed))),
+                            *malformed)
+
+    def clean_locks(self, max_timeout, now):
+        return self._update("""\
+            DELETE FROM locks WHERE
+            timeout IS NULL AND created + %s < %s OR
+            timeout IS NOT NULL AND created + timeout < %s
+            """, max_timeout, now, now)
+
+    def select_locks(self, now):
+        return self._query("""\
+            SELECT id, resource, token, scope, depth, owner, created, timeout
+            FROM locks WHERE
+            timeout IS NULL OR created + timeout > %s""", now)
+
+    def insert_lock(self, resource, token, scope, depth, created, timeout, owner):
+        return self._insert("""\
+            insert into locks (resource, token, scope, depth, created, timeout, owner)
+            values (%s, %s, %s, %s, %s, %s, %s)
+            """, resource, token, scope, depth, created, timeout, owner)
+
+    def update_lock(self, lockid, created, timeout):
+        return self._update(
+            "update locks set created = %s, timeout = %s where id = %s",
+            created, timeout, lockid)
+
+    def delete_locks(self, lockids):
+        return self._update("delete from locks where id in (%s)" %
+                ', '.join(['%s'] * len(lockids)), *lockids)
+
+    def select_properties(self, uris):
+        if not uris:
+            return []
+        return self._query("""\
+            select id, uri, property_name, property_value from property
+            where uri in (%s)
+            """ % ', '.join(['%s'] * len(uris)), *uris)
+
+    def select_property_uris(self):
+        return [row['uri'] for row in self._query(
+                    "select distinct uri from property")]
+
+    def insert_property(self, uri, name, value):
+        return self._insert("""\
+            insert into property (uri, property_name, property_value)
+            values (%s, %s, %s)
+            """, uri, name, value)
+
+    def patch_properties(self, uri, values, names):
+        # the last value of a property set twice wins
+        values = OrderedDict(values)
+        changed = values.keys() + [name for name in names 
+                                   if name not in values]
+        with self._transaction():
+            if changed:
+                self._update("""\
+                    DELETE FROM property
+                    WHERE uri = %s AND property_name IN (%s)
+                    """ % ('%s', ', '.join(['%s'] * len(changed))),
+                    uri, *changed)
+            items = values.items()
+            for i in range(0, len(items), INSERT_ROWS):
+                batch = items[i:i+INSERT_ROWS]
+                parameters = []
+                for name, value in batch:
+                    parameters.extend( (uri, name, value) )
+                self._update("""\
+                    INSERT INTO property (uri, property_name, property_value)
+                    VALUES %s
+                    """ % ', '.join(['(%s, %s, %s)'] * len(batch)),
+                    *parameters)
+            return self._query("""\
+                select id, uri, property_name, property_value from property
+                where uri = %s
+                """, uri)
+
+    def copy_properties(self, from_uri, to_uri, subtree=False):
+        where, parameters = self._subtree(from_uri, subtree)
+        from_base, to_base = self._bases(from_uri, to_uri, subtree)
+        with self._transaction():
+            self.delete_properties(to_uri, subtree)
+            return self._update("""\
+                INSERT INTO property
+                (uri, property_name, property_value)
+                SELECT %s, property_name, property_value
+                FROM property WHERE %s
+                """ % (self._concat('%s', 'SUBSTR(uri, %s)'), where), 
+                to_base, len(from_base) + 1, *parameters)
+
+    def move_properties(self, from_uri, to_uri, subtree=False):
+        where, parameters = self._subtree(from_uri, subtree)
+        from_base, to_base = self._bases(from_uri, to_uri, subtree)
+        with self._transaction():
+            self.delete_properties(to_uri, subtree)
+            return self._update("""\
+                UPDATE property
+                SET uri = %s
+                WHERE %s
+                """ % (self._concat('%s', 'SUBSTR(uri, %s)'), where),
+                to_base, len(from_base) + 1, *parameters)
+
+    def delete_properties(self, uri, subtree=False):
+        where, parameters = self._subtree(uri, subtree)
+        return self._update("""\
+            DELETE FROM property
+            WHERE %s
+            """ % where, *parameters)
+
+    def purge_properties(self, uri, limit):
+        where, parameters = self._subtree(uri, True)
+        # the derived table lets MySQL limit the selected ids
+        return self._update("""\
+            DELETE FROM property WHERE id IN (
+                SELECT id FROM (
+                    SELECT id FROM property WHERE %s LIMIT %%s
+                ) AS batch)
+            """ % where, *(parameters + [limit]))
+
+    def _subtree(self, uri, subtree):
+        """ where clause and parameters selecting uri, and all uris
+            below it if subtree, as ranges of the uri index
+        """
+        if not subtree:
+            return "uri = %s", [uri]
+        # the uris starting with prefix sort before prefix with
+        # its '/' replaced by the next character, '0'
+        prefix = uri.rstrip('/') + '/'
+        return "(uri = %s OR uri >= %s AND uri < %s)", \
+               [uri, prefix, prefix[:-1] + '0']
+
+    def _bases(self, from_uri, to_uri, subtree):
+        """ the parts of from_uri and to_uri replaced in the uris
+            moved or copied
+        """
+        if subtree:
+            return from_uri.rstrip('/'), to_uri.rstrip('/')
+        return from_uri, to_uri
+
+    def _concat(self, *expressions):
+        return "CONCAT(%s)" % ', '.join(expressions)
+
+    def select_users(self, realm):
+        return [(row['user_name'], row['user_hash']) for row in self._query("""\
+            SELECT user_name, user_hash
+            FROM users WHERE realm = %s""", realm)]
+
+    def dump(self, table):
+        """ all rows of a table """
+        return self._query("SELECT * FROM %s" % table)
+
+
+# indexed property table, uris are url quoted ascii compared as bytes
+MYSQL_PROPERTY_TABLE = """\
+    create table %s (
+        id int not null auto_increment primary key,
+        uri varchar(250) character set ascii collate ascii_bin not null,
+        property_name varchar(100) character set utf8 collate utf8_bin not null,
+        property_value text,
+        unique key property_uri (uri, property_name))"""
+
+MYSQL_PROPERTY_TRIGGERS = [
+    ("property_insert", """\
+        create trigger property_insert after insert on property for each row
+        replace into property_new (id, uri, property_name, property_value)
+        values (new.id, new.uri, new.property_name, new.property_value)"""),
+    ("property_update", """\
+        create trigger property_update after update on property for each row
+        replace into property_new (id, uri, property_name, property_value)
+        values (new.id, new.uri, new.property_name, new.property_value)"""),
+    ("property_delete", """\
+        create trigger property_delete after delete on property for each row
+        delete from property_new where id = old.id"""),
+    ]
+
+
+class ConnectionPool(object):
+    """ Pool of torndb connections shared by threads
+
+        A connection is taken for one statement, threads wait when all
+        of them are busy. A connection idle for longer than
+        ping_interval is checked before use and reconnected when the
+        server does not answer.
+    """
+
+    def __init__(self, connect, size=1, ping_interval=60):
+        self.ping_interval = ping_interval
+        self._idle = Queue.LifoQueue()
+        for i in range(size):
+            self._idle.put( (connect(), time.time()) )
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection, last_use = self._idle.get()
+        try:
+            if time.time() - last_use > self.ping_interval:
+                self._check(connection)
+            yield connection
+        finally:
+            self._idle.put( (connection, time.time()) )
+
+    def _check(self, connection):
+        try:
+            connection._db.ping()
+        except Exception:
+            connection.reconnect()
+
+
+class MySqlStorage(SqlStorage):
+    """ MySQL storage, see schema.sql for the tables
+
+        Statements run on a pool of pool_size connections, the 
+        executor should not have more threads than that.
+    """
+
+    def __init__(self, host, database, user=None, password=None, 
+                 pool_size=1, executor=None):
+        SqlStorage.__init__(self)
+        if torndb==None:
+            raise ImportError("MySQL storage needs the MySQLdb module")
+        self.executor = executor
+        self._pool = ConnectionPool(
+            lambda: torndb.Connection(host, database, user, password),
+            pool_size)
+        # connection of the transaction of each thread
+        self._local = threading.local()
+
+    def _execute(self, method, query, parameters):
+        self.queries += 1
+        connection = getattr(self._local, 'connection', None)
+        if connection!=None:
+            # a lost connection fails the whole transaction
+            return getattr(connection, method)(query, *parameters)
+        with self._pool.connection() as connection:
+            try:
+                return getattr(connection, method)(query, *parameters)
+            except torndb.OperationalError, why:
+                if why.args[0]!=CR_SERVER_GONE_ERROR:
+                    raise
+                # the connection was lost while idle, retry once
+                connection.reconnect()
+                return getattr(connection, method)(query, *parameters)
+
+    def _query(self, query, *parameters):
+        return self._execute('query', query, parameters)
+
+    def _insert(self, query, *parameters):
+        return self._execute('execute_lastrowid', query, parameters)
+
+    def _update(self, query, *parameters):
+        return self._execute('execute_rowcount', query, parameters)
+
+    def upgrade_property_table(self, batch_size=10000):
+        """ Move the property table to the indexed schema while the
+            server is running, return the number of rows copied or 
+            None when the table is already indexed.
+
+            The rows are copied in batches into a new table, triggers
+            on the old table replay the changes made meanwhile. The rows
+            with a value that is not a well formed element are then
+            deleted from the new table, which replaces the old one in
+            one RENAME, the old table is kept as property_old. Creating
+            triggers may need the SUPER privilege when binary logging
+            is on.
+        """
+        if self._query("show index from property where Key_name = %s",
+                       'property_uri'):
+            return None
+        self._update("drop table if exists property_new")
+        self._update(MYSQL_PROPERTY_TABLE % 'property_new')
+        for name, trigger in MYSQL_PROPERTY_TRIGGERS:
+            self._update(trigger)
+        try:
+            # newest rows first, the older duplicates are dropped
+            last = self._query("select max(id) as id from property")[0]['id']
+            copied = 0
+            while last!=None and last>0:
+                copied += self._update("""\
+                    insert ignore into property_new 
+                    (id, uri, property_name, property_value)
+                    select id, uri, property_name, property_value 
+                    from property where id <= %s and id > %s
+                    order by id desc lock in share mode
+                    """, last, last - batch_size)
+                last -= batch_size
+            copied -= self._delete_malformed('property_new', batch_size)
+            self._update("drop table if exists property_old")
+            self._update("""\
+                rename table property to property_old, 
+                property_new to property""")
+        finally:
+            for name, trigger in MYSQL_PROPERTY_TRIGGERS:
+                self._update("drop trigger if exists %s" % name)
+        return copied
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._pool.connection() as connection:
+            connection.execute("START TRANSACTION")
+            self._local.connection = connection
+            try:
+                yield
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
+            finally:
+                self._local.connection = None
+
+
+def _dict_factory(cursor, row):
+    return dict( (d[0], value) for d, value in zip(cursor.description, row) )
+
+class SqliteStorage(SqlStorage):
+    """ In process sqlite storage
+
+        The database is opened in WAL mode so readers do not block on
+        a writer, the tables and indexes are created when missing.
+        Statements are prepared once and kept in the connection
+        statement cache. The connection is shared by the executor
+        threads one statement at a time.
+    """
+
+    def __init__(self, filename, executor=None):
+        SqlStorage.__init__(self)
+        self.executor = executor
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(filename,
+                    isolation_level=None,
+                    check_same_thread=False,
+                    cached_statements=256)
+        self._db.row_factory = _dict_factory
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SQLITE_SCHEMA)
+
+    def _sql(self, query):
+        return query.replace('%s', '?')
+
+    def _concat(self, *expressions):
+        return "(%s)" % ' || '.join(expressions)
+
+    def _execute(self, query, parameters):
+        self.queries += 1
+        return self._db.execute(self._sql(query), parameters)
+
+    def _query(self, query, *parameters):
+        with self._lock:
+            return self._execute(query, parameters).fetchall()
+
+    def _insert(self, query, *parameters):
+        with self._lock:
+            return self._execute(query, parameters).lastrowid
+
+    def _update(self, query, *parameters):
+        with self._lock:
+            return self._execute(query, parameters).rowcount
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                yield
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def load(self, table, rows):
+        """ insert rows into a table in one transaction, a row replaces
+            the one loaded before it with the same unique key
+        """
+        if not rows:
+            return
+        columns = rows[0].keys()
+        query = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (table,
+                    ', '.join(columns), ', '.join(['?'] * len(columns)))
+        with self._transaction():
+            self._db.executemany(query,
+                [[row[column] for column in columns] for row in rows])
+
+    def close(self):
+        self._db.close()
+
+
+def migrate(source, target):
+    """ copy all tables of the source storage into an sqlite storage,
+        return the number of rows copied per table. Of the rows with
+        the same unique key, like the duplicate properties of a MySQL
+        table without the property_uri key, the newest is kept. The
+        properties with a value that is not a well formed element
+        are not copied
+    """
+    copied = {}
+    for table in TABLES:
+        rows = [dict(row) for row in source.dump(table)]
+        if table=='property':
+            rows = [row for row in rows
+                    if well_formed(row['property_value'])]
+        rows.sort(key=lambda row: row.get('id'))
+        target.load(table, rows)
+        copied[table] = len(rows)
+    return copied
@@ -0,0 +1,233 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+
+import tornado
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import SSLIOStream, StreamClosedError
+
+
+""" File download engine
+
+    Sends a region of a file on the connection of a request handler.
+    When possible the bytes are handed to the kernel with sendfile(2)
+    driven by the socket writability, otherwise the file is sent in
+    large chunks waiting for each chunk to be written to the socket
+    before reading the next one.
+"""
+
+CHUNK_SIZE = 64*1024
+SENDFILE_BLOCK = 1024*1024
+
+# errors of sendfile on a file it cannot send
+_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+# the HTTP1Connection of these tornado versions counts the body bytes
+# it still expects in the private _expected_content_remaining
+COUNTING_TORNADO = (4, 3) <= tornado.version_info[:2] < (7, 0)
+
+
+class SendfileUnsupported(IOError):
+    """ sendfile failed before sending anything """
+
+
+def expected_content(connection, sent=0):
+    """ body bytes the connection still expects once sent bytes
+        written around it are taken off, None when it is not known.
+        finish() checks the count against the Content-Length, a body
+        is only sent around the connection when it can be counted
+    """
+    if not COUNTING_TORNADO:
+        return None
+    remaining = getattr(connection, '_expected_content_remaining', None)
+    if remaining!=None and sent:
+        remaining -= sent
+        connection._expected_content_remaining = remaining
+    return remaining
+
+def _libc_sendfile():
+    """ sendfile(2) through libc for python versions without os.sendfile
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_sendfile = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_longlong(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(off), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+try:
+    _sendfile = os.sendfile
+except AttributeError:
+    try:
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = _libc_sendfile()
+
+
+def sendfile_supported():
+    return _sendfile!=None
+
+
+def multipart(ranges, size, content_type, boundary):
+    """ multipart/byteranges layout of ranges
+
+        return (parts, trailer, content length) where parts is a list of
+        (part header, offset, length) for each range
+    """
+    parts = []
+    total = 0
+    for first, last in ranges:
+        header = "\r\n--%s\r\nContent-Type: %s\r\n" \
+                 "Content-Range: bytes %d-%d/%d\r\n\r\n" % \
+                 (boundary, content_type, first, last, size)
+        length = last - first + 1
+        parts.append( (header, first, length) )
+        total += len(header) + length
+    trailer = "\r\n--%s--\r\n" % boundary
+    return (parts, trailer, total + len(trailer))
+
+
+class FileSender(object):
+    """ Send file regions on the connection of a request handler
+
+        The handler must have set all the response headers including
+        Content-Length, the sender flushes them before the first byte
+        of the file is sent.
+    """
+
+    def __init__(self, handler, use_sendfile=True, chunk_size=CHUNK_SIZE, 
+                 executor=None):
+        self.handler = handler
+        self.chunk_size = chunk_size
+        # file reads are done on the executor when given
+        self.executor = executor
+        self.stream = handler.request.connection.stream
+        # sendfile bypasses the ssl layer of the stream
+        self.use_sendfile = use_sendfile and sendfile_supported() and \
+            not isinstance(self.stream, SSLIOStream)
+
+    @gen.coroutine
+    def send(self, object_file, offset, length):
+        """ send length bytes of object_file starting at offset """
+        yield self.handler.flush()
+        if length<=0:
+            return
+        connection = self.handler.request.connection
+        remaining = expected_content(connection)
+        if self.use_sendfile and remaining!=None and remaining>=length:
+            try:
+                yield self._sendfile(object_file, offset, length)
+            except SendfileUnsupported:
+                # nothing was sent, the file cannot be sent this way
+                self.use_sendfile = False
+                yield self._send_chunks(object_file, offset, length)
+                return
+            # the body did not pass through the connection
+            expected_content(connection, length)
+        else:
+            yield self._send_chunks(object_file, offset, length)
+
+    @gen.coroutine
+    def send_parts(self, object_file, parts, trailer):
+        """ send a multipart body, parts is a list of
+            (part header, offset, length) as built by multipart()
+        """
+        for header, offset, length in parts:
+            self.handler.write(header)
+            yield self.send(object_file, offset, length)
+        self.handler.write(trailer)
+        yield self.handler.flush()
+
+    @gen.coroutine
+    def _send_chunks(self, object_file, offset, length):
+        object_file.seek(offset)
+        while length>0:
+            size = min(self.chunk_size, length)
+            if self.executor!=None:
+                buf = yield self.executor.submit(object_file.read, size)
+            else:
+                buf = object_file.read(size)
+            if buf=='':
+                # file was truncated while sending
+                raise IOError(errno.EIO, 'Unexpected end of file')
+            length -= len(buf)
+            self.handler.write(buf)
+            yield self.handler.flush()
+
+    def _sendfile(self, object_file, offset, length):
+        """ sendfile on a duplicate of the socket descriptor, the stream
+            keeps its own registration with the io loop
+        """
+        future = Future()
+        io_loop = IOLoop.current()
+        out_fd = os.dup(self.stream.socket.fileno())
+        in_fd = object_file.fileno()
+        state = {'offset': offset, 'remaining': length}
+
+        def done(error=None):
+            io_loop.remove_handler(out_fd)
+            os.close(out_fd)
+            if isinstance(error, SendfileUnsupported):
+                future.set_exception(error)
+            elif error!=None:
+                self.stream.close()
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+        def on_writable(fd, events):
+            try:
+                sent = _sendfile(out_fd, in_fd, state['offset'],
+                            min(state['remaining'], SENDFILE_BLOCK))
+            except (OSError, IOError), why:
+                if why.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                if why.errno in _UNSUPPORTED and state['offset']==offset:
+                    done(SendfileUnsupported(why.errno, why.strerror))
+                    return
+                done(StreamClosedError(real_error=why))
+                return
+            if sent==0:
+                # file was truncated while sending
+                done(IOError(errno.EIO, 'Unexpected end of file'))
+                return
+            state['offset'] += sent
+            state['remaining'] -= sent
+            if state['remaining']==0:
+                done()
+
+        io_loop.add_handler(out_fd, on_writable, IOLoop.WRITE)
+        return future
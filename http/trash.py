@@ -0,0 +1,161 @@
+#
+# Copyright 2012 ASAF
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+import uuid
+import errno
+from tornado import gen
+from tornado.concurrent import Future
+
+
+""" Trash of deleted collections
+
+    A deleted collection is renamed into the trash directory of the
+    data root and its dead properties are moved below the trash uri,
+    so the DELETE is answered without waiting for the tree to go.
+    The reaper then removes the files and the property rows a batch
+    at a time with a pause between batches. What is left in the trash
+    when the server stops is removed after it starts again.
+"""
+
+TRASH_NAME = '.dav-trash'
+TRASH_URI = '/%s/' % TRASH_NAME
+
+REAP_BATCH = 1000
+REAP_PAUSE = 0.1
+
+
+class Trash(object):
+    """ Trash directory of the data root and its reaper
+
+        File system batches run on the executor, property batches on
+        the storage executor, the reaper runs on the io loop.
+    """
+
+    def __init__(self, root, db, executor=None, batch=REAP_BATCH,
+                 pause=REAP_PAUSE):
+        self.directory = os.path.join(root, TRASH_NAME)
+        self.db = db
+        self.executor = executor
+        self.batch = batch
+        self.pause = pause
+        # removed so far
+        self.files = 0
+        self.rows = 0
+        self._paths = None
+        self._reaping = False
+
+    def put(self, path):
+        """ rename path into the trash and return its name in the
+            trash, raises os.error when it cannot be renamed there
+        """
+        try:
+            os.mkdir(self.directory)
+        except os.error, why:
+            if why.errno!=errno.EEXIST:
+                raise
+        name = '%x-%s' % (int(time.time()), uuid.uuid4().hex)
+        os.rename(path, os.path.join(self.directory, name))
+        return name
+
+    def uri(self, name):
+        """ uri of the properties of a trashed collection """
+        return TRASH_URI + name + '/'
+
+    @gen.coroutine
+    def reap(self):
+        """ remove what the trash holds, at startup and after each
+            put. Returns at once while a reap is running
+        """
+        if self._reaping:
+            return
+        self._reaping = True
+        try:
+            while True:
+                # done when a new walk finds nothing
+                fresh = self._paths==None
+                removed = yield self._submit(self._remove_batch)
+                if removed==0 and fresh:
+                    break
+                if removed:
+                    yield gen.sleep(self.pause)
+            while True:
+                rows = yield self.db.submit(self.db.purge_properties,
+                                            TRASH_URI, self.batch)
+                self.rows += rows
+                if rows < self.batch:
+                    break
+                yield gen.sleep(self.pause)
+        finally:
+            self._reaping = False
+
+    def stats(self):
+        try:
+            entries = len(os.listdir(self.directory))
+        except os.error:
+            entries = 0
+        return {'entries': entries,
+                'files': self.files,
+                'rows': self.rows,
+                'reaping': self._reaping,
+                'batch': self.batch}
+
+    def _submit(self, method, *args):
+        if self.executor!=None:
+            return self.executor.submit(method, *args)
+        future = Future()
+        future.set_result(method(*args))
+        return future
+
+    def _remove_batch(self):
+        """ remove up to batch paths of the trash, the number removed.
+            A walk goes on with the next batch, a new one starts when
+            it is done so the collections trashed meanwhile are found
+        """
+        removed = 0
+        if self._paths==None:
+            self._paths = self._walk()
+        for path, directory in self._paths:
+            try:
+                if directory:
+                    os.rmdir(path)
+                else:
+                    os.unlink(path)
+            except os.error:
+                continue
+            removed += 1
+            if removed >= self.batch:
+                break
+        else:
+            self._paths = None
+        self.files += removed
+        return removed
+
+    def _walk(self):
+        """ (path, is a directory) below the trash directory, each
+            directory after what it holds
+        """
+        for parent, dirnames, filenames in os.walk(self.directory,
+                                                   topdown=False):
+            for name in filenames:
+                yield os.path.join(parent, name), False
+            for name in dirnames:
+                path = os.path.join(parent, name)
+                # not walked into
+                if os.path.islink(path):
+                    yield path, False
+            if parent!=self.directory:
+                yield parent, True
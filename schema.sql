@@ -13,9 +13,10 @@ create table locks (
 drop table if exists property;
 create table property(
     id int not null auto_increment primary key, 
-    uri varchar(250) not null, 
-    property_name varchar(100) not null, 
-    property_value text);
+    uri varchar(250) character set ascii collate ascii_bin not null, 
+    property_name varchar(100) character set utf8 collate utf8_bin not null, 
+    property_value text,
+    unique key property_uri (uri, property_name));
 
 
 drop table if exists users;
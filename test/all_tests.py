@@ -3,12 +3,33 @@ import unittest
 from ifheader_test import *
 from propfind_test import *
 from lock_test import *
+from rangeheader_test import *
+from storage_test import *
+from multistatus_test import *
+from file_object_test import *
+from metacache_test import *
+from copyengine_test import *
+from trash_test import *
+from jobs_test import *
+from contentcache_test import *
+from handler_test import *
 
 def suite():
     suite = unittest.TestSuite = [
         unittest.TestLoader().loadTestsFromTestCase(TestIfHeader),
         unittest.TestLoader().loadTestsFromTestCase(TestPropfind),
         unittest.TestLoader().loadTestsFromTestCase(TestLock),
+        unittest.TestLoader().loadTestsFromTestCase(TestRangeHeader),
+        unittest.TestLoader().loadTestsFromTestCase(TestStorage),
+        unittest.TestLoader().loadTestsFromTestCase(TestMultistatus),
+        unittest.TestLoader().loadTestsFromTestCase(TestFileObject),
+        unittest.TestLoader().loadTestsFromTestCase(TestMetadataCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestCopyEngine),
+        unittest.TestLoader().loadTestsFromTestCase(TestTrash),
+        unittest.TestLoader().loadTestsFromTestCase(TestJobs),
+        unittest.TestLoader().loadTestsFromTestCase(TestContentCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestHandler),
+        unittest.TestLoader().loadTestsFromTestCase(TestUpload),
         ]
     return suite
 
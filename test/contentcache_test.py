@@ -0,0 +1,111 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from http.contentcache import ContentCache, validator
+from http.file_object import FileObject
+
+
+class Application(object):
+    def __init__(self, directory, content_cache):
+        self.directory = directory
+        self.content_cache = content_cache
+
+
+class TestContentCache ( unittest.TestCase ):
+
+    def setUp(self):
+        self.cache = ContentCache(budget=250, max_file=100)
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'col'))
+        for name in ('a', 'b', 'c'):
+            self.write(name, name * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, *names):
+        return os.path.join(self.root, 'col', *names)
+
+    def write(self, name, content):
+        with open(self.path(name), 'w') as f:
+            f.write(content)
+
+    def read(self, name):
+        return self.cache.read(self.path(name), self.valid(name))
+
+    def valid(self, name):
+        return validator(os.stat(self.path(name)))
+
+    def test_lru(self):
+        valid = self.valid('a')
+        assert self.read('a') == 'a' * 100
+        # served from memory
+        os.unlink(self.path('a'))
+        assert self.cache.read(self.path('a'), valid) == 'a' * 100
+        self.read('b')
+        self.read('c')
+        # a is the least recently used
+        assert self.cache.get(self.path('a'), valid)[0] == None
+        assert self.cache.get(self.path('b'), self.valid('b'))[0] == 'b' * 100
+        stats = self.cache.stats()
+        assert (stats['hits'], stats['misses']) == (2, 4)
+        assert stats['hit_rate'] == 2 / 6.0
+        assert (stats['entries'], stats['bytes']) == (2, 200)
+
+    def test_changed(self):
+        self.read('a')
+        self.write('a', 'changed')
+        assert self.read('a') == 'changed'
+        assert self.cache.stats()['bytes'] == 7
+
+        # rewritten within the same second, with the same size
+        stat = os.stat(self.path('a'))
+        self.write('a', 'CHANGED')
+        os.utime(self.path('a'), (stat.st_atime, int(stat.st_mtime) + 0.5))
+        assert self.read('a') == 'CHANGED'
+        # replaced by another file
+        os.rename(self.path('b'), self.path('a'))
+        os.utime(self.path('a'), (stat.st_atime, int(stat.st_mtime) + 0.5))
+        assert self.read('a') == 'b' * 100
+
+    def test_grown(self):
+        valid = self.valid('a')
+        # larger than max_file since it was stated
+        self.write('a', 'a' * 1000)
+        assert self.cache.read(self.path('a'), valid) == None
+        assert self.cache.stats()['entries'] == 0
+
+    def test_invalidate(self):
+        content, generation = self.cache.get(self.path('a'), self.valid('a'))
+        # changed while it was read
+        self.cache.invalidate(self.path())
+        self.cache.load(self.path('a'), generation)
+        assert self.cache.stats()['entries'] == 0
+
+        self.read('a')
+        self.read('b')
+        self.cache.invalidate(self.path(), True)
+        assert self.cache.stats()['entries'] == 0
+
+    def test_file_object(self):
+        application = Application(self.root, self.cache)
+        a = FileObject(application, 'col', 'a')
+        assert self.cache.read(a.filename, validator(a)) == 'a' * 100
+        a.write('new')
+        assert self.cache.stats()['entries'] == 0
+
+        b = FileObject(application, 'col', 'b')
+        self.cache.read(b.filename, validator(b))
+        collection = FileObject(application, 'col', '')
+        assert collection.move(os.path.join(self.root, 'other')) == 201
+        assert self.cache.stats()['entries'] == 0
+
+    def test_disabled(self):
+        assert not ContentCache(0).fits(1)
+        assert not self.cache.fits(101)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import os
+import errno
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from http import copyengine
+from http.copyengine import copy_file, copy_tree
+from http.file_object import FileObject
+
+
+class Application(object):
+    def __init__(self, directory, copy_executor=None):
+        self.directory = directory
+        self.copy_executor = copy_executor
+
+
+class TestCopyEngine ( unittest.TestCase ):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'col')
+        os.makedirs(os.path.join(self.source, 'sub', 'deep'))
+        os.mkdir(os.path.join(self.source, '.dav-hidden'))
+        for i, name in enumerate(('a.txt', 'sub/b.txt', 'sub/deep/c.txt')):
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(name * (i * 1000 + 1))
+        os.chmod(os.path.join(self.source, 'a.txt'), 0640)
+        os.symlink('a.txt', os.path.join(self.source, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self, *path):
+        with open(os.path.join(*path)) as f:
+            return f.read()
+
+    def test_copy_tree(self):
+        executor = ThreadPoolExecutor(4)
+        try:
+            destination = os.path.join(self.root, 'dest')
+            os.mkdir(destination)
+            failures = copy_tree(self.source, destination, executor, '.dav-')
+        finally:
+            executor.shutdown()
+        assert failures == []
+        assert sorted(os.listdir(destination)) == ['a.txt', 'link', 'sub']
+        for name in ('a.txt', 'sub/b.txt', 'sub/deep/c.txt'):
+            assert self.read(destination, name) == self.read(self.source, name)
+        assert os.readlink(os.path.join(destination, 'link')) == 'a.txt'
+        assert os.stat(os.path.join(destination, 'a.txt')).st_mode & 0777 \
+            == 0640
+        assert int(os.stat(os.path.join(destination, 'sub')).st_mtime) == \
+            int(os.stat(os.path.join(self.source, 'sub')).st_mtime)
+
+    def test_sparse(self):
+        source = os.path.join(self.root, 'sparse')
+        with open(source, 'w') as f:
+            f.write('head')
+            f.seek(64*1024*1024)
+            f.write('middle')
+            f.truncate(128*1024*1024)
+        if os.stat(source).st_blocks * 512 > 1024*1024:
+            self.skipTest('the file system does not make holes')
+
+        # copy the ranges without reflinks
+        clone = copyengine._clone
+        copyengine._clone = lambda fd_in, fd_out: False
+        try:
+            destination = os.path.join(self.root, 'copy')
+            assert copy_file(source, destination) == 128*1024*1024
+        finally:
+            copyengine._clone = clone
+
+        stat = os.stat(destination)
+        assert stat.st_size == 128*1024*1024
+        assert stat.st_blocks * 512 <= 1024*1024
+        with open(destination) as f:
+            assert f.read(4) == 'head'
+            f.seek(64*1024*1024)
+            assert f.read(6) == 'middle'
+            assert f.read(1024) == '\0' * 1024
+
+    def test_read_write(self):
+        copy_file_range = copyengine._copy_file_range
+        copyengine._copy_file_range = None
+        try:
+            destination = os.path.join(self.root, 'copy')
+            copy_file(os.path.join(self.source, 'sub/deep/c.txt'), destination)
+        finally:
+            copyengine._copy_file_range = copy_file_range
+        assert self.read(destination) == \
+            self.read(self.source, 'sub/deep/c.txt')
+
+    def test_failures(self):
+        copy = copyengine.copy_file
+        def failing(source, destination):
+            if source.endswith('b.txt'):
+                raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+            return copy(source, destination)
+
+        copyengine.copy_file = failing
+        try:
+            rc = FileObject(Application(self.root), 'col', '').copy(
+                os.path.join(self.root, 'other'))
+        finally:
+            copyengine.copy_file = copy
+
+        assert rc[0] == 207
+        assert [(r.findtext('{DAV:}href'), r.findtext('{DAV:}status'))
+                for r in rc[1]] == \
+            [('/other/sub/b.txt', 'HTTP/1.1 507 Insufficient Storage')]
+        # the others are copied
+        assert self.read(self.root, 'other', 'sub', 'deep', 'c.txt') == \
+            self.read(self.source, 'sub', 'deep', 'c.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+import os
+import errno
+import shutil
+import tempfile
+
+from http.file_object import FileObject
+
+
+class Application(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+
+class TestFileObject ( unittest.TestCase ):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'col', 'sub'))
+        os.mkdir(os.path.join(self.root, 'col', '.dav-hidden'))
+        for name in ('a.txt', 'b.txt'):
+            open(os.path.join(self.root, 'col', name), 'w').close()
+        self.application = Application(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_childs(self):
+        collection = FileObject(self.application, 'col', '')
+        assert collection.exists and collection.collection
+
+        stats = []
+        stat = os.stat
+        def counted(path):
+            stats.append(path)
+            return stat(path)
+        os.stat = counted
+        try:
+            childs = collection.childs()
+        finally:
+            os.stat = stat
+
+        assert sorted(child.uri for child in childs) == \
+            ['/col/a.txt', '/col/b.txt', '/col/sub/']
+        assert [child.uri for child in childs if child.collection] == \
+            ['/col/sub/']
+        assert all(child.exists for child in childs)
+        # at most the stat of the listing for each entry
+        assert len(stats) <= len(os.listdir(collection.filename))
+
+    def test_etag(self):
+        first = FileObject(self.application, 'col', 'a.txt')
+        second = FileObject(self.application, 'col', 'a.txt')
+        assert first._etag == None
+        assert first.etag == second.etag
+        assert first.etag != FileObject(self.application, 'col', 'b.txt').etag
+
+        missing = FileObject(self.application, 'col', 'missing.txt')
+        assert not missing.exists and not missing.collection
+        assert missing.etag.startswith('"')
+
+    def test_move(self):
+        col = os.path.join(self.root, 'col')
+        open(os.path.join(col, 'sub', 'c.txt'), 'w').close()
+        inode = os.stat(os.path.join(col, 'sub', 'c.txt')).st_ino
+        os.makedirs(os.path.join(self.root, 'dest', 'old'))
+
+        source = FileObject(self.application, 'col', '')
+        destination = os.path.join(self.root, 'dest')
+        assert source.move(destination) == 412
+        assert source.move(destination, 'T') == 201
+        # renamed, the old destination is gone
+        assert not os.path.exists(col)
+        assert sorted(os.listdir(destination)) == \
+            ['.dav-hidden', 'a.txt', 'b.txt', 'sub']
+        assert os.stat(os.path.join(destination, 'sub', 'c.txt')).st_ino \
+            == inode
+        assert os.listdir(self.root) == ['dest']
+
+        source = FileObject(self.application, 'dest', 'a.txt')
+        target = os.path.join(destination, 'b.txt')
+        assert source.move(target) == 412
+        assert source.move(target, 'T') == 204
+        assert sorted(os.listdir(destination)) == \
+            ['.dav-hidden', 'b.txt', 'sub']
+
+    def test_move_on_directory(self):
+        col = os.path.join(self.root, 'col')
+        open(os.path.join(col, 'sub', 'c.txt'), 'w').close()
+        source = FileObject(self.application, 'col', 'a.txt')
+        target = os.path.join(col, 'sub')
+        # the directory and what it holds are kept
+        assert source.move(target, 'F') == 412
+        assert source.move(target) == 412
+        assert os.listdir(target) == ['c.txt']
+        assert os.path.exists(os.path.join(col, 'a.txt'))
+
+        assert source.move(target, 'T') == 204
+        assert os.path.isfile(target)
+        assert not os.path.exists(os.path.join(col, 'a.txt'))
+
+    def test_move_across(self):
+        rename = os.rename
+        col = os.path.join(self.root, 'col')
+        def cross_device(src, dst):
+            if src.startswith(col):
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            return rename(src, dst)
+        os.mkdir(os.path.join(self.root, 'dest'))
+        os.rename = cross_device
+        try:
+            source = FileObject(self.application, 'col', '')
+            rc = source.move(os.path.join(self.root, 'dest'), 'T')
+        finally:
+            os.rename = rename
+        assert rc == 201
+        assert sorted(os.listdir(self.root)) == ['dest']
+        assert sorted(os.listdir(os.path.join(self.root, 'dest'))) == \
+            ['.dav-hidden', 'a.txt', 'b.txt', 'sub']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,355 @@
+import unittest
+import os
+import sys
+import errno
+import json
+import shutil
+import tempfile
+import threading
+from tornado import gen
+from tornado.http1connection import HTTP1Connection
+from tornado.testing import AsyncHTTPTestCase
+
+from http import stream
+from http.auth import BasicAuth
+from http.file_object import FileObject
+from http.handler import MAX_UPLOAD
+from http.jobs import JobQueue
+from http.server import DavApplication
+from http.storage import SqliteStorage
+
+
+class HandlerTestCase ( AsyncHTTPTestCase ):
+    """ requests to a server on a temporary root """
+
+    auth = None
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'col'))
+        AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        AsyncHTTPTestCase.tearDown(self)
+        for executor in (self._app.executor, self._app.copy_executor,
+                         self._app.jobs.executor):
+            executor.shutdown()
+        shutil.rmtree(self.root)
+
+    def get_app(self):
+        return DavApplication(self.root, self.auth,
+                              SqliteStorage(':memory:'), {})
+
+    def write(self, name, content):
+        with open(os.path.join(self.root, 'col', name), 'wb') as f:
+            f.write(content)
+
+    def request(self, method, path, body=None, **headers):
+        return self.fetch(path, method=method, body=body, headers=headers,
+                          allow_nonstandard_methods=True)
+
+
+class TestHandler ( HandlerTestCase ):
+
+    def setUp(self):
+        HandlerTestCase.setUp(self)
+        # larger than the files of the content cache
+        self.content = ''.join(chr(i % 251) for i in range(3*1024*1024 + 7))
+        self.write('big', self.content)
+
+    def test_sendfile(self):
+        if not stream.sendfile_supported():
+            self.skipTest('sendfile is not available')
+        calls = []
+        sendfile = stream._sendfile
+        def counting(*args):
+            calls.append(args)
+            return sendfile(*args)
+        stream._sendfile = counting
+        try:
+            response = self.request('GET', '/col/big')
+        finally:
+            stream._sendfile = sendfile
+        assert response.code == 200
+        assert response.headers['Content-Length'] == str(len(self.content))
+        assert response.body == self.content
+        assert calls
+
+    def test_sendfile_unsupported(self):
+        def unsupported(*args):
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        sendfile = stream._sendfile
+        stream._sendfile = unsupported
+        try:
+            response = self.request('GET', '/col/big')
+        finally:
+            stream._sendfile = sendfile
+        assert response.code == 200
+        assert response.headers['Content-Length'] == str(len(self.content))
+        assert response.body == self.content
+
+    def test_sendfile_uncounted(self):
+        # the installed tornado counts the body in the private counter
+        assert stream.COUNTING_TORNADO
+        calls = []
+        sendfile = stream._sendfile
+        def counting(*args):
+            calls.append(args)
+            return sendfile(*args)
+        stream._sendfile = counting
+        stream.COUNTING_TORNADO = False
+        try:
+            response = self.request('GET', '/col/big')
+        finally:
+            stream._sendfile = sendfile
+            stream.COUNTING_TORNADO = True
+        # other versions get the body through the connection
+        assert response.code == 200
+        assert response.body == self.content
+        assert calls == []
+
+    def test_range(self):
+        response = self.request('GET', '/col/big', Range='bytes=10-19')
+        assert response.code == 206
+        assert response.headers['Content-Range'] == \
+            'bytes 10-19/%d' % len(self.content)
+        assert response.headers['Content-Length'] == '10'
+        assert response.body == self.content[10:20]
+
+    def test_multiple_ranges(self):
+        response = self.request('GET', '/col/big', Range='bytes=0-4,-5')
+        assert response.code == 206
+        content_type = response.headers['Content-Type']
+        assert content_type.startswith('multipart/byteranges; boundary=')
+        boundary = content_type.split('=', 1)[1]
+        assert response.headers['Content-Length'] == str(len(response.body))
+        parts = response.body.split('--%s' % boundary)
+        assert parts[0] == '\r\n' and parts[-1] == '--\r\n'
+        assert [part.split('\r\n\r\n', 1)[1][:-2] for part in parts[1:-1]] \
+            == [self.content[:5], self.content[-5:]]
+        assert 'Content-Range: bytes 0-4/%d' % len(self.content) in parts[1]
+
+    def test_unsatisfiable_range(self):
+        response = self.request('GET', '/col/big',
+                                Range='bytes=%d-' % len(self.content))
+        assert response.code == 416
+        assert response.headers['Content-Range'] == \
+            'bytes */%d' % len(self.content)
+
+    def test_if_range(self):
+        etag = self.request('HEAD', '/col/big').headers['Etag']
+        response = self.request('GET', '/col/big', Range='bytes=0-1',
+                                **{'If-Range': etag})
+        assert response.code == 206 and response.body == self.content[:2]
+
+        response = self.request('GET', '/col/big', Range='bytes=0-1',
+                                **{'If-Range': '"other"'})
+        assert response.code == 200
+        assert response.body == self.content
+
+    def test_content_cache(self):
+        self._app.metadata.start(self.io_loop)
+        self.write('small', 'first')
+        assert self.request('GET', '/col/small').body == 'first'
+        # rewritten by another within the second
+        stat = os.stat(os.path.join(self.root, 'col', 'small'))
+        self.write('small', 'again')
+        os.utime(os.path.join(self.root, 'col', 'small'),
+                 (stat.st_atime, int(stat.st_mtime) + 0.5))
+        # the metadata cache hears of it from inotify
+        self.io_loop.run_sync(lambda: gen.sleep(0.05))
+        assert self.request('GET', '/col/small').body == 'again'
+        # grown over the largest file kept
+        self.write('small', 'x' * (self._app.content_cache.max_file + 1))
+        self.io_loop.run_sync(lambda: gen.sleep(0.05))
+        response = self.request('GET', '/col/small')
+        assert response.body == 'x' * (self._app.content_cache.max_file + 1)
+
+    def test_hidden(self):
+        os.mkdir(os.path.join(self.root, 'col', 'sub'))
+        self.write('sub/f', 'deleted')
+        # keep the deleted files in the trash
+        self._app.trash.reap = lambda: None
+        assert self.request('DELETE', '/col/sub/').code == 204
+        trashed = os.listdir(os.path.join(self.root, '.dav-trash'))
+        # the trash is not reachable before the reaper is done
+        for method, path in (('PROPFIND', '/.dav-trash/'),
+                             ('GET', '/.dav-trash/%s/f' % trashed[0]),
+                             ('GET', '/.dav-trash'),
+                             ('OPTIONS', '/.dav-trash'),
+                             ('GET', '/col/%2Edav-upload-x'),
+                             ('PUT', '/col/.dav-upload-evil'),
+                             ('MKCOL', '/.dav-trash/new/'),
+                             ('DELETE', '/.dav-trash/')):
+            response = self.request(method, path, '' if method=='PUT' else None,
+                                    Depth='1')
+            assert response.code == 404, (method, path, response.code)
+        assert not os.path.exists(
+                    os.path.join(self.root, 'col', '.dav-upload-evil'))
+        response = self.request('COPY', '/col/big',
+                        Destination='http://localhost/col/.dav-upload-x')
+        assert response.code == 403
+
+    def test_move_replace(self):
+        for name in ('src', 'dst', 'dst/sub'):
+            os.mkdir(os.path.join(self.root, 'col', name))
+        self.write('src/new', 'new')
+        self.write('dst/sub/old', 'old')
+        reaps = []
+        self._app.trash.reap = lambda: reaps.append(True)
+        response = self.request('MOVE', '/col/src/', Overwrite='T',
+                                Destination='http://localhost/col/dst/')
+        assert response.code == 201
+        assert sorted(os.listdir(os.path.join(self.root, 'col'))) == \
+            ['big', 'dst']
+        assert os.listdir(os.path.join(self.root, 'col', 'dst')) == ['new']
+        # the replaced tree is left to the reaper
+        trashed = os.listdir(os.path.join(self.root, '.dav-trash'))
+        assert len(trashed) == 1
+        assert os.path.exists(os.path.join(self.root, '.dav-trash',
+                                           trashed[0], 'old', 'sub', 'old'))
+        assert reaps == [True]
+
+    def test_job_locks(self):
+        self.write('a', 'a')
+        self.write('c', 'c')
+        self._app.jobs.executor.shutdown()
+        self._app.jobs = JobQueue(1)
+        release = threading.Event()
+        copy = FileObject.copy
+        def slow(dav_object, *args):
+            release.wait(10)
+            return copy(dav_object, *args)
+        FileObject.copy = slow
+        try:
+            first = self.request('COPY', '/col/a', Prefer='respond-async',
+                                 Destination='http://localhost/col/b')
+            second = self.request('COPY', '/col/big', Prefer='respond-async',
+                        Overwrite='T', Destination='http://localhost/col/c')
+            assert (first.code, second.code) == (202, 202)
+            # locked while the second waits for the worker
+            response = self.request('LOCK', '/col/c',
+                '<D:lockinfo xmlns:D="DAV:"><D:lockscope><D:exclusive/>'
+                '</D:lockscope><D:locktype><D:write/></D:locktype>'
+                '</D:lockinfo>', Timeout='Second-60')
+            assert response.code == 200
+        finally:
+            release.set()
+            FileObject.copy = copy
+        jobs = [self._app.jobs.get(json.loads(response.body)['id'])
+                for response in (first, second)]
+        @gen.coroutine
+        def finished():
+            while jobs[1].finished==None:
+                yield gen.sleep(0.01)
+        self.io_loop.run_sync(finished, timeout=10)
+        assert (jobs[0].status, jobs[1].status) == (201, 423)
+        with open(os.path.join(self.root, 'col', 'c')) as f:
+            assert f.read() == 'c'
+
+    def test_blocking_work(self):
+        # a slow file system call does not hold the other requests
+        release = threading.Event()
+        mkcol = FileObject.mkcol
+        def slow(dav_object):
+            release.wait(10)
+            return mkcol(dav_object)
+        FileObject.mkcol = slow
+        try:
+            created = self.http_client.fetch(self.get_url('/col/sub/'),
+                                             method='MKCOL',
+                                             allow_nonstandard_methods=True)
+            response = self.request('GET', '/col/big', Range='bytes=0-0')
+            assert response.code == 206
+            assert not created.done()
+            release.set()
+            self.io_loop.add_future(created, self.stop)
+            self.wait()
+        finally:
+            FileObject.mkcol = mkcol
+            release.set()
+        assert created.result().code == 201
+        assert os.path.isdir(os.path.join(self.root, 'col', 'sub'))
+
+
+class TestUpload ( HandlerTestCase ):
+
+    auth = BasicAuth({'user': BasicAuth({}, 'dav').compute_hash(
+                                'user', 'dav', 'secret')}, 'dav')
+    credentials = 'Basic ' + 'user:secret'.encode('base64').strip()
+
+    def setUp(self):
+        HandlerTestCase.setUp(self)
+        self.uploads = []
+        self.upload = FileObject.upload
+        def upload(dav_object):
+            self.uploads.append(dav_object.filename)
+            return self.upload(dav_object)
+        FileObject.upload = upload
+
+    def tearDown(self):
+        FileObject.upload = self.upload
+        HandlerTestCase.tearDown(self)
+
+    def test_put(self):
+        response = self.request('PUT', '/col/a', 'content',
+                                Authorization=self.credentials)
+        assert response.code == 201
+        with open(os.path.join(self.root, 'col', 'a')) as f:
+            assert f.read() == 'content'
+
+    def test_unauthenticated(self):
+        response = self.request('PUT', '/col/a', 'x' * 1024*1024)
+        assert response.code == 401
+        assert 'WWW-Authenticate' in response.headers
+        # refused before any of the body was written
+        assert self.uploads == []
+        assert os.listdir(os.path.join(self.root, 'col')) == []
+
+        response = self.request('PUT', '/col/a', 'x',
+                    Authorization='Basic ' + 'user:bad'.encode('base64').strip())
+        assert response.code == 403
+        assert self.uploads == []
+
+    def test_too_large(self):
+        self._app.max_upload = 16
+        response = self.request('PUT', '/col/a', 'x' * 17,
+                                Authorization=self.credentials)
+        assert response.code == 400
+        assert self.uploads == []
+
+        # a chunked body is cut when it goes over
+        @gen.coroutine
+        def body(write):
+            for i in range(4):
+                yield write('x' * 8)
+        try:
+            response = self.fetch('/col/a', method='PUT', body_producer=body,
+                        headers={'Authorization': self.credentials})
+            assert response.code != 201
+        except IOError:
+            # the connection was closed before the answer
+            pass
+        assert os.listdir(os.path.join(self.root, 'col')) == []
+
+    def test_unlimited(self):
+        assert self._app.max_upload == MAX_UPLOAD
+        sizes = []
+        set_max_body_size = HTTP1Connection.set_max_body_size
+        def recording(connection, size):
+            sizes.append(size)
+            return set_max_body_size(connection, size)
+        HTTP1Connection.set_max_body_size = recording
+        self._app.max_upload = 0
+        try:
+            response = self.request('PUT', '/col/a', 'x' * 17,
+                                    Authorization=self.credentials)
+        finally:
+            HTTP1Connection.set_max_body_size = set_max_body_size
+        assert response.code == 201
+        # over the 100MB default of tornado too
+        assert sizes == [sys.maxsize]
+
+
+if __name__ == '__main__':
+    unittest.main()
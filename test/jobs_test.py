@@ -0,0 +1,116 @@
+import unittest
+import os
+import shutil
+import tempfile
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from http.file_object import FileObject
+from http.jobs import Job, JobQueue, DONE, FAILED, QUEUED
+
+
+class Application(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+
+class TestJobs ( unittest.TestCase ):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'col', 'sub'))
+        for i, name in enumerate(('a', 'b', 'sub/c')):
+            with open(os.path.join(self.root, 'col', name), 'w') as f:
+                f.write('x' * (i * 100 + 1))
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close()
+        shutil.rmtree(self.root)
+
+    def wait(self, job):
+        @gen.coroutine
+        def finished():
+            while job.finished==None:
+                yield gen.sleep(0.01)
+        self.io_loop.run_sync(finished, timeout=10)
+
+    def test_copy(self):
+        jobs = JobQueue(1)
+        collection = FileObject(Application(self.root), 'col', '')
+        job = Job('COPY', '/col/', '/other/')
+        assert job.info()['state'] == QUEUED
+
+        def work(job):
+            return jobs.executor.submit(job.call, collection.copy,
+                        os.path.join(self.root, 'other'), None, job)
+
+        self.io_loop.add_callback(jobs.submit, job, work)
+        self.wait(job)
+        jobs.executor.shutdown()
+
+        info = jobs.get(job.id).info()
+        assert info['state'] == DONE
+        assert info['status'] == 201
+        assert info['files'] == 3
+        assert info['bytes'] == 1 + 101 + 201
+        assert info['errors'] == []
+        assert os.path.exists(os.path.join(self.root, 'other', 'sub', 'c'))
+        assert jobs.stats()[DONE] == 1
+
+    def test_queue(self):
+        jobs = JobQueue(1, queue_size=1, keep=1)
+        jobs.executor.shutdown()
+        pending = Future()
+        first, second = Job('MOVE', '/a', '/b'), Job('MOVE', '/a', '/c')
+
+        @gen.coroutine
+        def submit():
+            assert jobs.submit(first, lambda job: pending)
+            # full until the first is done
+            assert not jobs.submit(second, lambda job: pending)
+            pending.set_result((207, [('/b/x', 'HTTP/1.1 507 Insufficient'
+                                                ' Storage')]))
+        self.io_loop.run_sync(submit)
+        self.wait(first)
+        assert first.state == FAILED
+        assert first.info()['errors'] == \
+            [{'href': '/b/x', 'status': 'HTTP/1.1 507 Insufficient Storage'}]
+
+        self.io_loop.run_sync(lambda: gen.maybe_future(
+                    jobs.submit(second, lambda job: gen.maybe_future(204))))
+        self.wait(second)
+        assert second.state == DONE
+        # the oldest finished job is forgotten
+        assert jobs.get(first.id) == None
+        assert jobs.get(second.id) is second
+
+    def test_start(self):
+        jobs = JobQueue(1)
+        jobs.executor.shutdown()
+        pending = Future()
+        started = []
+        first, second = Job('COPY', '/a', '/b'), Job('COPY', '/a', '/c')
+
+        def work(job):
+            started.append(job)
+            return pending if job is first else gen.maybe_future(201)
+
+        @gen.coroutine
+        def submit():
+            assert jobs.submit(first, work)
+            assert jobs.submit(second, work)
+            yield gen.moment
+            # waits for the worker of the first
+            assert started == [first]
+            assert second.state == QUEUED
+            pending.set_result(201)
+        self.io_loop.run_sync(submit)
+        self.wait(second)
+        assert started == [first, second]
+        assert second.state == DONE
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,33 @@
 import unittest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.ioloop import IOLoop
+
 from http.dav.lock import *
+from http.storage import SqliteStorage
+
+
+class LocksDb(SqliteStorage):
+    """ locks table in memory, records the statements """
+    def __init__(self):
+        self.statements = []
+        SqliteStorage.__init__(self, ':memory:')
+
+    def _record(self, query):
+        self.statements.append(query.split()[0].lower())
+
+    def _query(self, query, *parameters):
+        self._record(query)
+        return SqliteStorage._query(self, query, *parameters)
+
+    def _insert(self, query, *parameters):
+        self._record(query)
+        return SqliteStorage._insert(self, query, *parameters)
+
+    def _update(self, query, *parameters):
+        self._record(query)
+        return SqliteStorage._update(self, query, *parameters)
 
 
 class TestLock ( unittest.TestCase ):
@@ -116,5 +144,165 @@ class TestLock ( unittest.TestCase ):
         assert l==[]
         l = lock.dependent_lock('/webdav/')
         assert l!=[]
-        
-        
+
+
+    def test_index(self):
+        lock = Lockdb()
+        owner = u'<D:href xmlns:D="DAV:">http://example.org/~ejw/contact.html</D:href>'
+        lock._locks = [
+            Lock(resource=u'/webdav/a+b/', created=1326985790L, depth=None, 
+                 token=u'aaaa', timeout=None, owner=owner, scope=1L, id=1L),
+            Lock(resource=u'/webdav/test1', created=1326985790L, depth=None, 
+                 token=u'bbbb', timeout=None, owner=owner, scope=0L, id=2L),
+            Lock(resource=u'/webdav/test1/sub/t.txt', created=1326985790L, depth=0, 
+                 token=u'cccc', timeout=None, owner=owner, scope=0L, id=3L),
+            ]
+
+        assert lock.getbytoken(u'bbbb').id == 2
+        assert lock.getbyid(3L).token == u'cccc'
+        assert lock.getbytoken(u'dddd') == None
+
+        # resource names are not patterns
+        l = lock.all_locks('/webdav/a+b/x.txt')
+        assert [x.id for x in l] == [1]
+        l = lock.all_locks('/webdav/aab/x.txt')
+        assert l == []
+
+        # a lock covers path segments not string prefixes
+        l = lock.all_locks('/webdav/test12/t.txt')
+        assert l == []
+        l = lock.all_locks('/webdav/test1/sub/t.txt')
+        assert sorted(x.id for x in l) == [2, 3]
+        # collection with or without trailing slash
+        l = lock.all_locks('/webdav/test1/')
+        assert [x.id for x in l] == [2]
+
+        l = lock.dependent_lock('/webdav/')
+        assert sorted(x.id for x in l) == [1, 2, 3]
+        l = lock.dependent_lock('/webdav/test1/')
+        assert [x.id for x in l] == [3]
+        l = lock.conflict_lock('/webdav/test1/')
+        assert l == []
+        l = lock.dependent_lock('/other/')
+        assert l == []
+
+
+    def test_incremental(self):
+        db = LocksDb()
+        lock = Lockdb(db)
+        assert db.statements == ['delete', 'select']
+
+        lockid = lock.add_lock(u'/webdav/test1/', SHARED, None, 60).result()
+        l = lock.all_locks('/webdav/test1/t.txt')
+        assert [x.id for x in l] == [lockid]
+        assert lock.getbyid(lockid).resource == u'/webdav/test1/'
+
+        lock.refresh_lock(lockid, 120)
+        assert lock.getbyid(lockid).timeout == 120
+
+        lock.remove_lock(lockid)
+        assert lock.all_locks('/webdav/test1/t.txt') == []
+        assert lock.getbyid(lockid) == None
+        assert lock._tree.childs == {}
+
+        # the locks table is not reloaded after a change
+        assert db.statements == ['delete', 'select', 'insert', 'update', 'delete']
+
+
+    def test_shared_tokens(self):
+        lock = Lockdb(LocksDb())
+        # in the same second
+        first = lock.add_lock(u'/webdav/test1/', SHARED, 0, 60).result()
+        second = lock.add_lock(u'/webdav/test1/', SHARED, 0, 60).result()
+        assert first != second
+        assert lock.getbyid(first).token != lock.getbyid(second).token
+        assert len( lock.shared_lock(u'/webdav/test1/') ) == 2
+
+
+    def test_executor(self):
+        executor = ThreadPoolExecutor(1)
+        db = SqliteStorage(':memory:', executor)
+        lock = Lockdb(db)
+        io_loop = IOLoop()
+
+        def add():
+            # hold the executor so the insert is pending
+            gate = threading.Event()
+            executor.submit(gate.wait)
+            future = lock.add_lock(u'/webdav/test1/', EXCLUSIVE, None, 60)
+            # the lock holds the resource before the row is inserted
+            assert future.done() == False
+            assert len( lock.exclusive_lock(u'/webdav/test1/t.txt') ) == 1
+            gate.set()
+            return future
+        lockid = io_loop.run_sync(add)
+        assert lock.getbyid(lockid).resource == u'/webdav/test1/'
+
+        io_loop.run_sync(lambda: lock.remove_lock(lockid))
+        io_loop.run_sync(lock.resync)
+        assert lock.all_locks(u'/webdav/test1/') == []
+        io_loop.close()
+
+    def test_resync_pending(self):
+        executor = ThreadPoolExecutor(2)
+        db = SqliteStorage(':memory:', executor)
+        lock = Lockdb(db)
+        io_loop = IOLoop()
+        insert_lock = db.insert_lock
+
+        # the row is not inserted yet, then inserted but not returned
+        for inserted in (False, True):
+            gate = threading.Event()
+            def held(*args):
+                if inserted:
+                    rowid = insert_lock(*args)
+                gate.wait(10)
+                return rowid if inserted else insert_lock(*args)
+            db.insert_lock = held
+
+            @gen.coroutine
+            def add():
+                future = lock.add_lock(u'/webdav/test1/', EXCLUSIVE, None, 60)
+                yield lock.resync()
+                # still held while it is inserted
+                assert len( lock.exclusive_lock(u'/webdav/test1/t.txt') ) == 1
+                gate.set()
+                lockid = yield future
+                raise gen.Return(lockid)
+            lockid = io_loop.run_sync(add)
+            assert lock.getbyid(lockid).resource == u'/webdav/test1/'
+            assert len( lock.all_locks(u'/webdav/test1/') ) == 1
+
+            io_loop.run_sync(lambda: lock.remove_lock(lockid))
+            assert lock.all_locks(u'/webdav/test1/') == []
+            assert lock._tree.childs == {}
+        executor.shutdown()
+        io_loop.close()
+
+
+    def test_expiry(self):
+        db = LocksDb()
+        lock = Lockdb(db)
+        now = get_current_time()
+        owner = u'<D:href xmlns:D="DAV:">http://example.org/~ejw/contact.html</D:href>'
+        lock._locks = [
+            Lock(resource=u'/webdav/old.txt', created=now-100, depth=0, 
+                 token=u'aaaa', timeout=10, owner=owner, scope=1L, id=1L),
+            Lock(resource=u'/webdav/older.txt', created=now-200, depth=0, 
+                 token=u'bbbb', timeout=10, owner=owner, scope=1L, id=2L),
+            Lock(resource=u'/webdav/new.txt', created=now, depth=0, 
+                 token=u'cccc', timeout=10, owner=owner, scope=1L, id=3L),
+            Lock(resource=u'/webdav/', created=now-100, depth=0, 
+                 token=u'dddd', timeout=None, owner=owner, scope=1L, id=4L),
+            ]
+
+        assert lock.all_locks('/webdav/old.txt') == []
+        assert lock.getbytoken(u'bbbb') == None
+        assert sorted(x.id for x in lock.dependent_lock('/webdav/')) == [3]
+        assert lock.getbyid(4L) != None
+
+        del db.statements[:]
+        lock.purge()
+        assert db.statements == ['delete']
+        lock.purge()
+        assert db.statements == ['delete']
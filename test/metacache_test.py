@@ -0,0 +1,132 @@
+import unittest
+import os
+import errno
+import shutil
+import tempfile
+
+from http.metacache import MetadataCache
+from http.file_object import FileObject
+
+
+class Application(object):
+    def __init__(self, directory, metadata):
+        self.directory = directory
+        self.metadata = metadata
+
+
+class TestMetadataCache ( unittest.TestCase ):
+
+    def setUp(self):
+        self.cache = MetadataCache.create(100)
+        if not self.cache.enabled():
+            self.skipTest('inotify is not available')
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'col'))
+        with open(os.path.join(self.root, 'col', 'a.txt'), 'w') as f:
+            f.write('a')
+
+    def tearDown(self):
+        self.cache.watcher.close()
+        shutil.rmtree(self.root)
+
+    def path(self, *names):
+        return os.path.join(self.root, 'col', *names)
+
+    def test_stat(self):
+        assert self.cache.stat(self.path('a.txt')).st_size == 1
+        assert self.cache.stat(self.path('a.txt')).st_size == 1
+        assert self.cache.stat(self.path('missing')) == None
+        assert self.cache.stat(self.path('missing')) == None
+        stats = self.cache.stats()
+        assert (stats['hits'], stats['misses']) == (2, 2)
+        assert stats['entries'] == 2 and stats['watches'] == 1
+
+    def test_watcher(self):
+        assert [name for name, stat in self.cache.listdir(self.path())] == \
+            ['a.txt']
+        assert self.cache.stat(self.path('a.txt')).st_size == 1
+
+        # changes made by others are seen once the events are read
+        with open(self.path('a.txt'), 'a') as f:
+            f.write('bc')
+        open(self.path('b.txt'), 'w').close()
+        self.cache._on_events(self.cache.watcher.fileno(), None)
+        assert self.cache.stat(self.path('a.txt')).st_size == 3
+        assert sorted(name for name, stat in 
+                    self.cache.listdir(self.path())) == ['a.txt', 'b.txt']
+
+        # a removed directory forgets everything below it
+        self.cache.listdir(self.path())
+        shutil.rmtree(self.path())
+        self.cache._on_events(self.cache.watcher.fileno(), None)
+        assert self.cache.stat(self.path('a.txt')) == None
+        self.assertRaises(OSError, self.cache.listdir, self.path())
+
+    def test_file_object(self):
+        application = Application(self.root, self.cache)
+        collection = FileObject(application, 'col', '')
+        child = collection.childs()[0]
+        assert child.contenttype() == 'text/plain'
+        assert FileObject(application, 'col', 'a.txt').etag == child.etag
+
+        # the object invalidates what it changes itself
+        child.write('changed')
+        assert FileObject(application, 'col', 'a.txt').st_size == 7
+        FileObject(application, 'col', '').mkcol()
+        assert FileObject(application, 'col/sub', '').exists == False
+        FileObject(application, 'col/sub', '').mkcol()
+        assert FileObject(application, 'col/sub', '').collection
+        assert [c.uri for c in collection.childs() if c.collection] == \
+            ['/col/sub/']
+
+    def test_size(self):
+        cache = MetadataCache(3, self.cache.watcher)
+        for i in range(10):
+            open(self.path('f%d' % i), 'w').close()
+            cache.stat(self.path('f%d' % i))
+        assert cache.stats()['entries'] == 3
+        # a listing counts for each of its entries
+        cache.listdir(self.path())
+        assert cache.stats()['entries'] == 0
+
+    def test_watches(self):
+        cache = MetadataCache(100, self.cache.watcher, max_watches=2)
+        for name in ('a', 'b', 'c'):
+            os.mkdir(self.path(name))
+            open(self.path(name, 'f'), 'w').close()
+            cache.stat(self.path(name, 'f'))
+        stats = cache.stats()
+        assert stats['watches'] == 2 and stats['entries'] == 2
+        # the entries of the oldest watch went with it
+        assert self.path('a') not in cache._watches
+        cache.stat(self.path('b', 'f'))
+        assert cache.stats()['hits'] == 1
+
+        # the watch of a directory reached by another path is kept
+        os.symlink(self.path('c'), self.path('d'))
+        cache.stat(self.path('d', 'f'))
+        cache.stat(self.path('b', 'f'))
+        cache.stat(self.path('a', 'f'))
+        assert sorted(cache._watches) == [self.path('a'), self.path('b')]
+        assert [directories for directories in cache._directories.values()
+                if self.path('c') in directories] == []
+
+    def test_out_of_watches(self):
+        class Watcher(object):
+            def add_watch(self, directory):
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        cache = MetadataCache(100, Watcher())
+        assert cache.stat(self.path('a.txt')).st_size == 1
+        assert not cache.enabled()
+        assert cache.stat(self.path('a.txt')).st_size == 1
+        assert cache.stats()['entries'] == 0
+
+    def test_disabled(self):
+        cache = MetadataCache(100, None)
+        assert cache.stat(self.path('a.txt')).st_size == 1
+        assert cache.stat(self.path('a.txt')).st_size == 1
+        assert cache.stats()['entries'] == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from lxml import etree
+from tornado.concurrent import Future
+
+from http.dav.davelement import *
+from http.multistatus import MultistatusWriter
+
+
+class Handler(object):
+    """ records the written body and the flushes """
+    def __init__(self):
+        self.body = []
+        self.flushes = []
+
+    def write(self, data):
+        self.body.append(data)
+
+    def flush(self):
+        self.flushes.append(len(''.join(self.body)))
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+class TestMultistatus ( unittest.TestCase ):
+
+    def test_write(self):
+        handler = Handler()
+        produced = []
+
+        def responses():
+            for i in range(100):
+                # responses are produced while the body is written
+                produced.append( len(''.join(handler.body)) )
+                yield ResponseElement(HrefElement('/webdav/f%d.txt' % i))
+
+        MultistatusWriter(handler, flush_size=1024).write(responses()).result()
+
+        body = ''.join(handler.body)
+        assert body.startswith("<?xml version='1.0' encoding='UTF-8'?>")
+        multistatus = etree.fromstring(body)
+        assert multistatus.tag == '{DAV:}multistatus'
+        assert [r.findtext('{DAV:}href') for r in multistatus] == \
+            ['/webdav/f%d.txt' % i for i in range(100)]
+        assert produced == sorted(produced) and produced[-1] > 0
+        assert len(handler.flushes) > 1
+        assert max(b - a for a, b in zip([0] + handler.flushes, handler.flushes)) < 2048
+
+    def test_empty(self):
+        handler = Handler()
+        MultistatusWriter(handler).write([]).result()
+        multistatus = etree.fromstring(''.join(handler.body))
+        assert multistatus.tag == '{DAV:}multistatus'
+        assert len(multistatus) == 0
+
+    def test_futures(self):
+        handler = Handler()
+        batch = Future()
+        batch.set_result([ResponseElement(HrefElement('/webdav/a/')),
+                          ResponseElement(HrefElement('/webdav/a/b.txt'))])
+        responses = [ResponseElement(HrefElement('/webdav/')), batch]
+        MultistatusWriter(handler).write(responses).result()
+        multistatus = etree.fromstring(''.join(handler.body))
+        assert [r.findtext('{DAV:}href') for r in multistatus] == \
+            ['/webdav/', '/webdav/a/', '/webdav/a/b.txt']
+
+    def test_raw(self):
+        handler = Handler()
+        fragment = '<Z:p xmlns:Z="x:" xmlns:Q="q:" Q:t="1">&#233;<Z:b/></Z:p>'
+        response = ResponseElement(HrefElement('/webdav/f.txt'),
+                        PropStatElement(PropElement(RawElement(fragment), 
+                                                    DAVElement.getetag('e')),
+                                        StatusElement('HTTP/1.1 200 OK')))
+        MultistatusWriter(handler).write([response]).result()
+        body = ''.join(handler.body)
+        # spliced as stored
+        assert fragment in body
+        prop = etree.fromstring(body).find('.//{DAV:}prop')
+        assert [e.tag for e in prop] == ['{x:}p', '{DAV:}getetag']
+        assert prop[0].text == u'\xe9' and prop[0].get('{q:}t') == '1'
+        assert prop[1].text == 'e'
@@ -1,8 +1,33 @@
 import unittest
+import os
+import shutil
+import tempfile
+from lxml import etree
 
 from http.dav.davelement import *
-from http.dav.properties import Properties, PropFindParser
+from http.dav.properties import Properties, PropFindParser, PropPatchParser, \
+    PropertyCache, UriSet, DbAdapter
+from http.dav.lock import Lockdb
 from http.file_object import FileObject
+from http.storage import SqliteStorage
+
+
+class Application(object):
+    def __init__(self, directory, db):
+        self.directory = directory
+        self.db = db
+        self.lockdb = Lockdb()
+        self.executor = None
+
+
+def dead_text(response, tag):
+    """ text of the stored property tag in a response """
+    for raw in response.iter(RAW_TAG):
+        element = etree.fromstring(raw.text)
+        if element.tag == tag:
+            return element.text
+    return None
+
 
 class TestPropfind ( unittest.TestCase ):
     def test_default(self):
@@ -117,6 +142,255 @@ class TestPropfind ( unittest.TestCase ):
             result[prop.tag] = prop.text
         assert '{DAV:}displayname' in result.keys()
         assert '{http://www.foo.bar/boxschema/}author' in result.keys()
+
+    def test_lazy_live(self):
+        calls = []
+        file_object = FileObject(None, 'static', '')
+        for name in ('getetag', 'getcontenttype'):
+            method = getattr(file_object, name)
+            def counted(method=method, name=name):
+                calls.append(name)
+                return method()
+            setattr(file_object, name, counted)
+        p = Properties( file_object, locks=[] )
+
+        response = p.propfind(['{DAV:}getetag'])
+        assert calls == ['getetag']
+        props = list( list(response[0])[0] )
+        assert [prop.tag for prop in props] == ['{DAV:}getetag']
+
+        # evaluated once
+        p.propfind(['{DAV:}getetag', '{DAV:}lockdiscovery'])
+        assert calls == ['getetag']
+        assert p.get('{DAV:}getcontenttype').tag == '{DAV:}getcontenttype'
+        assert calls == ['getetag', 'getcontenttype']
+
+    def test_depth_one_queries(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'col'))
+            for i in range(20):
+                open(os.path.join(root, 'col', 'f%d.txt' % i), 'w').close()
+            author = '<R:author xmlns:R="http://www.foo.bar/boxschema/">me</R:author>'
+            db = SqliteStorage(':memory:')
+            db.insert_property('/col/f3.txt', 
+                '{http://www.foo.bar/boxschema/}author', author)
+            db.queries = 0
+            collection = FileObject(Application(root, db), 'col', '')
+            parser = PropFindParser("""\
+    <D:propfind xmlns:D="DAV:" xmlns:R="http://www.foo.bar/boxschema/">
+      <D:prop><D:getetag/><R:author/></D:prop>
+    </D:propfind>""")
+            status, response = collection.propfind(parser, 1).result()
+            response = list(response)
+
+            assert status == 207
+            assert len ( response ) == 21
+            # one query for the collection and all of its childs
+            assert db.queries == 1
+            found = [r[0].text for r in response 
+                if dead_text(r, '{http://www.foo.bar/boxschema/}author') == 'me']
+            assert found == ['/col/f3.txt']
+        finally:
+            shutil.rmtree(root)
+
+    def test_proppatch_queries(self):
+        root = tempfile.mkdtemp()
+        try:
+            open(os.path.join(root, 'f.txt'), 'w').close()
+            db = SqliteStorage(':memory:')
+            db.insert_property('/f.txt', '{x:}old', '<Z:old xmlns:Z="x:"/>')
+            db.queries = 0
+            dav_object = FileObject(Application(root, db), '', 'f.txt')
+
+            props = ''.join('<Z:p%d>%d</Z:p%d>' % (i, i, i) for i in range(20))
+            parser = PropPatchParser("""\
+    <D:propertyupdate xmlns:D="DAV:" xmlns:Z="x:">
+      <D:set><D:prop>%s</D:prop></D:set>
+      <D:remove><D:prop><Z:old/></D:prop></D:remove>
+    </D:propertyupdate>""" % props)
+            status, response = dav_object.proppatch(parser).result()
+            assert status == 207
+            # select, then delete, insert and select in one transaction
+            assert db.queries == 4
+            rows = db.select_properties(['/f.txt'])
+            assert sorted(row['property_name'] for row in rows) == \
+                sorted('{x:}p%d' % i for i in range(20))
+
+            # a forbidden property fails the whole update
+            db.queries = 0
+            parser = PropPatchParser("""\
+    <D:propertyupdate xmlns:D="DAV:" xmlns:Z="x:">
+      <D:set><D:prop><Z:new/><D:getetag>x</D:getetag></D:prop></D:set>
+    </D:propertyupdate>""")
+            status, response = dav_object.proppatch(parser).result()
+            assert [p.findtext('{DAV:}status') 
+                    for p in response.findall('{DAV:}propstat')] == \
+                ['HTTP/1.1 403 Forbidden']
+            assert db.queries == 1
+            assert len( db.select_properties(['/f.txt']) ) == 20
+        finally:
+            shutil.rmtree(root)
+
+    def test_property_cache(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root, 'col', 'sub'))
+            for name in ('a.txt', 'b.txt', 'sub/c.txt'):
+                open(os.path.join(root, 'col', name), 'w').close()
+            db = SqliteStorage(':memory:')
+            db.insert_property('/col/a.txt', '{x:}p', '<Z:p xmlns:Z="x:">1</Z:p>')
+            db.property_cache = PropertyCache(1024*1024)
+            application = Application(root, db)
+            collection = FileObject(application, 'col', '')
+            parser = PropFindParser("""\
+    <D:propfind xmlns:D="DAV:" xmlns:Z="x:"><D:prop><Z:p/></D:prop></D:propfind>""")
+
+            def values(response=None):
+                if response==None:
+                    status, response = collection.propfind(parser, 1).result()
+                return dict( (r.findtext('{DAV:}href'), 
+                              dead_text(r, '{x:}p'))
+                             for r in response )
+
+            db.queries = 0
+            first = values()
+            assert first['/col/a.txt'] == '1' and first['/col/b.txt'] == None
+            assert db.queries == 1
+            # warm resources do not query the database, the cached
+            # fragments are not parsed again
+            status, response = collection.propfind(parser, 1).result()
+            response = list(response)
+            assert values() == first and values(response) == first
+            assert db.queries == 1
+
+            # changes are written through
+            dav_object = FileObject(application, 'col', 'b.txt')
+            status, response = dav_object.proppatch(PropPatchParser("""\
+    <D:propertyupdate xmlns:D="DAV:" xmlns:Z="x:">
+      <D:set><D:prop><Z:p>2</Z:p></D:prop></D:set>
+    </D:propertyupdate>""")).result()
+            assert values()['/col/b.txt'] == '2'
+
+            adapter = DbAdapter(db)
+            adapter.move_properties('/col/a.txt', '/col/sub/a.txt').result()
+            assert values()['/col/a.txt'] == None
+            adapter.delete_collection('/col/').result()
+            assert values()['/col/b.txt'] == None
+
+            # entries beyond the budget are dropped
+            db.property_cache = PropertyCache(3 * PropertyCache.ENTRY_SIZE)
+            values()
+            assert db.property_cache.stats()['entries'] < 4
+        finally:
+            shutil.rmtree(root)
+
+    def test_uri_set(self):
+        db = SqliteStorage(':memory:')
+        for uri in [u'/a/', u'/a/x/a/', u'/a/100%25_b', u'/ab', u'/a0', u'/a_/c']:
+            db.insert_property(uri, u'{x:}p', u'<p xmlns="x:"/>')
+        db.property_uris = UriSet(db.select_property_uris())
+        adapter = DbAdapter(db)
+
+        def uris():
+            assert db.property_uris.select('/', True) == \
+                sorted(db.select_property_uris())
+            # the membership set follows the sorted list
+            assert sorted(db.property_uris._set) == db.property_uris._uris
+            return db.property_uris.select('/', True)
+
+        # the same changes as the storage subtree test
+        adapter.move_collection('/a/', '/b').result()
+        assert uris() == [u'/a0', u'/a_/c', u'/ab', u'/b/', u'/b/100%25_b', u'/b/x/a/']
+        adapter.copy_collection('/b/x', '/a_').result()
+        assert uris() == [u'/a0', u'/a_/a/', u'/ab', u'/b/', u'/b/100%25_b', u'/b/x/a/']
+        adapter.delete_collection('/b/100%').result()
+        adapter.delete_properties('/b/100%25_b').result()
+        adapter.delete_collection('/a').result()
+        adapter.delete_collection('/b/').result()
+        assert uris() == [u'/a0', u'/a_/a/', u'/ab']
+        adapter.copy_properties('/ab', '/ac').result()
+        adapter.move_properties('/ac', '/ad').result()
+        assert uris() == [u'/a0', u'/a_/a/', u'/ab', u'/ad']
+
+        root = tempfile.mkdtemp()
+        try:
+            for name in ('a0', 'ab', 'ac'):
+                open(os.path.join(root, name), 'w').close()
+            application = Application(root, db)
+            parser = PropFindParser("""\
+    <D:propfind xmlns:D="DAV:"><D:prop><D:getetag/></D:prop></D:propfind>""")
+            db.queries = 0
+            collection = FileObject(application, '', '')
+            status, response = collection.propfind(parser, 1).result()
+            assert len(list(response)) == 4
+            # one query for the uris that have properties
+            assert db.queries == 1
+            status, response = FileObject(application, '', 'ac').propfind(
+                                                        parser).result()
+            assert db.queries == 1
+
+            # the set follows the changes of properties
+            dav_object = FileObject(application, '', 'ac')
+            dav_object.proppatch(PropPatchParser("""\
+    <D:propertyupdate xmlns:D="DAV:" xmlns:Z="x:">
+      <D:set><D:prop><Z:p>1</Z:p></D:prop></D:set>
+    </D:propertyupdate>""")).result()
+            assert '/ac' in db.property_uris
+            dav_object.proppatch(PropPatchParser("""\
+    <D:propertyupdate xmlns:D="DAV:" xmlns:Z="x:">
+      <D:remove><D:prop><Z:p/></D:prop></D:remove>
+    </D:propertyupdate>""")).result()
+            assert '/ac' not in db.property_uris
+            uris()
+        finally:
+            shutil.rmtree(root)
+
+    def test_depth_infinity(self):
+        root = tempfile.mkdtemp()
+        try:
+            for path in ('col/a/b', 'col/c', 'col/.dav-hidden'):
+                os.makedirs(os.path.join(root, path))
+            for path in ('col/f.txt', 'col/a/g.txt', 'col/a/b/h.txt'):
+                open(os.path.join(root, path), 'w').close()
+            db = SqliteStorage(':memory:')
+            db.insert_property('/col/a/b/h.txt', '{x:}p',
+                '<Z:p xmlns:Z="x:">1</Z:p>')
+            db.queries = 0
+            collection = FileObject(Application(root, db), 'col', '')
+            parser = PropFindParser("""\
+    <D:propfind xmlns:D="DAV:" xmlns:Z="x:">
+      <D:prop><D:getetag/><Z:p/></D:prop>
+    </D:propfind>""")
+
+            def responses(max_entries):
+                status, response = collection.propfind(parser, None,
+                                            None, max_entries).result()
+                assert status == 207
+                elements = []
+                for batch in response:
+                    elements += batch.result()
+                return elements
+
+            response = responses(None)
+            assert sorted(r.findtext('{DAV:}href') for r in response) == [
+                '/col/', '/col/a/', '/col/a/b/', '/col/a/b/h.txt',
+                '/col/a/g.txt', '/col/c/', '/col/f.txt']
+            found = [r.findtext('{DAV:}href') for r in response
+                if dead_text(r, '{x:}p') == '1']
+            assert found == ['/col/a/b/h.txt']
+            # the tree fits in one batch and one query
+            assert db.queries == 1
+
+            response = responses(3)
+            assert len(response) == 4
+            assert response[-1].findtext('{DAV:}href') == '/col/'
+            assert response[-1].findtext('{DAV:}status') == \
+                'HTTP/1.1 507 Insufficient Storage'
+            # a limit the tree does not exceed
+            assert len(responses(7)) == 7
+        finally:
+            shutil.rmtree(root)
         
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+
+import unittest
+
+from http.rangeheader import parse_range_header, if_range_match
+
+ETAG = "\"ddddffff1234\""
+MTIME = 1326985790
+
+
+class TestRangeHeader ( unittest.TestCase ):
+
+    def test_single(self):
+        self.assertEqual( parse_range_header('bytes=0-499', 1000), [(0, 499)] )
+        self.assertEqual( parse_range_header('bytes=500-', 1000), [(500, 999)] )
+        self.assertEqual( parse_range_header('bytes=-200', 1000), [(800, 999)] )
+        self.assertEqual( parse_range_header('bytes=-2000', 1000), [(0, 999)] )
+        self.assertEqual( parse_range_header('bytes=900-2000', 1000), [(900, 999)] )
+
+    def test_multi(self):
+        r = parse_range_header('bytes=500-599, 0-99', 1000)
+        self.assertEqual( r, [(0, 99), (500, 599)] )
+        # overlapping and adjacent ranges are coalesced
+        r = parse_range_header('bytes=0-99,50-199,200-299', 1000)
+        self.assertEqual( r, [(0, 299)] )
+        # unsatisfiable ranges are dropped
+        r = parse_range_header('bytes=0-99,2000-3000', 1000)
+        self.assertEqual( r, [(0, 99)] )
+
+    def test_unsatisfiable(self):
+        self.assertEqual( parse_range_header('bytes=1000-', 1000), [] )
+        self.assertEqual( parse_range_header('bytes=-0', 1000), [] )
+        self.assertEqual( parse_range_header('bytes=0-', 0), [] )
+
+    def test_ignored(self):
+        self.assertEqual( parse_range_header('items=0-1', 1000), None )
+        self.assertEqual( parse_range_header('bytes=5-1', 1000), None )
+        self.assertEqual( parse_range_header('bytes=a-b', 1000), None )
+        self.assertEqual( parse_range_header('bytes=-', 1000), None )
+        self.assertEqual( parse_range_header('bytes 0-1', 1000), None )
+        many = 'bytes=' + ','.join(['%d-%d' % (i*2, i*2) for i in range(100)])
+        self.assertEqual( parse_range_header(many, 1000), None )
+
+    def test_if_range(self):
+        self.assertTrue( if_range_match(ETAG, ETAG, MTIME) )
+        self.assertFalse( if_range_match("\"other\"", ETAG, MTIME) )
+        self.assertFalse( if_range_match("W/" + ETAG, ETAG, MTIME) )
+        self.assertTrue( if_range_match("Thu, 19 Jan 2012 15:09:50 GMT", ETAG, MTIME + 0.5) )
+        self.assertFalse( if_range_match("Thu, 19 Jan 2012 15:09:51 GMT", ETAG, MTIME) )
+        self.assertFalse( if_range_match("garbage", ETAG, MTIME) )
+
+
+if __name__ == '__main__':
+    unittest.main()
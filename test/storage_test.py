@@ -0,0 +1,158 @@
+import unittest
+
+from http.storage import *
+
+
+class TestStorage ( unittest.TestCase ):
+
+    def test_locks(self):
+        db = SqliteStorage(':memory:')
+        first = db.insert_lock(u'/webdav/a/', u'token1', 1, None, 1000, 60, None)
+        second = db.insert_lock(u'/webdav/b/', u'token2', 0, 0, 1000, None, u'me')
+        assert first != second
+
+        assert len( db.select_locks(1050) ) == 2
+        # the timed lock is expired
+        locks = db.select_locks(1070)
+        assert [l['id'] for l in locks] == [second]
+        assert locks[0]['owner'] == u'me'
+
+        db.update_lock(first, 1060, 60)
+        assert len( db.select_locks(1070) ) == 2
+        # infinite locks are dropped after max timeout
+        assert db.clean_locks(100, 1110) == 1
+        assert [l['id'] for l in db.select_locks(1110)] == [first]
+
+        db.delete_locks([first])
+        assert db.select_locks(1110) == []
+
+    def test_properties(self):
+        db = SqliteStorage(':memory:')
+        db.insert_property(u'/webdav/a/', u'{x:}p', u'<p xmlns="x:">1</p>')
+        db.insert_property(u'/webdav/a/f.txt', u'{x:}p', u'<p xmlns="x:">2</p>')
+        db.insert_property(u'/webdav/ab', u'{x:}p', u'<p xmlns="x:">3</p>')
+
+        rows = db.patch_properties(u'/webdav/a/', [(u'{x:}p', u'<p xmlns="x:">4</p>')], [])
+        assert [row['property_value'] for row in rows] == [u'<p xmlns="x:">4</p>']
+        rows = db.select_properties([u'/webdav/a/', u'/webdav/ab'])
+        assert sorted(row['uri'] for row in rows) == [u'/webdav/a/', u'/webdav/ab']
+
+        # copy over existing properties of the destination
+        db.insert_property(u'/webdav/c/', u'{x:}p', u'<p xmlns="x:">5</p>')
+        assert db.copy_properties(u'/webdav/a/', u'/webdav/c/', True) == 2
+        rows = db.select_properties([u'/webdav/c/', u'/webdav/c/f.txt'])
+        assert sorted(row['property_value'] for row in rows) == \
+            [u'<p xmlns="x:">2</p>', u'<p xmlns="x:">4</p>']
+
+        assert db.move_properties(u'/webdav/c/', u'/webdav/d/', True) == 2
+        assert db.select_properties([u'/webdav/c/']) == []
+        assert len( db.select_properties([u'/webdav/d/', u'/webdav/d/f.txt']) ) == 2
+
+        assert db.delete_properties(u'/webdav/a/', True) == 2
+        assert len( db.select_properties([u'/webdav/ab']) ) == 1
+        assert sorted(db.select_property_uris()) == \
+            [u'/webdav/ab', u'/webdav/d/', u'/webdav/d/f.txt']
+
+    def test_subtree(self):
+        db = SqliteStorage(':memory:')
+        for uri in [u'/a/', u'/a/x/a/', u'/a/100%25_b', u'/ab', u'/a0', u'/a_/c']:
+            db.insert_property(uri, u'{x:}p', u'<p xmlns="x:"/>')
+
+        def uris():
+            return sorted(row['uri'] for row in db.dump('property'))
+
+        # no wildcards, only the prefix of the moved uris is replaced
+        assert db.move_properties(u'/a/', u'/b', True) == 3
+        assert uris() == [u'/a0', u'/a_/c', u'/ab', u'/b/', u'/b/100%25_b', u'/b/x/a/']
+
+        assert db.copy_properties(u'/b/x', u'/a_', True) == 1
+        assert uris() == [u'/a0', u'/a_/a/', u'/ab', u'/b/', u'/b/100%25_b', u'/b/x/a/']
+
+        assert db.delete_properties(u'/b/100%', True) == 0
+        assert db.delete_properties(u'/b/100%25_b') == 1
+        assert db.delete_properties(u'/a', True) == 0
+        assert db.delete_properties(u'/b/', True) == 2
+        assert uris() == [u'/a0', u'/a_/a/', u'/ab']
+
+        for i in range(5):
+            db.insert_property(u'/t/%d' % i, u'{x:}p', u'<p xmlns="x:"/>')
+        assert db.purge_properties(u'/t/', 3) == 3
+        assert db.purge_properties(u'/t/', 3) == 2
+        assert db.purge_properties(u'/t/', 3) == 0
+        assert uris() == [u'/a0', u'/a_/a/', u'/ab']
+
+    def test_patch(self):
+        db = SqliteStorage(':memory:')
+        db.insert_property(u'/a', u'{x:}a', u'<a xmlns="x:"/>')
+        db.insert_property(u'/a', u'{x:}b', u'<b xmlns="x:"/>')
+        db.queries = 0
+
+        values = [(u'{x:}p%d' % i, u'<p%d xmlns="x:"/>' % i) for i in range(500)]
+        rows = db.patch_properties(u'/a', values + [(u'{x:}a', u'<a xmlns="x:">1</a>')], 
+                                   [u'{x:}b', u'{x:}none'])
+        # delete, two inserts and select
+        assert db.queries == 4
+        names = dict( (row['property_name'], row['property_value']) for row in rows )
+        assert len(names) == 501
+        assert names[u'{x:}a'] == u'<a xmlns="x:">1</a>'
+        assert u'{x:}b' not in names
+
+        # a failed patch changes nothing
+        self.assertRaises(Exception, db.patch_properties, u'/a', 
+                          [(u'{x:}c', u'<c xmlns="x:"/>'), (u'{x:}d', object())], [u'{x:}a'])
+        rows = db.select_properties([u'/a'])
+        assert len(rows) == 501
+        assert u'{x:}c' not in [row['property_name'] for row in rows]
+
+    def test_migrate(self):
+        source = SqliteStorage(':memory:')
+        source.insert_lock(u'/webdav/a/', u'token1', 1, None, 1000, 60, None)
+        source.insert_property(u'/webdav/a/', u'{x:}p', u'<p xmlns="x:"/>')
+        source.load('users', [{'realm': u'r', 'user_name': u'u', 'user_hash': u'h'},
+            {'realm': u'other', 'user_name': u'v', 'user_hash': u'h'}])
+
+        target = SqliteStorage(':memory:')
+        copied = migrate(source, target)
+        assert copied == {'locks': 1, 'property': 1, 'users': 2}
+        assert len( target.select_properties([u'/webdav/a/']) ) == 1
+        assert target.select_locks(1000)[0]['token'] == u'token1'
+        assert target.select_users(u'r') == [(u'u', u'h')]
+
+    def test_migrate_duplicates(self):
+        class Source(object):
+            """ an old MySQL property table without a unique key """
+            def dump(self, table):
+                if table != 'property':
+                    return []
+                return [{'id': 3, 'uri': u'/a', 'property_name': u'{x:}p',
+                         'property_value': u'<p xmlns="x:">new</p>'},
+                        {'id': 1, 'uri': u'/a', 'property_name': u'{x:}p',
+                         'property_value': u'<p xmlns="x:">old</p>'},
+                        {'id': 2, 'uri': u'/b', 'property_name': u'{x:}p',
+                         'property_value': u'<p xmlns="x:"/>'}]
+
+        target = SqliteStorage(':memory:')
+        assert migrate(Source(), target)['property'] == 3
+        rows = target.select_properties([u'/a', u'/b'])
+        assert sorted((row['uri'], row['property_value']) for row in rows) == \
+            [(u'/a', u'<p xmlns="x:">new</p>'), (u'/b', u'<p xmlns="x:"/>')]
+
+    def test_malformed(self):
+        source = SqliteStorage(':memory:')
+        source.insert_property(u'/a', u'{x:}good', u'<Z:good xmlns:Z="x:"/>')
+        # rows stored by older versions or other writers
+        for name, value in ((u'{x:}open', u'<Z:open xmlns:Z="x:">1'),
+                (u'{x:}decl', u'<?xml version="1.0"?><Z:decl xmlns:Z="x:"/>'),
+                (u'{x:}text', u'text'),
+                (u'{x:}empty', u''),
+                (u'{x:}doctype', u'<!DOCTYPE d [<!ENTITY e "e">]><d>&e;</d>')):
+            source.insert_property(u'/a', name, value)
+        target = SqliteStorage(':memory:')
+        assert migrate(source, target)['property'] == 1
+        assert [row['property_name'] for row in
+                target.select_properties([u'/a'])] == [u'{x:}good']
+
+        # in batches, of the table in place
+        assert source._delete_malformed('property', 2) == 5
+        assert [row['property_name'] for row in
+                source.select_properties([u'/a'])] == [u'{x:}good']
@@ -0,0 +1,73 @@
+import unittest
+import os
+import shutil
+import tempfile
+from tornado.ioloop import IOLoop
+
+from http.dav.properties import DbAdapter
+from http.file_object import FileObject
+from http.storage import SqliteStorage
+from http.trash import Trash
+
+
+class Application(object):
+    def __init__(self, directory, trash):
+        self.directory = directory
+        self.trash = trash
+
+
+class TestTrash ( unittest.TestCase ):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ('col/a', 'col/b/c'):
+            os.makedirs(os.path.join(self.root, path))
+        for i in range(5):
+            for path in ('col', 'col/a', 'col/b/c'):
+                open(os.path.join(self.root, path, 'f%d' % i), 'w').close()
+        os.symlink(os.path.join(self.root, 'col', 'a'), 
+                   os.path.join(self.root, 'col', 'link'))
+        self.db = SqliteStorage(':memory:')
+        self.io_loop = IOLoop()
+        for uri in ('/col/', '/col/a/f1', '/col/b/c/', '/colon'):
+            self.db.insert_property(uri, '{x:}p', '<Z:p xmlns:Z="x:"/>')
+
+    def tearDown(self):
+        self.io_loop.close()
+        shutil.rmtree(self.root)
+
+    def test_delete(self):
+        trash = Trash(self.root, self.db, batch=4, pause=0)
+        collection = FileObject(Application(self.root, trash), 'col', '')
+        assert collection.delete() == 204
+        assert not os.path.exists(os.path.join(self.root, 'col'))
+        assert os.listdir(trash.directory) == [collection.trashed]
+
+        self.io_loop.run_sync(lambda: DbAdapter(self.db).trash_collection(
+                            '/col/', trash.uri(collection.trashed)))
+        uris = sorted(row['uri'] for row in self.db.dump('property'))
+        assert uris == ['/.dav-trash/%s/%s' % (collection.trashed, uri)
+                        for uri in ('', 'a/f1', 'b/c/')] + ['/colon']
+
+        self.io_loop.run_sync(trash.reap)
+        assert os.listdir(trash.directory) == []
+        # 15 files, the link and 4 directories
+        assert trash.files == 20
+        assert trash.rows == 3
+        assert [row['uri'] for row in self.db.dump('property')] == ['/colon']
+        # the link is not followed
+        assert os.path.isdir(self.root)
+
+    def test_restart(self):
+        Trash(self.root, self.db).put(os.path.join(self.root, 'col', 'b'))
+        trash = Trash(self.root, self.db, batch=2, pause=0)
+        assert trash.stats()['entries'] == 1
+        self.io_loop.run_sync(trash.reap)
+        assert trash.stats()['entries'] == 0
+        assert trash.files == 7
+        assert sorted(os.listdir(os.path.join(self.root, 'col'))) == \
+            ['a', 'f0', 'f1', 'f2', 'f3', 'f4', 'link']
+
+
+if __name__ == '__main__':
+    unittest.main()